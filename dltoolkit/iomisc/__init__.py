@@ -1,5 +1,14 @@
 """Various data set I/O classes"""
 from .hdf5writer import HDF5Writer
 from .hdf5reader import HDF5Reader
-from .hdf5generator import HDF5Generator, HDF5Generator_Segment
+from .hdf5generator import HDF5Generator, HDF5Generator_Segment, HDF5ShardedGenerator
+from .hdf5sequence import HDF5Sequence, HDF5Sequence_Segment
+from .patchgenerator import RandomPatchGenerator
+from .subvolumegenerator import SubVolumeGenerator
+from .pixelindex import PixelIndex, cached_pixel_index
+from .hdf5sharded import HDF5ShardedWriter, HDF5ShardedReader
 from .memorydataloader import MemoryDataLoader
+from .parallelloader import ParallelLoader, ImageFileLoader
+from .hdf5incremental import update_hdf5
+from .hdf5cache import HDF5HandleCache, get_handle_cache
+from .hdf5memcache import HDF5MemoryCache, get_memory_cache
@@ -0,0 +1,53 @@
+"""Pool of preallocated batch arrays that are reused in turn, so assembling a batch does not allocate new arrays (and
+touch new memory pages) every time. A batch is assembled in one slot of the pool, e.g. the features in the slot's
+"X" array and the labels in its "Y" array. Slots are handed out round robin, so the arrays of a batch are overwritten
+once num_buffers more batches have been assembled.
+"""
+import numpy as np
+import threading
+
+
+class BatchBufferPool:
+    """Preallocated batch arrays, num_buffers of each kind
+
+    Attributes:
+        num_buffers: number of slots, i.e. the number of batches that can be alive at the same time
+        batch_size: number of records per array
+    """
+    def __init__(self, num_buffers, batch_size):
+        """
+        Initialise the class, arrays are allocated when they are first used
+        :param num_buffers: number of slots
+        :param batch_size: number of records per array
+        """
+        self.num_buffers = num_buffers
+        self.batch_size = batch_size
+        self._buffers = {}                  # (name, slot) -> NumPy array
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def next_slot(self):
+        """Return the slot to assemble the next batch in"""
+        with self._lock:
+            slot = self._next_slot
+            self._next_slot = (slot + 1) % self.num_buffers
+
+            return slot
+
+    def get(self, name, slot, record_shape, dtype):
+        """
+        Return an array of a slot, (re)allocating it when its record shape or data type changed
+        :param name: name of the array, e.g. "X"
+        :param slot: slot returned by next_slot()
+        :param record_shape: shape of a single record
+        :param dtype: data type of the array
+        :return: NumPy array with shape (batch_size,) + record_shape
+        """
+        shape = (self.batch_size,) + tuple(record_shape)
+        buffer = self._buffers.get((name, slot))
+
+        if buffer is None or buffer.shape != shape or buffer.dtype != np.dtype(dtype):
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[(name, slot)] = buffer
+
+        return buffer
@@ -0,0 +1,48 @@
+"""Fingerprints of the source files (or folders of files) records in a HDF5 data set were created from. They are
+used to detect which records need to be recreated when the source files change.
+"""
+import hashlib, os
+
+# Data set names used to store the source paths and their fingerprints in a HDF5 file
+DS_SOURCES = "SOURCES"
+DS_FINGERPRINTS = "FINGERPRINTS"
+
+HASH_BLOCK_SIZE = 2 ** 20
+
+
+def _file_hash(path, digest):
+    """Add the contents of a file to a hashlib digest"""
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+
+
+def file_fingerprint(path, use_hash=False):
+    """
+    Create the fingerprint of a file or of all files in a folder (e.g. a patient folder holding the slices of a 3D
+    volume)
+    :param path: full path to the file or folder
+    :param use_hash: True to hash the contents of each file (slow but exact), False to only use the size and
+    modification time of each file
+    :return: fingerprint string, None if the path does not exist
+    """
+    if not os.path.exists(path):
+        return None
+
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, f) for (root, _, filenames) in os.walk(path) for f in filenames)
+    else:
+        files = [path]
+
+    digest = hashlib.sha1()
+
+    for f in files:
+        digest.update(os.path.relpath(f, path).encode("utf-8"))
+
+        if use_hash:
+            _file_hash(f, digest)
+        else:
+            stat = os.stat(f)
+            digest.update("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+
+    return digest.hexdigest()
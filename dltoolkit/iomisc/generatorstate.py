@@ -0,0 +1,79 @@
+"""Serialisable state of the generators, so an interrupted training run can continue with exactly the batches it would
+have produced. The batches of the generators only depend on the seed and the position of the batch (the epoch and the
+index of the batch within the epoch): the shuffled orders, random patch positions, augmentations and random
+preprocessors (those with a uses_rng attribute, e.g. PatchPreprocessor) draw from random streams derived from them
+(see sampling.epoch_rng and sampling.batch_seed). The state therefore only holds the seed and the position of the next
+batch, e.g. {"epoch": 12, "cursor": 0, "seed": 42}. Preprocessors drawing from NumPy's global random state are not
+covered.
+
+state_dict() returns the state as a dictionary of plain integers that can be stored as JSON, load_state_dict()
+restores it. The next call to generator() starts at the restored position, the batches before it are not loaded.
+Generators created without a seed draw one, so runs without a fixed seed can be resumed as well.
+"""
+from .sampling import MAX_SEED
+from collections import deque
+import numpy as np
+
+
+class ResumableGenerator:
+    """Base class of the generators, tracks the position of the next batch taken by the consumer"""
+    def _init_state(self, seed):
+        """Initialise the state, the first batch is at the start of epoch 0"""
+        self._seed = seed if seed is not None else int(np.random.randint(MAX_SEED))
+        self._position = (0, 0)             # (epoch, index of the batch) of the next batch taken
+        self._pending = deque()             # positions of the batches generated but not taken yet
+
+    def _batches_per_epoch(self):
+        """Return the number of batches per epoch"""
+        raise NotImplementedError
+
+    def _positions(self, num_epochs):
+        """Generate the (epoch, index of the batch) position of every batch, starting at the current position"""
+        self._pending = deque()
+        (epoch, start) = self._position
+
+        while epoch < num_epochs:
+            for index in range(start, self._batches_per_epoch()):
+                self._pending.append((epoch, index))
+                yield (epoch, index)
+
+            (epoch, start) = (epoch + 1, 0)
+
+    def _advance(self):
+        """Move past the oldest batch generated, called when the batch is handed to the consumer"""
+        (epoch, index) = self._pending.popleft()
+        self._position = (epoch, index + 1) if index + 1 < self._batches_per_epoch() else (epoch + 1, 0)
+
+    def state_dict(self, num_batches=None):
+        """
+        Return the state of the generator
+        :param num_batches: number of batches used since the start of epoch 0, e.g. as counted by Keras (which takes
+        batches from the generator ahead of training on them), None to use the number of batches the generator
+        handed out
+        :return: dictionary holding the epoch and cursor (index of the batch within the epoch) of the next batch and
+        the seed
+        """
+        if num_batches is None:
+            (epoch, cursor) = self._position
+        else:
+            (epoch, cursor) = divmod(int(num_batches), self._batches_per_epoch())
+
+        return {"epoch": int(epoch), "cursor": int(cursor), "seed": int(self._seed)}
+
+    def load_state_dict(self, state):
+        """
+        Restore a state returned by state_dict(), the next call to generator() starts at its position
+        :param state: dictionary holding the epoch, cursor and seed
+        """
+        if not 0 <= state["cursor"] < self._batches_per_epoch():
+            raise ValueError("The cursor does not point to a batch of the epoch", state["cursor"],
+                             self._batches_per_epoch())
+
+        self._seed = int(state["seed"])
+        self._position = (int(state["epoch"]), int(state["cursor"]))
+        self._pending = deque()
+        self._state_loaded()
+
+    def _state_loaded(self):
+        """Update anything derived from the state after a state was loaded"""
+        pass
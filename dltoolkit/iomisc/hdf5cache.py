@@ -0,0 +1,182 @@
+"""Process-wide cache of open, read-only HDF5 files and their data sets. Opening a file, parsing its metadata and
+warming up its chunk cache is only done once per process, no matter how many readers and generators use the file.
+
+Files are reference counted: acquire() a file (or acquire_dataset() one of its data sets, which are opened once per
+file) before using it and release() it when done. Unused files stay open
+until the cache holds more than max_files files, at which point the least recently used unused files are closed.
+Files that are written to must be invalidated first (HDF5Writer does this for its output path). After a fork the
+child process starts with an empty cache, the parent's handles are never used or closed by the child.
+"""
+from contextlib import contextmanager
+from collections import OrderedDict
+import threading
+import h5py
+import os
+
+# Constants
+MAX_OPEN_FILES = 16
+
+
+class HDF5HandleCache:
+    def __init__(self, max_files=MAX_OPEN_FILES):
+        """
+        Initialise the cache
+        :param max_files: maximum number of files to keep open when they are not in use
+        """
+        self.max_files = max_files
+        self._lock = threading.RLock()
+        self._reset()
+
+        # Drop handles inherited from the parent process
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Forget all handles without closing them, used after a fork"""
+        self._pid = os.getpid()
+        self._entries = OrderedDict()       # path -> {"file", "refs", "datasets", "stale"}
+        self._stale_entries = []            # invalidated entries that are still in use
+
+    def _check_pid(self):
+        """Reset the cache when it is used in a forked process on a platform without fork handlers"""
+        if os.getpid() != self._pid:
+            self._reset()
+
+    @staticmethod
+    def _key(path):
+        return os.path.realpath(path)
+
+    def acquire(self, path, rdcc_nbytes=None):
+        """
+        Open a file or return the file already opened by the cache, each call must be paired with a call to release()
+        :param path: full path to the HDF5 file
+        :param rdcc_nbytes: chunk cache size in bytes, only used when the file is opened
+        :return: h5py.File opened in read-only mode
+        """
+        key = self._key(path)
+
+        with self._lock:
+            self._check_pid()
+            entry = self._entries.get(key)
+
+            if entry is None:
+                entry = {"file": h5py.File(path, "r", rdcc_nbytes=rdcc_nbytes), "refs": 0, "datasets": {},
+                         "stale": False}
+                self._entries[key] = entry
+
+            entry["refs"] += 1
+            self._entries.move_to_end(key)
+            self._evict()
+
+            return entry["file"]
+
+    def acquire_dataset(self, path, key, rdcc_nbytes=None):
+        """
+        Return a data set of a cached file, each call must be paired with a call to release(path, dataset)
+        :param path: full path to the HDF5 file
+        :param key: name of the data set
+        :param rdcc_nbytes: chunk cache size in bytes, only used when the file is opened
+        :return: h5py.Dataset
+        """
+        with self._lock:
+            f = self.acquire(path, rdcc_nbytes)
+            datasets = self._entries[self._key(path)]["datasets"]
+
+            if key not in datasets:
+                datasets[key] = f[key]
+
+            return datasets[key]
+
+    def release(self, path, file=None):
+        """
+        Release a file acquired earlier
+        :param path: full path to the HDF5 file
+        :param file: the h5py.File returned by acquire() or the h5py.Dataset returned by acquire_dataset(), needed to
+        release a file that was invalidated while it was in use. None to release the current handle of the path
+        """
+        key = self._key(path)
+
+        with self._lock:
+            if os.getpid() != self._pid:
+                return
+
+            entry = self._entries.get(key)
+
+            if entry is None or (file is not None and not self._owns(entry, file)):
+                # The handle was invalidated while in use, close it once it is no longer used
+                entry = next((e for e in self._stale_entries if self._owns(e, file)), None)
+                if entry is None:
+                    return
+
+            entry["refs"] -= 1
+
+            if entry["stale"] and entry["refs"] <= 0:
+                self._close(entry)
+            else:
+                self._evict()
+
+    @staticmethod
+    def _owns(entry, handle):
+        """Return True if a file or data set handle belongs to an entry"""
+        return entry["file"] is handle or any(d is handle for d in entry["datasets"].values())
+
+    @contextmanager
+    def open(self, path, rdcc_nbytes=None):
+        """Context manager acquiring a file and releasing it at the end of the block"""
+        f = self.acquire(path, rdcc_nbytes)
+
+        try:
+            yield f
+        finally:
+            self.release(path, f)
+
+    def invalidate(self, path=None):
+        """
+        Close a cached file (e.g. before it is overwritten) or all cached files. Files still in use are closed when
+        they are released, later calls to acquire() open the file again
+        :param path: full path to the HDF5 file, None to invalidate all files
+        """
+        with self._lock:
+            self._check_pid()
+            keys = [self._key(path)] if path is not None else list(self._entries.keys())
+
+            for key in keys:
+                entry = self._entries.pop(key, None)
+
+                if entry is None:
+                    continue
+
+                entry["stale"] = True
+
+                if entry["refs"] <= 0:
+                    self._close(entry)
+                else:
+                    self._stale_entries.append(entry)
+
+    def _evict(self):
+        """Close the least recently used files that are not in use until at most max_files files are open"""
+        unused = [k for (k, e) in self._entries.items() if e["refs"] <= 0]
+
+        while len(self._entries) > self.max_files and len(unused) > 0:
+            self._close(self._entries.pop(unused.pop(0)))
+
+    def _close(self, entry):
+        """Close the file of an entry"""
+        self._stale_entries = [e for e in self._stale_entries if e is not entry]
+
+        entry["datasets"] = {}
+        entry["file"].close()
+
+
+# Cache shared by all readers and generators in this process
+_handle_cache = None
+
+
+def get_handle_cache():
+    """Return the process-wide HDF5HandleCache, creating it the first time"""
+    global _handle_cache
+
+    if _handle_cache is None:
+        _handle_cache = HDF5HandleCache()
+
+    return _handle_cache
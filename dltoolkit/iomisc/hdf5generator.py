@@ -1,78 +1,481 @@
 """Image generator using a HDF5 data set as the source. Comes in two versions:
 
 - HDF5Generator for classification, regressions data sets that have an image or other features as input and a label or
-  value as output.
-- HDF5Generator_Segment for segmentation data sets that have an image as input as well as output.
+  value as output. Images stored in encoded form (see HDF5Writer's encode_ext) are decoded on the fly by a pool of
+  threads. Preprocessing is applied to whole batches when all preprocessors support it and can be spread across a
+  pool of processes (see parallelpreprocessor.py).
+- HDF5Generator_Segment for segmentation data sets that have an image as input as well as output. Images and masks can
+  be stored in separate files or together in one file (see HDF5Writer's label_shape).
+- HDF5ShardedGenerator, a version of HDF5Generator reading a sharded data set (see HDF5ShardedWriter), optionally
+  limited to the shards assigned to one worker.
+
+All generators read the records sequentially by default. With shuffle=True the order of chunk-sized blocks of records
+is shuffled every epoch and the records are shuffled within pools of blocks (see sampling.py), which keeps reads
+close to sequential speed. With world_size > 1 each rank (e.g. one process per node) only reads its own segment of
+every epoch's order. With prefetch > 0 batches are prepared ahead by background threads or processes (see
+prefetch.py), which stop when the generator is closed or garbage collected, or when close() is called.
+
+With cache="ram" or cache="shared" the data sets are loaded into memory once and shared with the other generators and
+worker processes using them (see hdf5memcache.py). Data sets that do not fit in the memory budget are read from disc.
+
+The generators' state (the position of the next batch and the seed) can be saved with state_dict() and restored with
+load_state_dict() to resume an interrupted run exactly, see generatorstate.py.
+
+With batch_buffers > 0 HDF5Generator assembles batches in a pool of preallocated arrays (see batchbuffers.py) instead
+of allocating new arrays for every batch. Features are read straight into these arrays and scalar labels are loaded
+into memory once, then copied or one-hot encoded into them. A batch stays valid until batch_buffers more batches were
+assembled, so the pool must cover the batches queued by the consumer as well (e.g. Keras' max_queue_size).
 
 Code is based on the excellent book "Deep Learning for Computer Vision" by PyImageSearch available on:
 https://www.pyimagesearch.com/deep-learning-computer-vision-python-book/
 """
+from .hdf5sharded import HDF5ShardedReader
+from .imagecodec import decode_image, ATTR_ENCODING, ATTR_RECORD_SHAPE
+from .hdf5cache import get_handle_cache
+from .hdf5memcache import get_memory_cache, CACHE_MODES
+from .sampling import BlockReader, epoch_order, chunk_records, pool_records, POOL_BYTES
+from .sampling import num_batches, batch_indices, PARTIAL_BATCH_MODES
+from .sampling import check_shard, shard_order, shard_size, batch_seed
+from .batchbuffers import BatchBufferPool
+from .generatorstate import ResumableGenerator
+from .prefetch import PrefetchingGenerator
+from .parallelpreprocessor import ParallelPreprocessor, apply_preprocessors, record_rngs
 from keras.utils import to_categorical
 from keras.preprocessing.image import ImageDataGenerator
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import numpy as np
-import h5py
+import threading
+
+# ImageDataGenerator draws its random transformations from the global NumPy random state, so batches prepared by
+# different threads are augmented one at a time. Otherwise an image and its mask could get different transformations
+_augment_lock = threading.Lock()
+
+
+class _CachedDatasets:
+    """Base class of the generators, holds the data sets loaded into memory through the memory cache"""
+    def _init_cache(self, cache, cache_budget, cache_keys):
+        """Initialise the cache settings, see HDF5Generator"""
+        if cache is not None and cache not in CACHE_MODES:
+            raise ValueError("Invalid cache mode", cache, CACHE_MODES)
+
+        self._cache = cache
+        self._cache_budget = cache_budget
+        self._cache_keys = cache_keys
+        self._cached = {}                   # (path, key) -> NumPy array, None if the data set is read from disc
+
+    def _cached_dataset(self, path, db, key):
+        """Return a data set, held in memory if it is cached and fits in the remaining memory budget"""
+        if self._cache is None or (self._cache_keys is not None and key not in self._cache_keys):
+            return db[key]
+
+        if (path, key) not in self._cached:
+            budget = None
+
+            if self._cache_budget is not None:
+                budget = self._cache_budget - sum(a.nbytes for a in self._cached.values() if a is not None)
+
+            # Data sets that do not fit in the memory budget are read from disc
+            self._cached[(path, key)] = get_memory_cache().acquire(path, key, self._cache, budget)
 
+        array = self._cached[(path, key)]
 
-class HDF5Generator:
+        return array if array is not None else db[key]
+
+    def _release_cache(self):
+        """Release the data sets held in memory"""
+        for array in self._cached.values():
+            if array is not None:
+                get_memory_cache().release(array)
+
+        self._cached = {}
+
+
+class HDF5Generator(_CachedDatasets, PrefetchingGenerator, ResumableGenerator):
     def __init__(self, dbpath, batch_size, preprocessors=None, augment=None, onehot=False,
-                 num_classes=2, label_key="Y"):
+                 num_classes=2, label_key="Y", rdcc_nbytes=None, decode_workers=None, shuffle=False, seed=None,
+                 pool_bytes=POOL_BYTES, block_size=None, prefetch=0, prefetch_workers=1, prefetch_processes=False,
+                 preprocess_workers=0, batch_buffers=0, partial_batch="keep", cache=None, cache_budget=None,
+                 cache_keys=None, rank=0, world_size=1, max_queue_size=10):
+        """
+        Initialise the generator
+        :param dbpath: full path to the HDF5 file
+        :param batch_size: batch size
+        :param preprocessors: list of preprocessors applied to each image, whole batches are preprocessed at once when
+        all preprocessors have a preprocess_batch method
+        :param augment: ImageDataGenerator used to augment each batch, None for no augmentation
+        :param onehot: True to one-hot encode the labels
+        :param num_classes: number of classes used for one-hot encoding
+        :param label_key: name of the labels data set
+        :param rdcc_nbytes: chunk cache size in bytes, None to use the HDF5 default
+        :param decode_workers: number of threads decoding encoded images, None for the default
+        :param shuffle: True to shuffle the records every epoch (chunk-sized blocks, then records within pools)
+        :param seed: seed of the shuffled order, each epoch uses a different order derived from the seed and the
+        epoch number. None for a different order every run
+        :param pool_bytes: memory budget of the records shuffled together, the number of records per pool is derived
+        from the size of a feature and label record (see sampling.pool_records)
+        :param block_size: number of consecutive records read at a time, None to use the chunk size of the data set
+        :param prefetch: number of batches prepared ahead in the background, 0 to prepare batches when they are
+        requested
+        :param prefetch_workers: number of threads or processes preparing batches
+        :param prefetch_processes: True to prepare batches in forked worker processes, False to use threads
+        :param preprocess_workers: number of processes the images of each batch are preprocessed by, 0 to preprocess
+        them in the process preparing the batch. Cannot be combined with prefetch_processes
+        :param batch_buffers: number of preallocated batches reused in turn, 0 to allocate new arrays for every batch.
+        A batch is overwritten batch_buffers batches later, so batch_buffers must be at least the number of batches
+        that are alive at the same time, i.e. prefetch + max_queue_size + 2. Augmented batches are always new arrays
+        :param partial_batch: "keep" to generate a smaller final batch when the number of records is not a multiple of
+        the batch size, "drop" to skip it, "pad" to fill it with records from the start of the epoch
+        :param cache: None to read the data sets from disc, "ram" to load them into memory once or "shared" to load
+        them into shared memory other processes can attach to
+        :param cache_budget: maximum number of bytes the cached data sets may use, None to use a fraction of the
+        available memory. Data sets that do not fit are read from disc
+        :param cache_keys: names of the data sets to cache, None to cache all data sets that are read
+        :param rank: index of this process when the data set is shared by world_size processes
+        :param world_size: number of processes each reading a disjoint segment of every epoch, the final segment is
+        padded with records from the start of the epoch. All processes must use the same seed when shuffling
+        :param max_queue_size: number of batches the consumer queues before using them, e.g. fit_generator's
+        max_queue_size (10 by default) plus its number of workers for Sequences. Only used with batch_buffers
+        """
+        if 0 < batch_buffers < prefetch + max_queue_size + 2:
+            raise ValueError("batch_buffers must be at least prefetch + max_queue_size + 2", batch_buffers, prefetch,
+                             max_queue_size)
+
+        if partial_batch not in PARTIAL_BATCH_MODES:
+            raise ValueError("Invalid partial batch mode", partial_batch, PARTIAL_BATCH_MODES)
+
+        # Daemonic prefetch processes cannot start a pool of their own
+        if preprocess_workers > 0 and prefetch_processes:
+            raise ValueError("preprocess_workers cannot be used with prefetch_processes", preprocess_workers,
+                             prefetch_processes)
+
+        check_shard(rank, world_size, shuffle, seed)
+
         self._batch_size = batch_size
         self._preprocessors = preprocessors
         self._augment = augment
         self._onehot = onehot
         self._num_classes = num_classes
 
-        # Open the database
-        self._db = h5py.File(dbpath, "r")
+        # Threads decoding encoded images (if any), created when the first batch is decoded
+        self._decode_workers = decode_workers
+        self._decode_pool = None
+
+        # Processes preprocessing images, started when the first batch is preprocessed. Created here so prefetch
+        # threads share a single pool
+        self._preprocess_workers = preprocess_workers
+        self._preprocess_pool = None
+
+        if preprocess_workers > 0:
+            self._preprocess_pool = ParallelPreprocessor(preprocessors, preprocess_workers)
+
+        # Shuffling, data sets are read through block readers created when they are first read
+        self._shuffle = shuffle
+        self._init_state(seed)
+        self._pool_bytes = pool_bytes
+        self._pool_size = None              # records per pool, determined when the first data set is read
+        self._pool_label_key = label_key
+        self._block_size = block_size
+        self._rank = rank
+        self._world_size = world_size
+        self._readers = {}
+        self._read_lock = threading.Lock()
+
+        # Background batch preparation
+        self._init_prefetch(prefetch, prefetch_workers, prefetch_processes)
+
+        # Preallocated batches, labels held in memory and the shape and dtype of a preprocessed image
+        self._batch_buffers = batch_buffers
+        self._buffers = BatchBufferPool(batch_buffers, batch_size) if batch_buffers > 0 else None
+        self._labels = {}
+        self._preprocessed_record = None
+        self._partial_batch = partial_batch
+
+        # Data sets held in memory
+        self._init_cache(cache, cache_budget, cache_keys)
+
+        # Open the database, optionally with a chunk cache large enough to hold a few batches of a chunked data set
+        self._dbpath = dbpath
+        self._rdcc_nbytes = rdcc_nbytes
+        self._db = self._open_db(dbpath, rdcc_nbytes)
         self._num_images = self._db[label_key].shape[0]
 
-    def generator(self, num_epochs=np.inf, feat_key="X", label_key="Y"):
-        """Generate batches of data"""
-        epochs = 0
+    def _open_db(self, dbpath, rdcc_nbytes):
+        """Open the database for reading, the file handle is shared with other readers through the handle cache"""
+        return get_handle_cache().acquire(dbpath, rdcc_nbytes=rdcc_nbytes)
+
+    def _close_db(self):
+        """Release the database"""
+        get_handle_cache().release(self._dbpath, self._db)
+
+    def _reopen(self):
+        """Open the database again in a forked worker process, handles of the parent process are not used"""
+        self._db = self._open_db(self._dbpath, self._rdcc_nbytes)
+        self._readers = {}
+        self._read_lock = threading.Lock()
+        self._decode_pool = None
+
+        if self._buffers is not None:
+            self._buffers = BatchBufferPool(self._batch_buffers, self._batch_size)
+
+    def _decode(self, X, num_channels):
+        """Decode a batch of encoded images in parallel, OpenCV releases the GIL while decoding"""
+        if self._decode_pool is None:
+            self._decode_pool = ThreadPoolExecutor(max_workers=self._decode_workers)
+
+        return list(self._decode_pool.map(partial(decode_image, num_channels=num_channels), X))
+
+    def _reader(self, key, feat_key):
+        """Return the block reader of a data set, blocks hold one chunk of the features data set by default"""
+        if key not in self._readers:
+            if self._block_size is None:
+                self._block_size = chunk_records(self._db[feat_key], self._batch_size)
+
+            if self._pool_size is None:
+                datasets = [self._db[k] for k in [feat_key, self._pool_label_key] if k is not None and k in self._db]
+                self._pool_size = pool_records(self._pool_bytes, datasets)
+
+            self._readers[key] = BlockReader(self._cached_dataset(self._dbpath, self._db, key), self._block_size,
+                                             self._pool_size, self._batch_size)
+
+        return self._readers[key]
+
+    def _epoch_order(self, epoch, feat_key):
+        """Return the indices of the records in the order they are read during an epoch"""
+        order = epoch_order(self._num_images, epoch, self._shuffle, self._reader(feat_key, feat_key).block_size,
+                            self._pool_size, self._seed)
+
+        return shard_order(order, self._rank, self._world_size)
+
+    def _num_channels(self, feat_key):
+        """Return the number of channels of encoded images, None if the images are not encoded"""
+        # Sharded data sets have no attributes
+        attrs = getattr(self._db[feat_key], "attrs", {})
+
+        return attrs[ATTR_RECORD_SHAPE][-1] if ATTR_ENCODING in attrs else None
+
+    def _preprocess(self, X, out=None, seed=None):
+        """Apply the preprocessors to a batch of images, optionally writing the results to out. Random preprocessors
+        draw from a random state per image derived from seed"""
+        if self._preprocess_pool is not None:
+            return self._preprocess_pool.preprocess_batch(X, out, seed)
+
+        return apply_preprocessors(self._preprocessors, X, out, record_rngs(seed, 0, len(X)))
+
+    def _load_batch(self, indices, feat_key, label_key, num_channels, seed=None):
+        """Read, decode, encode, preprocess and augment the records of a single batch, random preprocessors and
+        augmentation are seeded with seed"""
+        if self._buffers is not None:
+            return self._load_batch_buffered(indices, feat_key, label_key, num_channels, seed)
+
+        with self._read_lock:
+            X = self._reader(feat_key, feat_key).read(indices)
+            Y = self._reader(label_key, feat_key).read(indices)
+
+        # Decode encoded images, they are only combined into a single array after preprocessing as they may
+        # differ in size
+        if num_channels is not None:
+            X = self._decode(X, num_channels)
+
+            if self._preprocessors is None:
+                X = np.array(X)
 
-        while epochs < num_epochs:
-            for i in np.arange(0, self._num_images, self._batch_size):
-                # Get the current batch
-                X = self._db[feat_key][i:i + self._batch_size]
-                Y = self._db[label_key][i:i + self._batch_size]
+        # One-hot encode
+        if self._onehot:
+            Y = to_categorical(Y, self._num_classes)
 
-                # One-hot encode
-                if self._onehot:
-                    Y = to_categorical(Y, self._num_classes)
+        # Apply preprocessors
+        if self._preprocessors is not None:
+            X = self._preprocess(X, seed=seed)
 
-                # Apply preprocessors
-                if self._preprocessors is not None:
-                    processed_images = []
+        # Apply augmentation
+        if self._augment is not None:
+            with _augment_lock:
+                (X, Y) = next(self._augment.flow(X, Y, batch_size=self._batch_size, seed=seed))
 
-                    for image in X:
-                        for p in self._preprocessors:
-                            image = p.preprocess(image)
+        return X, Y
 
-                        processed_images.append(image)
+    def _load_batch_buffered(self, indices, feat_key, label_key, num_channels, seed=None):
+        """Assemble a batch in the arrays of the next slot of the batch buffer pool"""
+        slot = self._buffers.next_slot()
+        num_records = len(indices)
 
-                    X = np.array(processed_images)
+        with self._read_lock:
+            reader = self._reader(feat_key, feat_key)
+            label_reader = self._reader(label_key, feat_key)
 
-                # Apply augmentation
-                if self._augment is not None:
-                    (X, Y) = next(self._augment.flow(X, Y, batch_size=self._batch_size))
+            # Read the features straight into the slot's raw features array, encoded images are decoded below
+            if num_channels is None:
+                X = reader.read(indices, self._buffers.get("raw", slot, reader.dataset.shape[1:],
+                                                           reader.dataset.dtype)[:num_records])
+            else:
+                X = reader.read(indices)
 
-                # Return
-                yield (X, Y)
+            # Scalar labels are loaded into memory once, other labels are read like the features
+            if label_key not in self._labels and len(label_reader.dataset.shape) == 1:
+                self._labels[label_key] = label_reader.dataset[:]
 
-            epochs +=1
+            labels = self._labels.get(label_key)
+
+            if labels is None:
+                Y = label_reader.read(indices, self._buffers.get("Y", slot, label_reader.dataset.shape[1:],
+                                                                 label_reader.dataset.dtype)[:num_records])
+
+        # One-hot encode or copy the labels into the slot's labels array
+        if labels is None:
+            Y = to_categorical(Y, self._num_classes) if self._onehot else Y
+        elif self._onehot:
+            Y = self._buffers.get("Y", slot, (self._num_classes,), "float32")[:num_records]
+            Y.fill(0)
+            Y[np.arange(num_records), labels[indices].astype(int)] = 1
+        else:
+            Y = np.take(labels, indices, axis=0, out=self._buffers.get("Y", slot, labels.shape[1:],
+                                                                       labels.dtype)[:num_records], mode="clip")
+
+        if num_channels is not None:
+            X = self._decode(X, num_channels)
+
+        # Apply preprocessors, the shape of a preprocessed image is only known after the first batch
+        if self._preprocessors is not None and self._preprocessed_record is None:
+            X = self._preprocess(X, seed=seed)
+            self._preprocessed_record = (X.shape[1:], X.dtype)
+        elif self._preprocessors is not None:
+            X = self._preprocess(X, self._buffers.get("X", slot, *self._preprocessed_record)[:num_records], seed)
+        elif num_channels is not None:
+            X = np.stack(X, out=self._buffers.get("X", slot, X[0].shape, X[0].dtype)[:num_records])
+
+        # Apply augmentation
+        if self._augment is not None:
+            with _augment_lock:
+                (X, Y) = next(self._augment.flow(X, Y, batch_size=self._batch_size, seed=seed))
+
+        return X, Y
+
+    def _batches_per_epoch(self):
+        """Return the number of batches per epoch"""
+        return num_batches(shard_size(self._num_images, self._world_size), self._batch_size, self._partial_batch)
+
+    def _batches(self, num_epochs, feat_key, label_key):
+        """Generate the _load_batch arguments of every batch, starting at the current position"""
+        order_epoch = None
+
+        # Determine whether images are stored encoded
+        num_channels = self._num_channels(feat_key)
+
+        # Load cached data sets before any worker processes are started
+        self._reader(label_key, feat_key)
+
+        for (epoch, index) in self._positions(num_epochs):
+            if epoch != order_epoch:
+                (order_epoch, order) = (epoch, self._epoch_order(epoch, feat_key))
+
+            yield (batch_indices(order, index, self._batch_size, self._partial_batch), feat_key, label_key,
+                   num_channels, batch_seed(self._seed, epoch, index))
+
+    def generator(self, num_epochs=np.inf, feat_key="X", label_key="Y"):
+        """Generate batches of data until epoch num_epochs (counted from epoch 0, also after resuming) is reached"""
+        return self._generate(self._batches(num_epochs, feat_key, label_key))
 
     def close(self):
+        # Stop background batch preparation before the database is closed
+        self._stop_prefetch()
+
+        self._close_db()
+        self._release_cache()
+
+        if self._decode_pool is not None:
+            self._decode_pool.shutdown()
+            self._decode_pool = None
+
+        # The workers are started again if the generator is used after closing it
+        if self._preprocess_pool is not None:
+            self._preprocess_pool.close()
+
+
+class HDF5ShardedGenerator(HDF5Generator):
+    """Generator reading a sharded data set, each worker only reads the (whole) shards assigned to it"""
+    def __init__(self, manifest_path, batch_size, worker=0, num_workers=1, **kwargs):
+        """
+        Initialise the generator, see HDF5Generator for the other arguments
+        :param manifest_path: full path to the manifest of the sharded data set
+        :param batch_size: batch size
+        :param worker: index of this worker (0 <= worker < num_workers)
+        :param num_workers: total number of workers, shards are assigned to workers round-robin
+        """
+        if kwargs.get("cache") is not None:
+            raise ValueError("Sharded data sets cannot be cached", kwargs["cache"])
+
+        self._worker = worker
+        self._num_workers = num_workers
+
+        super(HDF5ShardedGenerator, self).__init__(manifest_path, batch_size, **kwargs)
+
+    def _open_db(self, dbpath, rdcc_nbytes):
+        """Open the shards assigned to this worker"""
+        return HDF5ShardedReader(dbpath, worker=self._worker, num_workers=self._num_workers, rdcc_nbytes=rdcc_nbytes)
+
+    def _close_db(self):
+        """Release the shards"""
         self._db.close()
 
 
-class HDF5Generator_Segment:
+class HDF5Generator_Segment(_CachedDatasets, PrefetchingGenerator, ResumableGenerator):
     """Generator specifically for semantic segmentation data, i.e. images and ground truth images"""
-    def __init__(self, image_db_path, mask_db_path, batch_size, num_classes, converter=None, data_gen_args=None, feat_key="X"):
+    def __init__(self, image_db_path, mask_db_path, batch_size, num_classes, converter=None, data_gen_args=None, feat_key="X",
+                 rdcc_nbytes=None, mask_key=None, shuffle=False, seed=None, pool_bytes=POOL_BYTES, block_size=None,
+                 prefetch=0, prefetch_workers=1, prefetch_processes=False, partial_batch="keep", cache=None,
+                 cache_budget=None, cache_keys=None, rank=0, world_size=1):
+        """
+        Initialise the generator
+        :param image_db_path: full path to the HDF5 file holding the images
+        :param mask_db_path: full path to the HDF5 file holding the masks, None if the masks are stored in the same
+        file as the images
+        :param batch_size: batch size
+        :param num_classes: number of classes, passed to the converter
+        :param converter: function converting a batch of masks to the format produced by the model
+        :param data_gen_args: ImageDataGenerator arguments used to augment images and masks, None for no augmentation
+        :param feat_key: name of the images data set
+        :param rdcc_nbytes: chunk cache size in bytes, None to use the HDF5 default
+        :param mask_key: name of the masks data set, None to use feat_key for a separate masks file or "Y" when the
+        masks are stored in the images file
+        :param shuffle: True to shuffle the records every epoch, see HDF5Generator
+        :param seed: seed of the shuffled order, None for a different order every run
+        :param pool_bytes: memory budget of the images and masks shuffled together, see HDF5Generator
+        :param block_size: number of consecutive records read at a time, None to use the chunk size of the images
+        :param prefetch: number of batches prepared ahead in the background, 0 to prepare batches when they are
+        requested
+        :param prefetch_workers: number of threads or processes preparing batches
+        :param prefetch_processes: True to prepare batches in forked worker processes, False to use threads
+        :param partial_batch: "keep", "drop" or "pad" the final batch of an epoch, see HDF5Generator
+        :param cache: None, "ram" or "shared", see HDF5Generator
+        :param cache_budget: maximum number of bytes the cached images and masks may use, see HDF5Generator
+        :param cache_keys: names of the data sets to cache, None to cache both the images and the masks
+        :param rank: index of this process when the data set is shared by world_size processes
+        :param world_size: number of processes each reading a disjoint segment of every epoch, see HDF5Generator
+        """
+        if partial_batch not in PARTIAL_BATCH_MODES:
+            raise ValueError("Invalid partial batch mode", partial_batch, PARTIAL_BATCH_MODES)
+
+        check_shard(rank, world_size, shuffle, seed)
+
         self._batch_size = batch_size
+        self._partial_batch = partial_batch
+        self._init_cache(cache, cache_budget, cache_keys)
+        self._shuffle = shuffle
+        self._init_state(seed)
+        self._pool_bytes = pool_bytes
+        self._rank = rank
+        self._world_size = world_size
 
-        # Open the database
-        self._db_image = h5py.File(image_db_path, "r")
-        self._db_mask = h5py.File(mask_db_path, "r")
+        # Background batch preparation
+        self._init_prefetch(prefetch, prefetch_workers, prefetch_processes)
+
+        # Open the database, images and masks share a single file handle when they are stored in the same file
+        self._image_db_path = image_db_path
+        self._mask_db_path = mask_db_path
+        self._rdcc_nbytes = rdcc_nbytes
+        self._mask_key = mask_key if mask_key is not None else ("Y" if mask_db_path is None else feat_key)
+        self._open_dbs()
 
         # Create data generators if parameters were provided
         self.data_gen_args = data_gen_args
@@ -89,40 +492,101 @@ class HDF5Generator_Segment:
         self._converter = converter
         self.img_shape = self._db_image[feat_key].shape
 
+        if self._db_mask[self._mask_key].shape[0] != self._num_images:
+            raise ValueError("The number of images and masks differs", self._num_images,
+                             self._db_mask[self._mask_key].shape[0])
+
+        # Images and masks are read block by block using the same block size
+        self._block_size = block_size if block_size is not None else chunk_records(self._db_image[feat_key],
+                                                                                   batch_size)
+        self._pool_size = pool_records(pool_bytes, [self._db_image[feat_key], self._db_mask[self._mask_key]])
+        self._create_readers()
+
+    def _open_dbs(self):
+        """Open the image and mask databases"""
+        self._db_image = get_handle_cache().acquire(self._image_db_path, rdcc_nbytes=self._rdcc_nbytes)
+
+        if self._mask_db_path is None:
+            self._db_mask = self._db_image
+        else:
+            self._db_mask = get_handle_cache().acquire(self._mask_db_path, rdcc_nbytes=self._rdcc_nbytes)
+
+        self._read_lock = threading.Lock()
+
+    def _create_readers(self):
+        """Create the block readers of the images and masks"""
+        mask_db_path = self._mask_db_path if self._mask_db_path is not None else self._image_db_path
+
+        self._image_reader = BlockReader(self._cached_dataset(self._image_db_path, self._db_image, self._feat_key),
+                                         self._block_size, self._pool_size, self._batch_size)
+        self._mask_reader = BlockReader(self._cached_dataset(mask_db_path, self._db_mask, self._mask_key),
+                                        self._block_size, self._pool_size, self._batch_size)
+
+    def _reopen(self):
+        """Open the databases again in a forked worker process, handles of the parent process are not used"""
+        self._open_dbs()
+        self._create_readers()
+
     def num_images(self):
         return self._num_images
 
-    def generator(self, num_epochs=np.inf, dim_reorder=None):
-        """Generate batches of data"""
-        epochs = 0
-        RANDOM_STATE = 42
+    def _epoch_order(self, epoch):
+        """Return the indices of the records in the order they are read during an epoch"""
+        order = epoch_order(self._num_images, epoch, self._shuffle, self._image_reader.block_size, self._pool_size,
+                            self._seed)
+
+        return shard_order(order, self._rank, self._world_size)
 
-        while epochs < num_epochs:
-            for i in np.arange(0, self._num_images, self._batch_size):
-                # Get the current batch
-                imgs = self._db_image[self._feat_key][i:i + self._batch_size]
-                masks = self._db_mask[self._feat_key][i:i + self._batch_size]
+    def _load_batch(self, indices, seed, dim_reorder):
+        """Read, augment and convert the images and masks of a single batch, the augmentation is seeded with seed"""
+        # Get the current batch
+        with self._read_lock:
+            imgs = self._image_reader.read(indices)
+            masks = self._mask_reader.read(indices)
 
-                # Apply augmentation
-                if not self.image_datagen is None:
-                    seed = RANDOM_STATE*epochs
+        # Apply augmentation
+        if not self.image_datagen is None:
+            with _augment_lock:
+                imgs = next(self.image_datagen.flow(imgs, batch_size=self._batch_size, shuffle=True, seed=seed))
+                masks = next(self.mask_datagen.flow(masks, batch_size=self._batch_size, shuffle=True, seed=seed))
 
-                    imgs = next(self.image_datagen.flow(imgs, batch_size=self._batch_size, shuffle=True, seed=seed))
-                    masks = next(self.mask_datagen.flow(masks, batch_size=self._batch_size, shuffle=True, seed=seed))
+        # Convert masks to the format produced by the segmentation model
+        if not self._converter is None:
+            masks = self._converter(masks, self._num_classes)
 
-                # Convert masks to the format produced by the segmentation model
-                if not self._converter is None:
-                    masks = self._converter(masks, self._num_classes)
+        if dim_reorder is not None:
+            # Reorder the dimensions if required
+            imgs = np.transpose(imgs, axes=dim_reorder)
+            masks = np.transpose(masks, axes=dim_reorder)
 
-                if dim_reorder is not None:
-                    # Reorder the dimensions if required
-                    imgs = np.transpose(imgs, axes=dim_reorder)
-                    masks = np.transpose(masks, axes=dim_reorder)
+        return imgs, masks
 
-                # Return
-                yield (imgs, masks)
+    def _batches_per_epoch(self):
+        """Return the number of batches per epoch"""
+        return num_batches(shard_size(self._num_images, self._world_size), self._batch_size, self._partial_batch)
 
-            epochs +=1
+    def _batches(self, num_epochs, dim_reorder):
+        """Generate the _load_batch arguments of every batch, starting at the current position"""
+        order_epoch = None
+
+        for (epoch, index) in self._positions(num_epochs):
+            if epoch != order_epoch:
+                (order_epoch, order) = (epoch, self._epoch_order(epoch))
+
+            yield (batch_indices(order, index, self._batch_size, self._partial_batch),
+                   batch_seed(self._seed, epoch, index), dim_reorder)
+
+    def generator(self, num_epochs=np.inf, dim_reorder=None):
+        """Generate batches of data until epoch num_epochs (counted from epoch 0, also after resuming) is reached"""
+        return self._generate(self._batches(num_epochs, dim_reorder))
 
     def close(self):
-        self._db.close()
+        # Stop background batch preparation before the databases are closed
+        self._stop_prefetch()
+
+        get_handle_cache().release(self._image_db_path, self._db_image)
+
+        if self._mask_db_path is not None:
+            get_handle_cache().release(self._mask_db_path, self._db_mask)
+
+        self._release_cache()
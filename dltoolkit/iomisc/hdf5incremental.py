@@ -0,0 +1,116 @@
+"""Create a HDF5 data set or incrementally update an existing one. The HDF5 file stores the path and fingerprint of
+the source of each record (see HDF5Writer's track_sources). Only sources that were added or changed since the file was
+created are loaded again. Records of unchanged sources are copied from the existing file and records of sources that
+no longer exist are dropped.
+"""
+from .hdf5writer import HDF5Writer, DS_CLASS_NAMES
+from .fingerprint import file_fingerprint, DS_SOURCES, DS_FINGERPRINTS
+from .imagecodec import ATTR_ENCODING, ATTR_RECORD_SHAPE
+from .hdf5cache import get_handle_cache
+import numpy as np
+import h5py, os
+
+
+def _to_str(value):
+    """Strings are returned as bytes by h5py 3 and as str by earlier versions"""
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def load_sources(db_path, hash_sources=False):
+    """
+    Load the source paths and fingerprints stored in a HDF5 file
+    :param db_path: full path to the HDF5 file
+    :param hash_sources: True if fingerprints should be based on the contents of the sources
+    :return: dictionary mapping each source path to (record index, fingerprint), empty if the file does not exist,
+    has no sources or used a different type of fingerprint
+    """
+    if not os.path.exists(db_path):
+        return {}
+
+    with h5py.File(db_path, "r") as db:
+        if DS_SOURCES not in db or bool(db[DS_SOURCES].attrs.get("hash_sources", False)) != hash_sources:
+            return {}
+
+        sources = [_to_str(s) for s in db[DS_SOURCES][()]]
+        fingerprints = [_to_str(f) for f in db[DS_FINGERPRINTS][()]]
+
+    return {src: (row, fp) for (row, (src, fp)) in enumerate(zip(sources, fingerprints))}
+
+
+def update_hdf5(output_path, sources, loader, record_shape, labels=None, feat_key="X", label_key="Y",
+                hash_sources=False, pbar=None, **writer_args):
+    """
+    Create a HDF5 data set from a list of sources or update an existing one, only loading sources that were added or
+    changed since the file was last written
+    :param output_path: full path to the HDF5 file
+    :param sources: list of source paths (files or folders), one per record, in the order they should be stored
+    :param loader: object with an imap(sources) method returning the loaded records in order, e.g. a ParallelLoader.
+    Sources returning None are skipped
+    :param record_shape: shape of each record, e.g. (height, width, # of channels)
+    :param labels: list of labels, one per source, required when label_key is not None
+    :param feat_key: name of the features data set
+    :param label_key: name of the labels data set, None to not store labels
+    :param hash_sources: True to fingerprint sources by hashing their contents instead of their size and modification
+    time
+    :param pbar: optional progress bar, updated with the number of sources processed
+    :param writer_args: any other HDF5Writer arguments (buf_size, dtype_feat, chunks, compression etc.)
+    :return: tuple (# of records copied, # of records loaded, # of records whose source is no longer listed)
+    """
+    if label_key is not None and labels is None:
+        raise ValueError("Labels are required when label_key is set")
+
+    # Compare the fingerprint of each source with the one stored in the existing file (if any)
+    fingerprints = [file_fingerprint(src, hash_sources) for src in sources]
+    existing = load_sources(output_path, hash_sources)
+
+    # Records cannot be reused if their shape or encoding changed, encoded images keep their shape in an attribute
+    if len(existing) > 0:
+        with h5py.File(output_path, "r") as db:
+            attrs = db[feat_key].attrs
+
+            if tuple(attrs.get(ATTR_RECORD_SHAPE, db[feat_key].shape[1:])) != tuple(record_shape) or \
+                    attrs.get(ATTR_ENCODING) != writer_args.get("encode_ext"):
+                existing = {}
+
+    rows = [existing[src][0] if src in existing and existing[src][1] == fp else None
+            for (src, fp) in zip(sources, fingerprints)]
+    to_load = [src for (src, row) in zip(sources, rows) if row is None]
+    num_copied = len(rows) - len(to_load)
+    num_removed = len(set(existing) - set(sources))
+
+    # Nothing to do when the file holds exactly the same records in the same order
+    if len(existing) > 0 and len(to_load) == 0 and num_removed == 0 and rows == list(range(len(rows))):
+        with h5py.File(output_path, "r") as db:
+            if labels is None or (label_key in db and np.array_equal(db[label_key][()], np.asarray(labels))):
+                return num_copied, 0, 0
+
+    # Write a new file next to the existing one, copying unchanged records and loading all other ones
+    tmp_path = output_path + ".tmp"
+    writer = HDF5Writer((None,) + tuple(record_shape), tmp_path, feat_key=feat_key, label_key=label_key,
+                        del_existing=True, track_sources=True, hash_sources=hash_sources, **writer_args)
+    db = h5py.File(output_path, "r") if len(existing) > 0 else None
+    loaded = loader.imap(to_load)
+
+    for (i, (src, fp, row)) in enumerate(zip(sources, fingerprints, rows)):
+        record = db[feat_key][row] if row is not None else next(loaded)
+
+        if record is not None:
+            writer.add([record], [None if labels is None else labels[i]], sources=[src], fingerprints=[fp])
+        else:
+            print("Skipping unreadable source: {}".format(src))
+
+        if pbar is not None:
+            pbar.update(i)
+
+    # Keep the class names
+    if db is not None:
+        if DS_CLASS_NAMES in db:
+            writer.write_class_names([_to_str(n) for n in db[DS_CLASS_NAMES][()]])
+
+        db.close()
+
+    writer.close()
+    get_handle_cache().invalidate(output_path)
+    os.replace(tmp_path, output_path)
+
+    return num_copied, len(to_load), num_removed
@@ -0,0 +1,249 @@
+"""Process-wide cache of HDF5 data sets loaded into memory. Small and medium data sets only need to be read from disc
+once, no matter how many epochs, generators or worker processes use them. Data sets are cached in one of two ways:
+
+- "ram": the data set is read into a NumPy array in the memory of the current process. Worker processes forked
+  afterwards (e.g. prefetch or Keras workers) share the array's memory pages with the training process
+- "shared": the data set is read into a named shared memory block. Other processes using the same data set (e.g. a
+  separate evaluation script) attach to the block instead of reading the data set again. Data sets holding encoded
+  images (variable length records) cannot be shared and are cached in RAM instead, as are all data sets on Python
+  versions without multiprocessing.shared_memory (before 3.8)
+
+Cached arrays are read-only and are identified by the file's path, modification time and size, so a data set that is
+overwritten is loaded again. A data set that does not fit in the memory budget is not cached, it is then read from
+disc as usual. Like HDF5HandleCache, arrays are reference counted: acquire() an array before using it and release() it
+when done. The process that created a shared memory block removes it when it releases the array.
+
+Forked worker processes usually exit without cleaning up, so they use the arrays inherited from their parent but
+never create shared memory blocks themselves: data sets they load are cached in RAM. Load data sets before starting
+worker processes to share them.
+"""
+from .hdf5cache import get_handle_cache
+import numpy as np
+import threading
+import hashlib
+import atexit
+import time
+import os
+
+# Constants
+CACHE_MODES = ("ram", "shared")
+CACHE_MEMORY_FRACTION = 0.5         # default budget as a fraction of the available memory
+SHARED_NAME_PREFIX = "dltoolkit_"
+SHARED_HEADER_BYTES = 64            # header of a shared memory block, its first byte is set once the data is loaded
+SHARED_LOAD_TIMEOUT = 600           # seconds to wait for another process to load a shared data set
+
+
+def available_memory():
+    """Return the available physical memory in bytes, None if it cannot be determined"""
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def shared_memory_supported():
+    """Return True if named shared memory blocks are supported, i.e. on Python 3.8 or later"""
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        return False
+
+    return True
+
+
+def dataset_nbytes(dataset):
+    """Return the number of bytes needed to hold a data set in memory"""
+    if dataset.dtype.kind == "O":
+        # Variable length records, the size of the stored data is a good estimate
+        return dataset.id.get_storage_size()
+
+    return dataset.size * dataset.dtype.itemsize
+
+
+class HDF5MemoryCache:
+    def __init__(self):
+        """Initialise the cache"""
+        self._lock = threading.RLock()
+        self._entries = {}                  # (path, key, modification time, size) -> entry
+        self._forked = False
+
+        # Blocks created by the parent process are used but never removed by a forked child process
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+        atexit.register(self.clear)
+
+    def _after_fork(self):
+        """Keep the entries inherited from the parent process, but never remove the parent's blocks"""
+        self._lock = threading.RLock()
+        self._forked = True
+
+        for entry in self._entries.values():
+            entry["owner"] = False
+
+    @staticmethod
+    def _ident(path, key):
+        stat = os.stat(path)
+        return (os.path.realpath(path), key, stat.st_mtime_ns, stat.st_size)
+
+    def acquire(self, path, key, mode="ram", budget=None):
+        """
+        Return a data set held in memory, loading it the first time. Each call that returns an array must be paired
+        with a call to release()
+        :param path: full path to the HDF5 file
+        :param key: name of the data set
+        :param mode: "ram" or "shared", a data set already cached in the other mode is returned as is
+        :param budget: maximum number of bytes the data set may use, None to use a fraction of the available memory
+        :return: read-only NumPy array, None if the data set does not fit in the budget
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError("Invalid cache mode", mode, CACHE_MODES)
+
+        ident = self._ident(path, key)
+
+        with self._lock:
+            entry = self._entries.get(ident)
+
+            if entry is None:
+                entry = self._load(path, key, ident, mode, budget)
+
+                if entry is None:
+                    return None
+
+                self._entries[ident] = entry
+
+            entry["refs"] += 1
+
+            return entry["array"]
+
+    def _load(self, path, key, ident, mode, budget):
+        """Load a data set into memory, return None if it does not fit in the budget"""
+        with get_handle_cache().open(path) as f:
+            dataset = f[key]
+            nbytes = dataset_nbytes(dataset)
+
+            if budget is None:
+                available = available_memory()
+                budget = available * CACHE_MEMORY_FRACTION if available is not None else None
+
+            if budget is not None and nbytes > budget:
+                return None
+
+            if mode == "shared" and dataset.dtype.kind not in "OV" and not self._forked and shared_memory_supported():
+                name = SHARED_NAME_PREFIX + hashlib.sha1(repr(ident).encode()).hexdigest()[:20]
+                (array, shm, owner) = self._load_shared(dataset, name, nbytes)
+
+                if array is None:
+                    return None
+            else:
+                (array, shm, owner) = (self._load_ram(dataset), None, False)
+
+        array.flags.writeable = False
+
+        return {"array": array, "refs": 0, "shm": shm, "owner": owner, "nbytes": nbytes}
+
+    @staticmethod
+    def _load_ram(dataset):
+        """Read a data set into a new array"""
+        if dataset.dtype.kind == "O" or dataset.size == 0:
+            return dataset[()]
+
+        array = np.empty(dataset.shape, dtype=dataset.dtype)
+        dataset.read_direct(array)
+
+        return array
+
+    @staticmethod
+    def _load_shared(dataset, name, nbytes):
+        """Read a data set into a named shared memory block, or attach to the block another process created"""
+        from multiprocessing import shared_memory, resource_tracker
+
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=SHARED_HEADER_BYTES + max(1, nbytes))
+            owner = True
+        except FileExistsError:
+            # The block is removed by the process that created it, not when this process exits
+            shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(shm._name, "shared_memory")
+            owner = False
+
+        array = np.ndarray(dataset.shape, dtype=dataset.dtype, buffer=shm.buf, offset=SHARED_HEADER_BYTES)
+
+        if owner:
+            if dataset.size > 0:
+                dataset.read_direct(array)
+
+            shm.buf[0] = 1
+        else:
+            # Wait for the process that created the block to load the data set, read from disc if it never does
+            deadline = time.time() + SHARED_LOAD_TIMEOUT
+
+            while shm.buf[0] == 0 and time.time() < deadline:
+                time.sleep(0.05)
+
+            if shm.buf[0] == 0:
+                del array
+                shm.close()
+                return (None, None, False)
+
+        return (array, shm, owner)
+
+    def release(self, array):
+        """
+        Release an array acquired earlier, the memory is freed once the array is no longer used
+        :param array: array returned by acquire()
+        """
+        with self._lock:
+            ident = next((i for (i, e) in self._entries.items() if e["array"] is array), None)
+
+            if ident is None:
+                return
+
+            entry = self._entries[ident]
+            entry["refs"] -= 1
+
+            if entry["refs"] <= 0:
+                del self._entries[ident]
+                self._free(entry)
+
+    @staticmethod
+    def _free(entry):
+        """Free the memory of an entry"""
+        entry["array"] = None
+
+        if entry["shm"] is not None:
+            try:
+                entry["shm"].close()
+            except BufferError:
+                # Batches still refer to the block, it is unmapped when they are garbage collected
+                pass
+
+            if entry["owner"]:
+                entry["shm"].unlink()
+
+    def clear(self):
+        """Free all cached arrays, e.g. at exit, arrays still in use remain valid in this process"""
+        with self._lock:
+            for entry in self._entries.values():
+                self._free(entry)
+
+            self._entries = {}
+
+    def nbytes(self):
+        """Return the number of bytes held by the cache"""
+        with self._lock:
+            return sum(e["nbytes"] for e in self._entries.values())
+
+
+# Cache shared by all generators in this process
+_memory_cache = None
+
+
+def get_memory_cache():
+    """Return the process-wide HDF5MemoryCache, creating it the first time"""
+    global _memory_cache
+
+    if _memory_cache is None:
+        _memory_cache = HDF5MemoryCache()
+
+    return _memory_cache
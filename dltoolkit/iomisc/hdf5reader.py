@@ -1,11 +1,165 @@
-"""Simple HDF5 reader that assumes the entire contents can fit in memory. Closes the file right after returning
-all the data.
+"""Simple HDF5 reader that assumes the entire contents can fit in memory. Files are opened through the process-wide
+handle cache (see HDF5HandleCache), so reading the same file again does not open it again. Encoded images (see
+HDF5Writer's encode_ext) are decoded.
+
+Data sets can also be loaded lazily, in which case nothing is read up front:
+- Contiguous, uncompressed data sets are memory-mapped, pages of the file are read by the OS when they are accessed.
+- Other data sets (chunked, compressed or encoded) are returned as an array-like proxy that only reads the records
+  that are sliced.
 """
-import h5py
+from .runningstats import STAT_MEAN, STAT_PREFIX
+from .imagecodec import decode_image, ATTR_ENCODING, ATTR_RECORD_SHAPE
+from .hdf5cache import get_handle_cache
 import numpy as np
+import weakref
+
+
+class _LazyDataset:
+    """Read-only, array-like view of a HDF5 data set that only reads the records being sliced. Encoded images are
+    decoded when they are read. The file is released when close() is called, at the end of a with block or when the
+    view is garbage collected
+    """
+    def __init__(self, file_path, key):
+        self._dataset = get_handle_cache().acquire_dataset(file_path, key)
+        self._finalizer = weakref.finalize(self, get_handle_cache().release, file_path, self._dataset)
+
+        if ATTR_ENCODING in self._dataset.attrs:
+            record_shape = tuple(self._dataset.attrs[ATTR_RECORD_SHAPE])
+            self._num_channels = record_shape[-1]
+            self.shape = self._dataset.shape + record_shape
+            self.dtype = np.dtype(np.uint8)
+        else:
+            self._num_channels = None
+            self.shape = self._dataset.shape
+            self.dtype = self._dataset.dtype
+
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        data = self._dataset[item]
+
+        if self._num_channels is None:
+            return data
+        elif isinstance(data, np.ndarray) and data.dtype == object:
+            return np.array([decode_image(d, self._num_channels) for d in data.ravel()])
+
+        return decode_image(data, self._num_channels)
+
+    def __array__(self, dtype=None, copy=None):
+        """Read the whole data set, e.g. when the proxy is passed to a NumPy function"""
+        data = self[()]
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Release the file, only the first call has any effect"""
+        self._finalizer()
 
 
 class HDF5Reader:
-    def load_hdf5(self, file_path, key):
-        with h5py.File(file_path, "r") as f:
-            return np.array(f[key][()])
+    def load_hdf5(self, file_path, key, lazy=False):
+        """
+        Load a data set
+        :param file_path: full path to the HDF5 file
+        :param key: name of the data set
+        :param lazy: True to return a read-only np.memmap for contiguous, uncompressed data sets or an array-like
+        proxy that reads records when they are sliced for all other data sets, False to read the whole data set
+        :return: NumPy array, np.memmap or proxy object
+        """
+        if lazy:
+            return self._load_lazy(file_path, key)
+
+        with get_handle_cache().open(file_path) as f:
+            if ATTR_ENCODING in f[key].attrs:
+                num_channels = f[key].attrs[ATTR_RECORD_SHAPE][-1]
+                return np.array([decode_image(data, num_channels) for data in f[key]])
+
+            # Reading the data set returns a new array, it does not need to be copied again
+            return f[key][()]
+
+    def read_into(self, file_path, key, out=None, dtype=None, selection=None):
+        """
+        Read (part of) a data set straight into a NumPy array, HDF5 converts the values to the array's dtype while
+        reading (values outside the range of an integer dtype are clipped), so no temporary copy is needed
+        :param file_path: full path to the HDF5 file
+        :param key: name of the data set
+        :param out: preallocated C-contiguous array to read into, its shape must match the selection. None to create
+        a new array
+        :param dtype: dtype of the new array when out is None, None to use the data set's dtype
+        :param selection: part of the data set to read, e.g. np.s_[10:20] for a range of records (such as the slices
+        of one patient), np.s_[:, 8:-8] for a crop window or np.s_[[1, 5, 7]] for a list of increasing record
+        indices. None to read the whole data set
+        :return: out or the new array
+        """
+        with get_handle_cache().open(file_path) as f:
+            dataset = f[key]
+
+            if ATTR_ENCODING in dataset.attrs:
+                raise ValueError("Encoded data sets cannot be read directly", file_path, key)
+
+            if out is None:
+                out = np.empty(self._selection_shape(dataset.shape, selection),
+                               dtype=dtype if dtype is not None else dataset.dtype)
+
+            dataset.read_direct(out, source_sel=selection)
+
+        return out
+
+    @staticmethod
+    def _selection_shape(shape, selection):
+        """Determine the shape of a selection without reading or allocating any data"""
+        if selection is None:
+            return shape
+
+        selection = selection if isinstance(selection, tuple) else (selection,)
+
+        # Slice an array with zero strides, which does not use any memory, to get the shape of the selection
+        view = np.broadcast_to(np.empty((), dtype=np.uint8), shape)
+
+        if isinstance(selection[0], (list, np.ndarray)):
+            # Index lists (h5py only supports them along a single axis)
+            return (len(selection[0]),) + view[(slice(None),) + selection[1:]].shape[1:]
+
+        return view[selection].shape
+
+    def _load_lazy(self, file_path, key):
+        """Memory-map a data set if its layout allows it, otherwise return a proxy"""
+        dataset = get_handle_cache().acquire_dataset(file_path, key)
+
+        try:
+            offset = dataset.id.get_offset()
+
+            # Only contiguous data sets without filters that were actually written to disc can be mapped
+            can_map = dataset.chunks is None and dataset.compression is None and offset is not None and \
+                      dataset.dtype.kind not in "OV" and dataset.size > 0
+            (shape, dtype) = (dataset.shape, dataset.dtype)
+        finally:
+            get_handle_cache().release(file_path, dataset)
+
+        if can_map:
+            return np.memmap(file_path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+        return _LazyDataset(file_path, key)
+
+    def load_stats(self, file_path, key):
+        """
+        Load the statistics HDF5Writer stored as attributes of a data set (see compute_stats)
+        :param file_path: full path to the HDF5 file
+        :param key: name of the data set
+        :return: dictionary with the per-channel count, mean, var, std, min, max, hist and hist_edges
+        """
+        with get_handle_cache().open(file_path) as f:
+            attrs = f[key].attrs
+
+            if STAT_MEAN not in attrs:
+                raise ValueError("Data set has no statistics", file_path, key)
+
+            return {name[len(STAT_PREFIX):]: np.array(attrs[name]) for name in attrs if name.startswith(STAT_PREFIX)}
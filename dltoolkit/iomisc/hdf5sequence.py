@@ -0,0 +1,136 @@
+"""Random-access versions of the HDF5 generators based on keras.utils.Sequence, which allow Keras to prepare batches
+in parallel, e.g. using fit_generator(workers=4, use_multiprocessing=True). Comes in two versions:
+
+- HDF5Sequence, the Sequence equivalent of HDF5Generator
+- HDF5Sequence_Segment, the Sequence equivalent of HDF5Generator_Segment
+
+With world_size > 1 the batches cover the segment of the epoch's order read by this rank (see the generators).
+
+Batches are loaded exactly like the generators load them, batch i of an epoch holds the records at positions
+i * batch_size up to (i + 1) * batch_size of the epoch's order (see partial_batch for the final batch). With
+shuffle=True a new order is determined by on_epoch_end, which Keras calls at the end of every epoch.
+
+Keras forks its worker processes from the training process, so each worker starts with a copy of the sequence. A
+worker opens its own HDF5 handles the first time it loads a batch (see the generators' _reopen method), handles of the
+training process are never used by a worker.
+
+state_dict() and load_state_dict() save and restore the epoch and seed (see generatorstate.py). Keras always starts a
+Sequence at its first batch, so a restored sequence starts at the beginning of the restored epoch.
+"""
+from .hdf5generator import HDF5Generator, HDF5Generator_Segment
+from .sampling import num_batches, batch_indices, shard_size, batch_seed
+from .generatorstate import ResumableGenerator
+from keras.utils import Sequence
+import numpy as np
+import threading
+import os
+
+
+class _ForkSafeSequence(ResumableGenerator, Sequence):
+    """Base class of the sequences, re-opens the HDF5 files of the sequence in a forked worker process"""
+    def _init_sequence(self):
+        """Initialise the state shared by all sequences"""
+        self._pid = os.getpid()
+        self._pid_lock = threading.Lock()
+        self._epoch = 0
+
+    def _check_pid(self):
+        """Open the HDF5 files again when the sequence is used in a forked worker process for the first time"""
+        with self._pid_lock:
+            if os.getpid() != self._pid:
+                self._reopen()
+                self._pid = os.getpid()
+                np.random.seed()
+
+    def _batch_indices(self, index):
+        """Return the indices of the records of a batch in the current epoch"""
+        return batch_indices(self._order, index, self._batch_size, self._partial_batch)
+
+    def __len__(self):
+        """Return the number of batches per epoch"""
+        return num_batches(shard_size(self._num_images, self._world_size), self._batch_size, self._partial_batch)
+
+    def _state_loaded(self):
+        """Move to the start of the restored epoch"""
+        self._set_epoch(self._position[0])
+
+    def on_epoch_end(self):
+        """Move to the next epoch, reshuffling the records if required"""
+        self._set_epoch(self._epoch + 1)
+
+
+class HDF5Sequence(HDF5Generator, _ForkSafeSequence):
+    def __init__(self, dbpath, batch_size, feat_key="X", label_key="Y", **kwargs):
+        """
+        Initialise the sequence, see HDF5Generator for the other arguments
+        :param dbpath: full path to the HDF5 file
+        :param batch_size: batch size
+        :param feat_key: name of the features data set
+        :param label_key: name of the labels data set
+        """
+        super(HDF5Sequence, self).__init__(dbpath, batch_size, label_key=label_key, **kwargs)
+        self._init_sequence()
+
+        self._feat_key = feat_key
+        self._label_key = label_key
+        self._num_channels_feat = self._num_channels(feat_key)
+
+        # Load cached data sets before Keras starts its worker processes
+        self._reader(label_key, feat_key)
+
+        # Order of the records during the current epoch
+        self._set_epoch(self._epoch)
+
+    def __getitem__(self, index):
+        """
+        Load a batch
+        :param index: index of the batch in the current epoch
+        :return: tuple holding the features and labels of the batch
+        """
+        self._check_pid()
+
+        return self._load_batch(self._batch_indices(index), self._feat_key, self._label_key, self._num_channels_feat,
+                                batch_seed(self._seed, self._epoch, index))
+
+    def _set_epoch(self, epoch):
+        """Move to the start of an epoch and determine its order"""
+        self._epoch = epoch
+        self._position = (epoch, 0)
+        self._order = self._epoch_order(epoch, self._feat_key)
+
+
+class HDF5Sequence_Segment(HDF5Generator_Segment, _ForkSafeSequence):
+    def __init__(self, image_db_path, mask_db_path, batch_size, num_classes, dim_reorder=None, **kwargs):
+        """
+        Initialise the sequence, see HDF5Generator_Segment for the other arguments
+        :param image_db_path: full path to the HDF5 file holding the images
+        :param mask_db_path: full path to the HDF5 file holding the masks, None if the masks are stored in the same
+        file as the images
+        :param batch_size: batch size
+        :param num_classes: number of classes, passed to the converter
+        :param dim_reorder: order the dimensions of the images and masks are transposed to, None to keep the order
+        """
+        super(HDF5Sequence_Segment, self).__init__(image_db_path, mask_db_path, batch_size, num_classes, **kwargs)
+        self._init_sequence()
+
+        self._dim_reorder = dim_reorder
+
+        # Order of the records during the current epoch
+        self._set_epoch(self._epoch)
+
+    def __getitem__(self, index):
+        """
+        Load a batch
+        :param index: index of the batch in the current epoch
+        :return: tuple holding the images and masks of the batch
+        """
+        self._check_pid()
+
+        return self._load_batch(self._batch_indices(index), batch_seed(self._seed, self._epoch, index),
+                                self._dim_reorder)
+
+    def _set_epoch(self, epoch):
+        """Move to the start of an epoch and determine its order"""
+        self._epoch = epoch
+        self._position = (epoch, 0)
+        self._order = self._epoch_order(epoch)
@@ -0,0 +1,231 @@
+"""Data sets split across a number of HDF5 shard files plus a JSON manifest describing them. Shards can be read by
+separate processes at the same time and copied to other machines one at a time.
+
+- HDF5ShardedWriter writes the shards and the manifest, using HDF5Writer for each shard.
+- HDF5ShardedReader maps global record indices to shards. It can be restricted to a subset of whole shards (e.g. one
+  subset per worker process) and behaves like a read-only h5py.File, i.e. db[key][start:stop] works as expected.
+"""
+from .hdf5writer import HDF5Writer
+from .hdf5cache import get_handle_cache
+from bisect import bisect_right
+import numpy as np
+import json, os
+
+# Constants
+MANIFEST_NAME = "manifest.json"
+SHARD_NAME = "shard_{:05d}.hdf5"
+
+
+class HDF5ShardedWriter:
+    def __init__(self, dimensions, output_dir, records_per_shard=None, num_shards=None, feat_key="X", label_key="Y",
+                 del_existing=False, dtype_feat=np.float32, dtype_label=np.uint8, label_shape=(), **writer_args):
+        """
+        Create a new sharded data set in an (empty) output folder
+        :param dimensions: e.g. (# of images, height, width, # of channels), use None for the # of records if it is
+        not known up front
+        :param output_dir: folder to store the shards and the manifest in
+        :param records_per_shard: maximum number of records per shard
+        :param num_shards: number of shards to create instead of records_per_shard (requires the # of records)
+        :param feat_key: name of the features data set
+        :param label_key: name of the labels data set, None to not store labels
+        :param del_existing: delete existing shards and manifest in the output folder True/False
+        :param dtype_feat: dtype of the features data set
+        :param dtype_label: dtype of the labels data set
+        :param label_shape: shape of each label, e.g. (height, width, 1) for segmentation masks
+        :param writer_args: any other HDF5Writer arguments (buf_size, chunks, compression etc.) used for each shard
+        """
+        if records_per_shard is None:
+            if num_shards is None or dimensions[0] is None:
+                raise ValueError("Provide records_per_shard, or num_shards and the number of records")
+
+            records_per_shard = -(-dimensions[0] // num_shards)
+
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+
+        if os.path.exists(self.manifest_path):
+            if not del_existing:
+                raise ValueError("Output folder already contains a sharded data set", output_dir)
+
+            for shard in HDF5ShardedReader.read_manifest(self.manifest_path)["shards"]:
+                os.remove(os.path.join(output_dir, shard["path"]))
+            os.remove(self.manifest_path)
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.output_dir = output_dir
+        self.records_per_shard = records_per_shard
+        self.writer_args = dict(writer_args, feat_key=feat_key, label_key=label_key, dtype_feat=dtype_feat,
+                                dtype_label=dtype_label, label_shape=label_shape, del_existing=del_existing)
+
+        self.manifest = {"feat_key": feat_key,
+                         "label_key": label_key,
+                         "record_shape": list(dimensions[1:]),
+                         "label_shape": list(label_shape),
+                         "dtype_feat": np.dtype(dtype_feat).str,
+                         "dtype_label": np.dtype(dtype_label).str if label_key is not None else None,
+                         "num_records": 0,
+                         "class_names": None,
+                         "shards": []}
+
+        self.writer = None
+        self.index = 0
+
+    def _next_shard(self):
+        """Close the current shard and start a new one"""
+        if self.writer is not None:
+            self._close_shard()
+
+        path = SHARD_NAME.format(len(self.manifest["shards"]))
+        self.writer = HDF5Writer((None,) + tuple(self.manifest["record_shape"]), os.path.join(self.output_dir, path),
+                                 **self.writer_args)
+        self.manifest["shards"].append({"path": path, "start": self.index, "stop": self.index})
+
+    def _close_shard(self):
+        """Close the current shard and record its range of records in the manifest"""
+        self.writer.close()
+        self.manifest["shards"][-1]["stop"] = self.manifest["shards"][-1]["start"] + self.writer.index
+        self.writer = None
+
+    def add(self, features, labels):
+        """Add features and labels, starting a new shard whenever the current one is full"""
+        start = 0
+
+        while start < len(features):
+            if self.writer is None or self.index - self.manifest["shards"][-1]["start"] == self.records_per_shard:
+                self._next_shard()
+
+            # Add as many records as still fit in the current shard
+            count = min(len(features) - start,
+                        self.records_per_shard - (self.index - self.manifest["shards"][-1]["start"]))
+            self.writer.add(features[start:start + count], None if labels is None else labels[start:start + count])
+
+            self.index += count
+            start += count
+
+    def write_class_names(self, class_names):
+        """Store the class name strings in the manifest"""
+        self.manifest["class_names"] = list(class_names)
+
+    def close(self):
+        """Close the last shard and write the manifest"""
+        if self.writer is not None:
+            self._close_shard()
+
+        self.manifest["num_records"] = self.index
+
+        with open(self.manifest_path, "w") as f:
+            f.write(json.dumps(self.manifest, indent=2))
+
+
+class _ShardedDataset:
+    """Read-only view of one data set (e.g. the features) across the shards of a HDF5ShardedReader"""
+    def __init__(self, reader, key):
+        self._reader = reader
+        self._key = key
+        is_feat = key == reader.manifest["feat_key"]
+        self.dtype = np.dtype(reader.manifest["dtype_feat"] if is_feat else reader.manifest["dtype_label"])
+        record_shape = reader.manifest["record_shape"] if is_feat else reader.manifest["label_shape"]
+        self.shape = (reader.num_records,) + tuple(record_shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            (start, stop, step) = item.indices(self.shape[0])
+            return self._reader.read(self._key, start, stop)[::step]
+        elif isinstance(item, (int, np.integer)):
+            item = item + self.shape[0] if item < 0 else item
+            return self._reader.read(self._key, item, item + 1)[0]
+        else:
+            # Array of indices
+            return np.array([self[int(i)] for i in item], dtype=self.dtype).reshape((-1,) + self.shape[1:])
+
+
+class HDF5ShardedReader:
+    def __init__(self, manifest_path, worker=0, num_workers=1, rdcc_nbytes=None):
+        """
+        Open a sharded data set. Shards are assigned to workers round-robin, each worker only sees the records in its
+        own shards, which are numbered from 0 onwards
+        :param manifest_path: full path to the manifest file
+        :param worker: index of this worker (0 <= worker < num_workers)
+        :param num_workers: total number of workers reading the data set
+        :param rdcc_nbytes: chunk cache size used for each shard, None to use the HDF5 default
+        """
+        if num_workers < 1 or not 0 <= worker < num_workers:
+            raise ValueError("Invalid worker index", worker, num_workers)
+
+        self.manifest = self.read_manifest(manifest_path)
+        self._folder = os.path.dirname(manifest_path)
+        self._rdcc_nbytes = rdcc_nbytes
+
+        # Shards assigned to this worker and the index of their first record in this worker's view of the data
+        self.shards = self.manifest["shards"][worker::num_workers]
+        self._starts = np.cumsum([0] + [s["stop"] - s["start"] for s in self.shards])
+        self.num_records = int(self._starts[-1])
+        self.class_names = self.manifest["class_names"]
+
+        self._files = {}
+
+    @staticmethod
+    def read_manifest(manifest_path):
+        """Load a manifest file"""
+        with open(manifest_path) as f:
+            return json.loads(f.read())
+
+    def __getitem__(self, key):
+        """Return a view of the data set with the name provided across all shards, like h5py.File does"""
+        if key not in (self.manifest["feat_key"], self.manifest["label_key"]):
+            raise KeyError(key)
+
+        return _ShardedDataset(self, key)
+
+    def __contains__(self, key):
+        return key is not None and key in (self.manifest["feat_key"], self.manifest["label_key"])
+
+    def shard_of(self, index):
+        """
+        Map a record index to a shard
+        :param index: record index in this reader's view of the data set
+        :return: (position of the shard in self.shards, index of the record inside the shard)
+        """
+        shard_ix = bisect_right(self._starts, index) - 1
+        return shard_ix, index - int(self._starts[shard_ix])
+
+    def _file(self, shard_ix):
+        """Open shards the first time they are needed"""
+        if shard_ix not in self._files:
+            path = os.path.join(self._folder, self.shards[shard_ix]["path"])
+            self._files[shard_ix] = get_handle_cache().acquire(path, rdcc_nbytes=self._rdcc_nbytes)
+
+        return self._files[shard_ix]
+
+    def read(self, key, start, stop):
+        """
+        Read a range of records that may span multiple shards
+        :param key: name of the data set
+        :param start: index of the first record
+        :param stop: index of the last record + 1
+        :return: NumPy array holding the records
+        """
+        parts = []
+        stop = min(stop, self.num_records)
+
+        while start < stop:
+            (shard_ix, offset) = self.shard_of(start)
+            count = min(stop - start, int(self._starts[shard_ix + 1]) - start)
+            parts.append(self._file(shard_ix)[key][offset:offset + count])
+            start += count
+
+        if len(parts) == 1:
+            return parts[0]
+
+        dataset = self[key]
+        return np.concatenate(parts) if len(parts) > 0 else np.empty((0,) + dataset.shape[1:], dtype=dataset.dtype)
+
+    def close(self):
+        """Release all open shards"""
+        for (shard_ix, f) in self._files.items():
+            get_handle_cache().release(os.path.join(self._folder, self.shards[shard_ix]["path"]), f)
+
+        self._files = {}
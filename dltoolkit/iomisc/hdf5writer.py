@@ -3,6 +3,11 @@
 Code is based on the excellent book "Deep Learning for Computer Vision" by PyImageSearch available on:
 https://www.pyimagesearch.com/deep-learning-computer-vision-python-book/
 """
+from .runningstats import RunningStatistics, HIST_BINS, HIST_RANGE
+from .fingerprint import file_fingerprint, DS_SOURCES, DS_FINGERPRINTS
+from .imagecodec import encode_image, decode_image, is_encoded, ATTR_ENCODING, ATTR_RECORD_SHAPE
+from .hdf5cache import get_handle_cache
+from concurrent.futures import ThreadPoolExecutor
 import h5py, os
 import numpy as np
 
@@ -11,23 +16,80 @@ BUF_FEATURES = "X"
 BUF_LABELS = "Y"
 DS_CLASS_NAMES = "NAMES"
 BUF_SIZE = 10000
+CHUNK_RECORDS = 32          # default number of records per chunk, i.e. one typical batch
+CHUNK_BYTES = 2**20         # maximum size of a default chunk, e.g. the size of HDF5's default chunk cache
+
+
+def _default_chunks(num_records, record_shape, itemsize):
+    """Return a chunk shape of at most about CHUNK_BYTES, holding fewer records if needed. Records larger than
+    CHUNK_BYTES (e.g. 3D volumes) are split across chunks by repeatedly halving their largest axis"""
+    record_shape = [int(d) for d in record_shape]
+    record_bytes = int(np.prod(record_shape)) * itemsize
+    num_records = max(1, min(num_records, CHUNK_BYTES // max(1, record_bytes)))
+
+    while int(np.prod(record_shape)) * itemsize > CHUNK_BYTES and max(record_shape) > 1:
+        axis = int(np.argmax(record_shape))
+        record_shape[axis] = -(-record_shape[axis] // 2)
+
+    return (num_records,) + tuple(record_shape)
+
 
 
 class HDF5Writer:
     def __init__(self, dimensions, output_path, feat_key="X", label_key="Y", buf_size=BUF_SIZE, del_existing=False,
-                 dtype_feat=np.float32, dtype_label=np.uint8):
+                 dtype_feat=np.float32, dtype_label=np.uint8, chunks=None, chunk_records=CHUNK_RECORDS,
+                 compression=None, compression_opts=None, shuffle=False, rdcc_nbytes=None, rdcc_nslots=None,
+                 compute_stats=False, hist_bins=HIST_BINS, hist_range=HIST_RANGE, track_sources=False,
+                 hash_sources=False, async_flush=False, label_shape=(),
+                 encode_ext=None, encode_params=None):
                  # dtype_feat=np.float16, dtype_label=np.uint8):
         """
         Create the new HDF5 file for simple 2D matrices
-        :param dimensions: e.g. (# of records, # of features) or (# of images, height, width, # of channels)
+        :param dimensions: e.g. (# of records, # of features) or (# of images, height, width, # of channels). Use
+        None for the # of records to create appendable data sets that grow as records are added
         :param output_path: full path to the HDF5 file
         :param feat_key: name of the features data set
         :param label_key: name of the labels data set
         :param buf_size: size of the in-memory buffer (= maximum number of records to keep in memory before
-        :param del_existing: delete existing file with the same name True/False
         flushing to disc)
+        :param del_existing: delete existing file with the same name True/False
+        :param dtype_feat: dtype of the features data set
+        :param dtype_label: dtype of the labels data set
+        :param chunks: chunk shape of the features data set, None to store chunk_records records per chunk or False
+        for a contiguous (unchunked) layout (not supported by appendable data sets)
+        :param chunk_records: number of records per chunk when chunks is None, typically the batch size used to read
+        the data set. Default chunks are capped at CHUNK_BYTES: they hold fewer records when the records are large,
+        records larger than CHUNK_BYTES are split across chunks
+        :param compression: compression filter to apply to chunked data sets: None, "lzf" or "gzip"
+        :param compression_opts: compression settings, e.g. the gzip level (0-9)
+        :param shuffle: True to apply the HDF5 byte shuffle filter before compression
+        :param rdcc_nbytes: size of the chunk cache in bytes, None to use the HDF5 default (1MB)
+        :param rdcc_nslots: number of chunk cache hash slots, None to use the HDF5 default
+        :param compute_stats: True to keep per-channel statistics (mean, variance, min, max and a histogram) while
+        records are written, they are stored as attributes of the features data set when the file is closed
+        :param hist_bins: number of histogram bins per channel
+        :param hist_range: (lower, upper) range of the histogram
+        :param track_sources: True to store the path and fingerprint of the source file of each record, which enables
+        incremental updates (see update_hdf5). Requires the sources to be passed to add()
+        :param hash_sources: True to fingerprint sources by hashing their contents instead of using their size and
+        modification time
+        :param async_flush: True to write full buffers to disc in a background thread while the next records are
+        copied into a second buffer. Errors raised by the background thread are raised by the next call to add(),
+        flush() or close()
+        :param label_shape: shape of each label, () for a single value per record or e.g. (height, width, 1) to store
+        segmentation masks in the same file as the images
+        :param encode_ext: image format (e.g. ".jpg" or ".png") to store images in as variable-length byte strings
+        instead of decoded pixels, None to store pixels. Records passed to add() can be decoded images, which are
+        encoded when the buffer is flushed, or encoded bytes (e.g. the original image files), which are stored as-is
+        :param encode_params: cv2.imencode parameters, e.g. [cv2.IMWRITE_JPEG_QUALITY, 95]
         """
         self.include_labels = True          # Assume target labels are provided
+        self.appendable = dimensions[0] is None
+        self.encode_ext = encode_ext
+        self.encode_params = encode_params
+
+        # Close any read-only handle to the file kept open by this process
+        get_handle_cache().invalidate(output_path)
 
         if del_existing:
             if os.path.exists(output_path):
@@ -36,54 +98,214 @@ class HDF5Writer:
             raise ValueError("Output path already exists", output_path)
 
         # Create the HDF5 file
-        self.db = h5py.File(output_path, "w", libver='latest')
+        self.db = h5py.File(output_path, "w", libver='latest', rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots)
+
+        # Determine the chunk layout, by default one batch of records per chunk. Encoded images are stored as
+        # variable-length records, only their number per chunk is used
+        default_chunks = chunks is None
+
+        if default_chunks:
+            num_records = chunk_records if self.appendable else min(chunk_records, dimensions[0])
+            record_shape = tuple(dimensions[1:]) if encode_ext is None else ()
+            chunks = _default_chunks(num_records, record_shape, np.dtype(dtype_feat).itemsize)
+
+        if chunks is False:
+            if compression is not None or shuffle:
+                raise ValueError("Compression filters require a chunked layout")
+            if self.appendable:
+                raise ValueError("Appendable data sets require a chunked layout")
+
+            self.layout = {"chunks": None}
+            label_layout = {"chunks": None}
+        else:
+            self.layout = {"chunks": tuple(chunks), "compression": compression,
+                           "compression_opts": compression_opts, "shuffle": shuffle}
+            label_chunks = tuple(chunks[:1]) + tuple(label_shape)
+
+            if default_chunks:
+                label_chunks = _default_chunks(chunks[0], label_shape, np.dtype(dtype_label).itemsize)
+
+            label_layout = dict(self.layout, chunks=label_chunks)
+
+        # Appendable data sets start empty and are resized as records are flushed
+        if self.appendable:
+            self.layout["maxshape"] = (None,) + tuple(dimensions[1:])
+            label_layout["maxshape"] = (None,) + tuple(label_shape)
+            dimensions = (0,) + tuple(dimensions[1:])
 
         #  Create the two datasets: features and labels (optional)
         # print("---> setting HDF5 dtype to: {}".format(dtype_feat))
-        self.feat_dataset = self.db.create_dataset(feat_key, dimensions, dtype=dtype_feat)
+        if encode_ext is None:
+            self.feat_dataset = self.db.create_dataset(feat_key, dimensions, dtype=dtype_feat, **self.layout)
+        else:
+            # One variable-length byte string per image, the decoded image shape is kept as an attribute
+            feat_layout = {k: v for (k, v) in label_layout.items() if k != "maxshape"}
+            if feat_layout["chunks"] is not None:
+                feat_layout["chunks"] = feat_layout["chunks"][:1]
+
+            self.feat_dataset = self.db.create_dataset(feat_key, (dimensions[0],),
+                                                       dtype=h5py.special_dtype(vlen=np.dtype(np.uint8)),
+                                                       maxshape=(None,) if self.appendable else None, **feat_layout)
+            self.feat_dataset.attrs[ATTR_ENCODING] = encode_ext
+            self.feat_dataset.attrs[ATTR_RECORD_SHAPE] = tuple(dimensions[1:])
 
         if label_key is not None:
-            self.label_dataset = self.db.create_dataset(label_key, (dimensions[0],), dtype=dtype_label)
+            self.label_dataset = self.db.create_dataset(label_key, (dimensions[0],) + tuple(label_shape),
+                                                        dtype=dtype_label, **label_layout)
         else:
             self.include_labels = False
 
-        # Init the in-memory buffer
-        self.buf_size = buf_size
+        # Init the in-memory buffer. It is preallocated with the data sets' dtypes and records are copied into it in
+        # place, so it never needs to hold more records than the data set itself
+        self.buf_size = buf_size if self.appendable else max(1, min(buf_size, dimensions[0]))
+        if encode_ext is None:
+            self.buffer = {BUF_FEATURES: np.empty((self.buf_size,) + tuple(dimensions[1:]), dtype=dtype_feat)}
+        else:
+            self.buffer = {BUF_FEATURES: np.empty((self.buf_size,), dtype=object)}
 
         if self.include_labels:
-            self.buffer = {BUF_FEATURES: [], BUF_LABELS: []}
-        else:
-            self.buffer = {BUF_FEATURES: []}
+            self.buffer[BUF_LABELS] = np.empty((self.buf_size,) + tuple(label_shape), dtype=dtype_label)
 
+        self.buf_count = 0                  # number of records currently held in the buffer
         self.index = 0
 
-    def add(self, features, labels):
-        """Add features and labels to the buffer and flush it to disc when it is full"""
-        self.buffer[BUF_FEATURES].extend(features)
+        # Double buffering: the buffer being written in the background is swapped with the spare one on each flush
+        self._executor = None
+        self._pending = None                # future of the write running in the background
+        if async_flush:
+            self._spare = {key: np.empty_like(buf) for (key, buf) in self.buffer.items()}
+            self._executor = ThreadPoolExecutor(max_workers=1)
 
-        if self.include_labels:
-            self.buffer[BUF_LABELS].extend(labels)
+        # Statistics are calculated per channel, i.e. the last dimension of each record
+        self.stats = None
+        if compute_stats:
+            num_channels = dimensions[-1] if len(dimensions) > 1 else 1
+            self.stats = RunningStatistics(num_channels, hist_bins=hist_bins, hist_range=hist_range)
 
-        if len(self.buffer[BUF_FEATURES]) >= self.buf_size:
-            self.flush()
+        # Source paths and fingerprints are small, they are kept in memory until the file is closed
+        self.track_sources = track_sources
+        self.hash_sources = hash_sources
+        self.sources = []
+        self.fingerprints = []
+
+    def add(self, features, labels, sources=None, fingerprints=None):
+        """Copy features and labels into the buffer and flush it to disc whenever it is full. Both can be a list of
+        records or a NumPy array holding a whole batch of records. When sources are tracked the path of the source
+        file (or folder) of each record is required, fingerprints are calculated unless they are provided
+        """
+        # Raise any error of a background write that already finished
+        if self._pending is not None and self._pending.done():
+            self._wait()
+
+        num_records = len(features)
+
+        if self.track_sources:
+            if sources is None or len(sources) != num_records:
+                raise ValueError("A source path is required for each record")
+
+            if fingerprints is None:
+                fingerprints = [file_fingerprint(src, self.hash_sources) for src in sources]
+
+            self.sources.extend(sources)
+            self.fingerprints.extend(fingerprints)
+        start = 0
+
+        while start < num_records:
+            # Copy as many records as still fit in the buffer
+            count = min(num_records - start, self.buf_size - self.buf_count)
+            self._copy_to_buffer(BUF_FEATURES, features[start:start + count])
+
+            if self.include_labels:
+                self._copy_to_buffer(BUF_LABELS, labels[start:start + count])
+
+            self.buf_count += count
+            start += count
+
+            if self.buf_count == self.buf_size:
+                self.flush()
+
+    def _copy_to_buffer(self, key, records):
+        """Copy records into the buffer starting at the first free position"""
+        if isinstance(records, np.ndarray) and self.buffer[key].dtype != object:
+            self.buffer[key][self.buf_count:self.buf_count + len(records)] = records
+        else:
+            # Copy one record at a time to avoid converting the list to a temporary array first
+            for (i, record) in enumerate(records):
+                self.buffer[key][self.buf_count + i] = record
 
     def flush(self):
-        """Write to disc and reset the buffer"""
-        i = self.index + len(self.buffer[BUF_FEATURES])
+        """Write the buffer contents straight to disc and reset the buffer. In async_flush mode the buffer is handed
+        to the background thread instead, after waiting for the previous write to finish
+        """
+        if self.buf_count == 0:
+            return
+
+        (start, count) = (self.index, self.buf_count)
+        self.index += count
+
+        if self._executor is None:
+            self._write(self.buffer, start, count)
+        else:
+            self._wait()
+            (self.buffer, self._spare) = (self._spare, self.buffer)
+            self._pending = self._executor.submit(self._write, self._spare, start, count)
+
+        # Reset the buffer, its memory is reused for the next records
+        self.buf_count = 0
+
+    def _write(self, buffer, start, count):
+        """Write the first count records of a buffer to the data sets, starting at record index start"""
+        i = start + count
+
+        # Grow appendable data sets in chunk sized steps
+        if self.appendable and i > self.feat_dataset.shape[0]:
+            self._resize(-(-i // self.layout["chunks"][0]) * self.layout["chunks"][0])
 
         # Add buffer contents to the data sets
-        self.feat_dataset[self.index:i] = self.buffer[BUF_FEATURES]
+        if self.encode_ext is None:
+            self.feat_dataset.write_direct(buffer[BUF_FEATURES], np.s_[0:count], np.s_[start:i])
+        else:
+            self.feat_dataset.write_direct(self._encode(buffer[BUF_FEATURES][:count]), np.s_[0:count], np.s_[start:i])
 
         if self.include_labels:
-            self.label_dataset[self.index:i] = self.buffer[BUF_LABELS]
+            self.label_dataset.write_direct(buffer[BUF_LABELS], np.s_[0:count], np.s_[start:i])
+
+        if self.stats is not None and self.encode_ext is None:
+            self.stats.update(buffer[BUF_FEATURES][:count])
+
+    def _encode(self, records):
+        """Encode the decoded images in an array of records, updating the statistics with the decoded images"""
+        encoded = np.empty((len(records),), dtype=object)
+        num_channels = self.feat_dataset.attrs[ATTR_RECORD_SHAPE][-1]
+
+        for (j, record) in enumerate(records):
+            if is_encoded(record):
+                encoded[j] = np.frombuffer(record, dtype=np.uint8) if isinstance(record, bytes) else record
+                image = decode_image(record, num_channels) if self.stats is not None else None
+            else:
+                encoded[j] = encode_image(record, self.encode_ext, self.encode_params)
+                image = record
+
+            if self.stats is not None:
+                self.stats.update(image)
+
+            # Release the decoded image held by the buffer
+            records[j] = None
+
+        return encoded
 
-        self.index = i
+    def _wait(self):
+        """Wait for the background write (if any) to finish, raising its error if it failed"""
+        if self._pending is not None:
+            (pending, self._pending) = (self._pending, None)
+            pending.result()
+
+    def _resize(self, num_records):
+        """Resize appendable data sets to hold the number of records provided"""
+        self.feat_dataset.resize(num_records, axis=0)
 
-        # Reset the buffer
         if self.include_labels:
-            self.buffer = {BUF_FEATURES: [], BUF_LABELS: []}
-        else:
-            self.buffer = {BUF_FEATURES: []}
+            self.label_dataset.resize(num_records, axis=0)
 
     def write_class_names(self, class_names):
         """Write the class name strings to disc"""
@@ -92,8 +314,29 @@ class HDF5Writer:
         class_name_dataset[:] = class_names
 
     def close(self):
-        """Close the file, flush to disc first if the buffer is not empty"""
-        if len(self.buffer[BUF_FEATURES]) > 0:
+        """Close the file, flush to disc first if the buffer is not empty. Appendable data sets are trimmed to the
+        number of records actually added
+        """
+        try:
             self.flush()
+            self._wait()
+        except Exception:
+            self.db.close()
+            raise
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+
+        if self.appendable:
+            self._resize(self.index)
+
+        if self.stats is not None:
+            self.stats.to_attrs(self.feat_dataset.attrs)
+
+        if self.track_sources:
+            dt = h5py.special_dtype(vlen=str)
+            sources = self.db.create_dataset(DS_SOURCES, data=np.array(self.sources, dtype=object), dtype=dt)
+            sources.attrs["hash_sources"] = self.hash_sources
+            self.db.create_dataset(DS_FINGERPRINTS, data=np.array(self.fingerprints, dtype=object), dtype=dt)
 
         self.db.close()
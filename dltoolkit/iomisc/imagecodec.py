@@ -0,0 +1,50 @@
+"""Encoding and decoding of images stored as compressed bytes (JPEG, PNG etc.) in a HDF5 data set. Storing encoded
+images instead of decoded pixels makes HDF5 files many times smaller, at the cost of decoding each image when it is
+read.
+"""
+import numpy as np
+import cv2
+
+# Attribute names used to describe encoded records on a HDF5 data set
+ATTR_ENCODING = "encoding"
+ATTR_RECORD_SHAPE = "record_shape"
+
+
+def is_encoded(record):
+    """Return True if a record holds encoded image bytes rather than decoded pixels"""
+    return isinstance(record, bytes) or (isinstance(record, np.ndarray) and record.ndim == 1)
+
+
+def encode_image(image, ext=".jpg", params=None):
+    """
+    Encode an image
+    :param image: decoded image, e.g. with shape (height, width, # of channels)
+    :param ext: image format to encode to, e.g. ".jpg" or ".png"
+    :param params: cv2.imencode parameters, e.g. [cv2.IMWRITE_JPEG_QUALITY, 95]
+    :return: 1D uint8 NumPy array holding the encoded image
+    """
+    (success, data) = cv2.imencode(ext, image, params if params is not None else [])
+
+    if not success:
+        raise ValueError("Image could not be encoded", ext, image.shape)
+
+    return data.ravel()
+
+
+def decode_image(data, num_channels=3):
+    """
+    Decode an image
+    :param data: encoded image as bytes or a 1D uint8 NumPy array
+    :param num_channels: number of channels of the decoded image, 1 for grayscale or 3 for colour images
+    :return: decoded image with shape (height, width, # of channels)
+    """
+    if isinstance(data, bytes):
+        data = np.frombuffer(data, dtype=np.uint8)
+
+    flags = cv2.IMREAD_GRAYSCALE if num_channels == 1 else cv2.IMREAD_COLOR
+    image = cv2.imdecode(data, flags)
+
+    if image is None:
+        raise ValueError("Image could not be decoded")
+
+    return image.reshape(image.shape[:2] + (num_channels,))
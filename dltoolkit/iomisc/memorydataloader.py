@@ -1,9 +1,13 @@
 """Data loading functions
 """
+from .parallelpreprocessor import apply_preprocessors, supports_batch
 import numpy as np
 import cv2
 import os
 
+# Constants
+PREPROCESS_BATCH_SIZE = 256         # number of images preprocessed at once when all preprocessors support batches
+
 
 class MemoryDataLoader:
     """Loads images using full image paths into memoery.
@@ -34,18 +38,19 @@ class MemoryDataLoader:
         X = []
         Y = []
 
+        # Images are preprocessed in batches when possible, otherwise one at a time
+        batch_size = PREPROCESS_BATCH_SIZE if supports_batch(self.preprocessors) else 1
+        batch = []
+
         for (i, imagePath) in enumerate(imagePaths):
             # Load the image and extrac the label name from the file name
-            image = cv2.imread(imagePath)
-            label = imagePath.split(os.path.sep)[-2]
+            batch.append(cv2.imread(imagePath))
+            Y.append(imagePath.split(os.path.sep)[-2])
 
             # Apply any preprocessors
-            if self.preprocessors is not None:
-                for p in self.preprocessors:
-                    image = p.preprocess(image)
-
-            X.append(image)
-            Y.append(label)
+            if len(batch) == batch_size or i == len(imagePaths) - 1:
+                X.extend(apply_preprocessors(self.preprocessors, batch))
+                batch = []
 
             if verbose > 0 and i > 0 and (i + 1) % verbose == 0:
                 print("Loaded and processed image {}/{}".format(i+1, len(imagePaths)))
@@ -0,0 +1,161 @@
+"""Decode and preprocess images using a pool of worker processes (or threads) while returning the results in their
+original order, e.g. to feed a single HDF5Writer when converting a data set to HDF5 format. The number of images
+being decoded or waiting to be consumed is bounded, so memory use does not depend on the size of the data set.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from itertools import repeat
+from .imagecodec import encode_image
+import numpy as np
+import cv2
+import os
+
+
+class ImageFileLoader:
+    """Read an image from disc and apply a chain of preprocessors to it. Instances can be pickled, so they can be
+    used by worker processes as long as the preprocessors can be pickled as well.
+
+    Attributes:
+        preprocessors: list of preprocessors to apply to each image
+        flags: flags passed to cv2.imread, e.g. cv2.IMREAD_GRAYSCALE
+        encode_ext: image format to encode the preprocessed image to (e.g. ".jpg"), None to return decoded pixels
+        encode_params: cv2.imencode parameters
+        keep_original: True to return the original bytes of the image file
+    """
+    def __init__(self, preprocessors=None, flags=cv2.IMREAD_COLOR, encode_ext=None, encode_params=None,
+                 keep_original=False):
+        """
+        Initialise the class
+        :param preprocessors: list of preprocessors to apply to each image
+        :param flags: flags passed to cv2.imread
+        :param encode_ext: image format to encode the preprocessed image to, e.g. to store it in a HDF5 data set
+        created with HDF5Writer's encode_ext. None to return the decoded image
+        :param encode_params: cv2.imencode parameters, e.g. [cv2.IMWRITE_JPEG_QUALITY, 95]
+        :param keep_original: True to return the bytes of the image file as-is (as a 1D uint8 array) instead of
+        decoding it, the image is only decoded to check it can be read. Cannot be combined with preprocessors
+        """
+        if keep_original and (preprocessors or encode_ext is not None):
+            raise ValueError("Original images cannot be preprocessed or re-encoded")
+
+        self.preprocessors = preprocessors if preprocessors is not None else []
+        self.flags = flags
+        self.encode_ext = encode_ext
+        self.encode_params = encode_params
+        self.keep_original = keep_original
+
+    def __call__(self, path):
+        """
+        Load and preprocess a single image
+        :param path: full path to the image
+        :return: preprocessed (and optionally encoded) image or None if the image could not be read
+        """
+        if self.keep_original:
+            data = np.fromfile(path, dtype=np.uint8)
+            return data if cv2.imdecode(data, self.flags) is not None else None
+
+        image = cv2.imread(path, self.flags)
+
+        if image is None:
+            return None
+
+        for p in self.preprocessors:
+            image = p.preprocess(image)
+
+        if self.encode_ext is not None:
+            image = encode_image(image, self.encode_ext, self.encode_params)
+
+        return image
+
+
+def _load_chunk(load_func, items):
+    """Helper function executed by the workers, loads a list of items"""
+    return [load_func(item) for item in items]
+
+
+class ParallelLoader:
+    """Apply a loading function to a sequence of items (typically image paths) using a pool of workers and return
+    the results in the order of the items.
+
+    Attributes:
+        load_func: function (or picklable callable) taking a single item and returning the loaded record, or None
+        if the item cannot be loaded
+        num_workers: number of worker processes or threads
+        chunk_size: number of items sent to a worker at a time
+        max_in_flight: maximum number of chunks being loaded or waiting to be consumed at any time
+        use_processes: True to use worker processes, False to use threads (sufficient when load_func releases the
+        GIL, as most OpenCV functions do)
+    """
+    def __init__(self, load_func, num_workers=None, chunk_size=8, max_in_flight=None, use_processes=True):
+        """
+        Initialise the class
+        :param load_func: function taking a single item and returning the loaded record or None
+        :param num_workers: number of workers, None to use one per CPU
+        :param chunk_size: number of items sent to a worker at a time
+        :param max_in_flight: maximum number of chunks in flight, None for twice the number of workers
+        :param use_processes: True to use worker processes, False to use threads
+        """
+        self.load_func = load_func
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight if max_in_flight is not None else 2 * self.num_workers
+        self.use_processes = use_processes
+
+    def _chunks(self, items):
+        """Split an iterable of items into lists of at most chunk_size items"""
+        chunk = []
+
+        for item in items:
+            chunk.append(item)
+
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+
+        if len(chunk) > 0:
+            yield chunk
+
+    def imap(self, items):
+        """
+        Load all items using the worker pool
+        :param items: iterable of items (e.g. a list_images generator), it is consumed lazily
+        :return: generator yielding the loaded records in the same order as the items
+        """
+        executor = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+
+        with executor(max_workers=self.num_workers) as pool:
+            pending = deque()
+
+            for chunk in self._chunks(items):
+                pending.append(pool.submit(_load_chunk, self.load_func, chunk))
+
+                # Wait for the oldest chunk once the maximum number of chunks is in flight
+                if len(pending) >= self.max_in_flight:
+                    for record in pending.popleft().result():
+                        yield record
+
+            while len(pending) > 0:
+                for record in pending.popleft().result():
+                    yield record
+
+    def to_hdf5(self, writer, items, labels=None, pbar=None):
+        """
+        Load all items and add them to a HDF5Writer in their original order. Items that cannot be loaded are skipped,
+        which requires an appendable writer to avoid leaving empty records
+        :param writer: HDF5Writer instance
+        :param items: iterable of items to load
+        :param labels: iterable of labels, one for each item, or None if the writer does not store labels
+        :param pbar: optional progress bar, updated with the number of items processed
+        :return: number of records written
+        """
+        num_written = 0
+        labels = labels if labels is not None else repeat(None)
+
+        for (i, (record, label)) in enumerate(zip(self.imap(items), labels)):
+            if record is not None:
+                writer.add([record], [label])
+                num_written += 1
+
+            if pbar is not None:
+                pbar.update(i)
+
+        return num_written
@@ -0,0 +1,188 @@
+"""Apply a chain of preprocessors to the images of a batch. apply_preprocessors() passes the whole batch to the
+preprocess_batch method of each preprocessor that has one, as long as the images have the same size. Other
+preprocessors are applied one image at a time.
+
+ParallelPreprocessor spreads the images of a batch across a pool of worker processes. Each worker preprocesses a
+fixed, contiguous part of the batch, so the order of the images never changes. Images are passed to the workers and
+returned to the caller through anonymous shared memory blocks that are reused for every batch, instead of being
+pickled.
+
+Workers are forked and inherit the preprocessors and the shared memory blocks, so the preprocessors do not need to be
+picklable. Each worker reseeds NumPy's random state, so random preprocessors (e.g. PatchPreprocessor) do not produce
+the same results in every worker.
+
+Random preprocessors that have a uses_rng attribute draw from a np.random.RandomState passed by the caller instead of
+NumPy's global random state, which makes their results reproducible: preprocess() takes the one of its image (rng),
+preprocess_batch() a list holding one per image (rngs). Each image has its own random state, derived from the seed of
+the batch and the position of the image in the batch (see record_rngs), so the results do not depend on how the batch
+is split across the workers.
+"""
+from .sampling import epoch_rng
+import multiprocessing as mp
+import numpy as np
+import threading
+import mmap
+
+# Preprocessors and shared memory blocks used by the current worker process
+_worker_preprocessors = None
+_worker_blocks = None
+
+
+def supports_batch(preprocessors):
+    """Return True if every preprocessor in a chain can preprocess a whole batch of images at once"""
+    return all(hasattr(p, "preprocess_batch") for p in preprocessors)
+
+
+def record_rngs(seed, start, stop):
+    """Return the random states of images start:stop of a batch, derived from the seed of the batch, None without a
+    seed"""
+    return [epoch_rng(seed, i) for i in range(start, stop)] if seed is not None else None
+
+
+def apply_preprocessors(preprocessors, images, out=None, rngs=None):
+    """
+    Apply a chain of preprocessors to a batch of images
+    :param preprocessors: list of preprocessors to apply to each image
+    :param images: NumPy array of images, or a list of images that may differ in size (e.g. decoded images)
+    :param out: optional NumPy array to write the preprocessed images to
+    :param rngs: list holding the np.random.RandomState random preprocessors draw from for each image (see
+    record_rngs), None to use NumPy's global random state
+    :return: NumPy array holding the preprocessed images in their original order
+    """
+    for (i, p) in enumerate(preprocessors):
+        uses_rng = rngs is not None and getattr(p, "uses_rng", False)
+
+        if hasattr(p, "preprocess_batch"):
+            # A list of images of the same size can be preprocessed as a single array
+            if not isinstance(images, np.ndarray) and len(set(image.shape for image in images)) == 1:
+                images = np.stack(images)
+
+            if isinstance(images, np.ndarray):
+                kwargs = {"rngs": rngs} if uses_rng else {}
+                images = p.preprocess_batch(images, out if i == len(preprocessors) - 1 else None, **kwargs)
+                continue
+
+        images = [p.preprocess(image, rng=rngs[j]) if uses_rng else p.preprocess(image)
+                  for (j, image) in enumerate(images)]
+
+    images = np.asarray(images)
+
+    if out is None or images is out:
+        return images
+
+    out[...] = images
+    return out
+
+
+def _init_worker(preprocessors, in_block, out_block):
+    """Initialise a worker process"""
+    global _worker_preprocessors, _worker_blocks
+    _worker_preprocessors = preprocessors
+    _worker_blocks = (in_block, out_block)
+    np.random.seed()
+
+
+def _preprocess_part(in_layout, images, start, stop, out_layout, seed):
+    """Preprocess images start:stop of a batch, writing the results to the shared output block"""
+    if in_layout is not None:
+        images = np.ndarray(in_layout[0], dtype=in_layout[1], buffer=_worker_blocks[0])[start:stop]
+
+    out = np.ndarray(out_layout[0], dtype=out_layout[1], buffer=_worker_blocks[1])
+    apply_preprocessors(_worker_preprocessors, images, out[start:stop], record_rngs(seed, start, stop))
+
+
+class ParallelPreprocessor:
+    """Preprocess batches of images using a pool of worker processes
+
+    Attributes:
+        preprocessors: list of preprocessors to apply to each image
+        num_workers: number of worker processes
+    """
+    def __init__(self, preprocessors, num_workers):
+        """
+        Initialise the class, the worker processes are started when the first batch is preprocessed
+        :param preprocessors: list of preprocessors to apply to each image
+        :param num_workers: number of worker processes
+        """
+        self.preprocessors = preprocessors
+        self.num_workers = num_workers
+        self._pool = None
+        self._lock = threading.Lock()       # batches share the shared memory blocks
+
+        self._in_block = None
+        self._out_block = None
+        self._out_record = None             # (shape, dtype) of a preprocessed image
+
+    def _start_pool(self, in_nbytes, out_nbytes):
+        """Start the workers, restarting them with larger shared memory blocks if the current blocks are too small"""
+        if self._pool is not None and len(self._in_block) >= in_nbytes and len(self._out_block) >= out_nbytes:
+            return
+
+        self.close()
+        self._in_block = mmap.mmap(-1, max(1, in_nbytes))
+        self._out_block = mmap.mmap(-1, max(1, out_nbytes))
+        self._pool = mp.get_context("fork").Pool(self.num_workers, initializer=_init_worker,
+                                                 initargs=(self.preprocessors, self._in_block, self._out_block))
+
+    def preprocess_batch(self, images, out=None, seed=None):
+        """
+        Preprocess a batch of images
+        :param images: NumPy array of images, or a list of images that may differ in size (e.g. decoded images)
+        :param out: optional NumPy array to write the preprocessed images to
+        :param seed: optional seed of the random preprocessors (those with a uses_rng attribute), None to use NumPy's
+        global random state
+        :return: NumPy array holding the preprocessed images in their original order
+        """
+        num_images = len(images)
+
+        with self._lock:
+            # Preprocess the first image to determine the shape and dtype of the results
+            if self._out_record is None:
+                first = images[0]
+
+                for p in self.preprocessors:
+                    first = p.preprocess(first)
+
+                self._out_record = (first.shape, first.dtype)
+
+            # Arrays of images are copied to shared memory, lists of images are pickled
+            out_layout = ((num_images,) + self._out_record[0], self._out_record[1])
+            in_layout = (images.shape, images.dtype) if isinstance(images, np.ndarray) else None
+
+            self._start_pool(images.nbytes if in_layout is not None else 0,
+                             int(np.prod(out_layout[0])) * np.dtype(out_layout[1]).itemsize)
+
+            if in_layout is not None:
+                np.ndarray(in_layout[0], dtype=in_layout[1], buffer=self._in_block)[...] = images
+
+            # Each worker preprocesses a contiguous part of the batch
+            bounds = np.linspace(0, num_images, min(self.num_workers, num_images) + 1).astype(int)
+            results = [self._pool.apply_async(_preprocess_part,
+                                              (in_layout, None if in_layout is not None else images[start:stop],
+                                               start, stop, out_layout, seed))
+                       for (start, stop) in zip(bounds[:-1], bounds[1:])]
+
+            for r in results:
+                r.get()
+
+            # Copy the results out of the shared block, which is reused for the next batch
+            results = np.ndarray(out_layout[0], dtype=out_layout[1], buffer=self._out_block)
+
+            if out is None:
+                return np.array(results)
+
+            out[...] = results
+            return out
+
+    def close(self):
+        """Stop the worker processes and free the shared memory"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+        for block in (self._in_block, self._out_block):
+            if block is not None:
+                block.close()
+
+        (self._in_block, self._out_block) = (None, None)
@@ -0,0 +1,239 @@
+"""Generate batches of random patches sampled from full images and their masks, e.g. to train a segmentation model on
+small patches of large images. Fresh patches are sampled for every batch, so every epoch sees different patches and
+memory use does not depend on the number of patches per epoch. The patches of a batch are extracted using a single
+fancy indexing operation.
+
+The positions of the patches of batch b during epoch e are drawn from a random stream derived from (seed, worker, e,
+b). Batches are reproducible for a given seed no matter which thread or process prepares them, and each worker (e.g.
+one per GPU or machine) gets its own stream of patches.
+
+By default patches are sampled uniformly. With a foreground_ratio the patches are centred on a foreground (mask) pixel
+with that probability and on a background pixel otherwise, see PixelIndex. Pixels outside an optional field of view
+(FOV) mask are never used as a centre.
+"""
+from .hdf5cache import get_handle_cache
+from .pixelindex import PixelIndex, cached_pixel_index
+from .sampling import epoch_rng, num_batches
+from .prefetch import PrefetchingGenerator
+from .generatorstate import ResumableGenerator
+from contextlib import ExitStack
+import numpy as np
+import threading
+
+
+def extract_patches(images, image_ixs, rows, cols, patch_height, patch_width):
+    """
+    Extract patches from a set of images
+    :param images: NumPy array of images with shape (N, height, width) or (N, height, width, # of channels)
+    :param image_ixs: NumPy array holding the index of the image each patch is taken from
+    :param rows: NumPy array holding the top row of each patch
+    :param cols: NumPy array holding the left column of each patch
+    :param patch_height: patch height
+    :param patch_width: patch width
+    :return: NumPy array with shape (# of patches, patch_height, patch_width) + images.shape[3:]
+    """
+    rows = rows[:, np.newaxis, np.newaxis] + np.arange(patch_height)[np.newaxis, :, np.newaxis]
+    cols = cols[:, np.newaxis, np.newaxis] + np.arange(patch_width)[np.newaxis, np.newaxis, :]
+
+    return images[image_ixs[:, np.newaxis, np.newaxis], rows, cols]
+
+
+class PatchGeneratorBase(PrefetchingGenerator, ResumableGenerator):
+    """Base class of the generators sampling patches from images (or volumes) and their masks, opens the sources,
+    indexes the mask pixels and generates the batches of the _load_batch method"""
+    def _init_sources(self, images, masks, feat_key, mask_key, rdcc_nbytes, foreground_ratio, fov, fov_key,
+                      mask_threshold, patch_shape):
+        """
+        Open the images and masks and index the mask pixels, see RandomPatchGenerator for the arguments
+        :param patch_shape: spatial shape of the patches, e.g. (height, width) or (depth, height, width)
+        """
+        if masks is None and not isinstance(images, str):
+            raise ValueError("Masks must be provided when the images are not read from a HDF5 file")
+
+        # Images and masks share a single file handle when they are stored in the same file
+        self._image_source = images
+        self._mask_source = masks if masks is not None else images
+        self._feat_key = feat_key
+        self._mask_key = mask_key if mask_key is not None else ("Y" if masks is None else feat_key)
+        self._rdcc_nbytes = rdcc_nbytes
+        self._foreground_ratio = foreground_ratio
+
+        # Index the mask pixels before the masks file is opened
+        self._pixel_index = None
+
+        if foreground_ratio is not None:
+            if not 0 <= foreground_ratio <= 1:
+                raise ValueError("The foreground ratio must be between 0 and 1", foreground_ratio)
+
+            self._pixel_index = self._build_pixel_index(fov, fov_key, mask_threshold, patch_shape)
+
+        self._open_sources()
+
+    def _build_pixel_index(self, fov, fov_key, threshold, patch_shape):
+        """Return the index of the foreground pixels of the masks"""
+        fov_key = fov_key if fov_key is not None else self._mask_key
+
+        # The index of masks stored in a HDF5 file is stored next to that file
+        if isinstance(self._mask_source, str) and (fov is None or isinstance(fov, str)):
+            return cached_pixel_index(self._mask_source, self._mask_key, fov, fov_key, len(patch_shape), threshold,
+                                      patch_shape)
+
+        # Masks or field of view held in memory, data sets of HDF5 files are read one record at a time
+        with ExitStack() as stack:
+            masks = self._mask_source
+
+            if isinstance(masks, str):
+                masks = stack.enter_context(get_handle_cache().open(masks))[self._mask_key]
+
+            if isinstance(fov, str):
+                fov = stack.enter_context(get_handle_cache().open(fov))[fov_key]
+
+            return PixelIndex.build(masks, fov, len(patch_shape), threshold, patch_shape)
+
+    def _open_source(self, source, key):
+        """Return the data set of a HDF5 file, arrays held in memory are used as is"""
+        if not isinstance(source, str):
+            return source
+
+        dataset = get_handle_cache().acquire_dataset(source, key, rdcc_nbytes=self._rdcc_nbytes)
+        self._datasets.append((source, dataset))
+
+        return dataset
+
+    def _open_sources(self):
+        """Open the images and masks"""
+        self._datasets = []
+        self._images = self._open_source(self._image_source, self._feat_key)
+        self._masks = self._open_source(self._mask_source, self._mask_key)
+        self._read_lock = threading.Lock()
+
+    def _reopen(self):
+        """Open the HDF5 files again in a forked worker process, handles of the parent process are not used"""
+        self._open_sources()
+
+    def steps_per_epoch(self):
+        """Return the number of batches per epoch"""
+        raise NotImplementedError
+
+    def _batches_per_epoch(self):
+        """Return the number of batches per epoch"""
+        return self.steps_per_epoch()
+
+    def generator(self, num_epochs=np.inf):
+        """Generate batches of patches"""
+        return self._generate(self._positions(num_epochs))
+
+    def close(self):
+        # Stop background batch preparation before the files are closed
+        self._stop_prefetch()
+
+        for (path, dataset) in self._datasets:
+            get_handle_cache().release(path, dataset)
+
+        self._datasets = []
+
+
+class RandomPatchGenerator(PatchGeneratorBase):
+    """Generator sampling random patches from images and the corresponding patches from their masks"""
+    def __init__(self, images, masks, patch_dim, batch_size, patches_per_epoch, num_classes=2, converter=None,
+                 feat_key="X", mask_key=None, seed=None, worker=0, fixed_patches=False, rdcc_nbytes=None, prefetch=0,
+                 prefetch_workers=1, prefetch_processes=False, foreground_ratio=None, fov=None, fov_key=None,
+                 mask_threshold=0.0):
+        """
+        Initialise the generator
+        :param images: NumPy array of images with shape (N, height, width, # of channels), or the full path to the
+        HDF5 file holding the images
+        :param masks: NumPy array of masks, the full path to the HDF5 file holding the masks or None if the masks are
+        stored in the same HDF5 file as the images
+        :param patch_dim: patch size, either an integer for square patches or a (height, width) tuple
+        :param batch_size: number of patches per batch
+        :param patches_per_epoch: number of patches per epoch, the final batch holds fewer patches when it is not a
+        multiple of the batch size
+        :param num_classes: number of classes, passed to the converter
+        :param converter: function converting a batch of mask patches to the format produced by the model
+        :param feat_key: name of the images data set
+        :param mask_key: name of the masks data set, None to use feat_key for a separate masks file or "Y" when the
+        masks are stored in the images file
+        :param seed: seed of the random patch positions, None for different positions every run
+        :param worker: index of this worker, each worker samples different patches
+        :param fixed_patches: True to sample the same patches every epoch (e.g. for validation), False to sample new
+        patches every epoch
+        :param rdcc_nbytes: chunk cache size in bytes, None to use the HDF5 default
+        :param prefetch: number of batches prepared ahead in the background, 0 to prepare batches when they are
+        requested
+        :param prefetch_workers: number of threads or processes preparing batches
+        :param prefetch_processes: True to prepare batches in forked worker processes, False to use threads
+        :param foreground_ratio: fraction of the patches centred on a foreground pixel, None to sample patches
+        uniformly
+        :param fov: NumPy array of field of view masks or the full path to the HDF5 file holding them, None to use all
+        pixels. Only used with a foreground_ratio
+        :param fov_key: name of the field of view data set, None to use mask_key
+        :param mask_threshold: mask values above the threshold are foreground
+        """
+        (self._patch_height, self._patch_width) = (patch_dim, patch_dim) if np.isscalar(patch_dim) else patch_dim
+        self._batch_size = batch_size
+        self._patches_per_epoch = patches_per_epoch
+        self._num_classes = num_classes
+        self._converter = converter
+        self._init_state(seed)
+        self._worker = worker
+        self._fixed_patches = fixed_patches
+
+        # Background batch preparation
+        self._init_prefetch(prefetch, prefetch_workers, prefetch_processes)
+
+        self._init_sources(images, masks, feat_key, mask_key, rdcc_nbytes, foreground_ratio, fov, fov_key,
+                           mask_threshold, (self._patch_height, self._patch_width))
+
+        (self._num_images, self._img_height, self._img_width) = self._images.shape[:3]
+
+        if self._masks.shape[:3] != self._images.shape[:3]:
+            raise ValueError("The images and masks differ in number or size", self._images.shape, self._masks.shape)
+
+        if self._patch_height > self._img_height or self._patch_width > self._img_width:
+            raise ValueError("Patches are larger than the images", (self._patch_height, self._patch_width),
+                             (self._img_height, self._img_width))
+
+    def steps_per_epoch(self):
+        """Return the number of batches per epoch"""
+        return num_batches(self._patches_per_epoch, self._batch_size)
+
+    def _read(self, dataset, image_ixs, unique_ixs, inverse_ixs):
+        """Return the images patches are taken from and the index of each patch's image in them"""
+        if isinstance(dataset, np.ndarray):
+            return (dataset, image_ixs)
+
+        # Only read the images patches are taken from, in increasing order
+        with self._read_lock:
+            return (dataset[unique_ixs.tolist()], inverse_ixs)
+
+    def _load_batch(self, epoch, index):
+        """Sample the patches of a single batch"""
+        rng = epoch_rng(self._seed, self._worker, 0 if self._fixed_patches else epoch, index)
+        batch_size = min(self._batch_size, self._patches_per_epoch - index * self._batch_size)
+
+        if self._pixel_index is None:
+            # Pick a random image and a random top left corner for each patch
+            image_ixs = rng.randint(0, self._num_images, size=batch_size)
+            rows = rng.randint(0, self._img_height - self._patch_height + 1, size=batch_size)
+            cols = rng.randint(0, self._img_width - self._patch_width + 1, size=batch_size)
+        else:
+            # Pick a foreground or background centre pixel for each patch, the index only holds centres of patches
+            # lying inside the image
+            (image_ixs, centres) = self._pixel_index.sample(rng, batch_size, self._foreground_ratio)
+            rows = centres[:, 0] - self._patch_height // 2
+            cols = centres[:, 1] - self._patch_width // 2
+
+        # Extract the patches
+        (unique_ixs, inverse_ixs) = np.unique(image_ixs, return_inverse=True)
+        (images, ixs) = self._read(self._images, image_ixs, unique_ixs, inverse_ixs)
+        X = extract_patches(images, ixs, rows, cols, self._patch_height, self._patch_width)
+
+        (masks, ixs) = self._read(self._masks, image_ixs, unique_ixs, inverse_ixs)
+        Y = extract_patches(masks, ixs, rows, cols, self._patch_height, self._patch_width)
+
+        # Convert masks to the format produced by the segmentation model
+        if self._converter is not None:
+            Y = self._converter(Y, self._num_classes)
+
+        return X, Y
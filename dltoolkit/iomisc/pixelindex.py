@@ -0,0 +1,210 @@
+"""Index of the foreground pixels of a set of masks, used to sample patches centred on foreground (e.g. blood vessel)
+pixels more often than uniform sampling would. Foreground pixels usually cover a small share of each image, so
+uniformly sampled patches mostly hold background.
+
+Only pixels that can be the centre of a patch lying entirely inside the image are used, so patches never have to be
+moved inside the image (which would shift their centre off the sampled pixel). For each image the index holds the flat
+coordinates of its foreground centres, drawing one is a single array lookup. Background covers most of each image, so
+its centres are stored as runs of consecutive flat coordinates inside the optional field of view (FOV), together with
+the cumulative number of centres at the end of each run. Drawing a background centre is a random number and a binary
+search of the run holding it.
+
+Building the index requires a pass over all masks, so the index of masks stored in a HDF5 file is stored in a file next
+to it (see cached_pixel_index) and is only rebuilt when the masks file, the FOV, the threshold or the patch size
+change.
+"""
+from .hdf5cache import get_handle_cache
+from .fingerprint import file_fingerprint
+import numpy as np
+import h5py
+import os
+
+# Constants
+INDEX_FILE_SUFFIX = "_pixel_index_"
+
+
+def _centre_bounds(spatial_shape, patch_shape):
+    """Return the first and last centre along each axis of patches lying entirely inside the image"""
+    patch_shape = patch_shape if patch_shape is not None else tuple(1 for _ in spatial_shape)
+
+    return [(p // 2, s - p + p // 2) for (s, p) in zip(spatial_shape, patch_shape)]
+
+
+class PixelIndex:
+    """Flat coordinates of the foreground centres of each image, and runs of the background centres of each image
+
+    Attributes:
+        spatial_shape: shape of an image or volume, excluding any channels
+        patch_shape: shape of the patches centred on the pixels, None for single pixels
+        foreground: flat coordinates of the foreground centres of all images, image after image, in increasing order
+        foreground_offsets: foreground[foreground_offsets[i]:foreground_offsets[i + 1]] belong to image i
+        background_starts: flat coordinate of the first centre of each background run, image after image
+        background_ends: number of background centres in all runs up to and including each run
+        background_offsets: the background centres of image i are numbered from background_offsets[i] up to
+        background_offsets[i + 1] in the runs
+    """
+    def __init__(self, spatial_shape, patch_shape, foreground, foreground_offsets, background_starts, background_ends,
+                 background_offsets):
+        self.spatial_shape = tuple(int(s) for s in spatial_shape)
+        self.patch_shape = tuple(int(p) for p in patch_shape) if patch_shape is not None else None
+        self.foreground = foreground
+        self.foreground_offsets = foreground_offsets
+        self.background_starts = background_starts
+        self.background_ends = background_ends
+        self.background_offsets = background_offsets
+
+        # Images without any centres inside the FOV are never sampled
+        self._fg_counts = np.diff(foreground_offsets)
+        self._bg_counts = np.diff(background_offsets)
+        self._valid_images = np.flatnonzero(self._fg_counts + self._bg_counts > 0)
+        self._run_firsts = np.concatenate([[0], background_ends[:-1]]).astype(np.int64)
+
+    @classmethod
+    def build(cls, masks, fov=None, spatial_ndim=2, threshold=0.0, patch_shape=None):
+        """
+        Build the index, reading one mask at a time
+        :param masks: NumPy array or HDF5 data set of masks, e.g. with shape (N, height, width, 1)
+        :param fov: optional NumPy array or HDF5 data set of field of view masks with the same shape, pixels outside
+        the field of view are not used as centres
+        :param spatial_ndim: number of spatial dimensions, 2 for images or 3 for volumes. Any remaining dimensions
+        (e.g. channels) are combined, a pixel is foreground when any of its channels is
+        :param threshold: mask values above the threshold are foreground
+        :param patch_shape: spatial shape of the patches, only pixels at the centre of a patch lying entirely inside
+        the image are indexed. None to index all pixels
+        :return: PixelIndex
+        """
+        spatial_shape = tuple(masks.shape[1:1 + spatial_ndim])
+        bounds = _centre_bounds(spatial_shape, patch_shape)
+
+        if any(first > last for (first, last) in bounds):
+            raise ValueError("Patches are larger than the images", patch_shape, spatial_shape)
+
+        # Pixels that can be the centre of a patch
+        centres = np.zeros(spatial_shape, dtype=bool)
+        centres[tuple(slice(first, last + 1) for (first, last) in bounds)] = True
+
+        dtype = np.uint32 if int(np.prod(spatial_shape)) < 2**32 else np.int64
+        (foreground, run_starts, run_lengths, background_counts) = ([], [], [], [])
+
+        for i in range(masks.shape[0]):
+            mask = (np.asarray(masks[i]).reshape(spatial_shape + (-1,)) > threshold).any(axis=-1)
+            inside = centres
+
+            if fov is not None:
+                inside = (np.asarray(fov[i]).reshape(spatial_shape + (-1,)) > 0).any(axis=-1) & centres
+
+            foreground.append(np.flatnonzero(mask & inside).astype(dtype))
+
+            # Runs of consecutive background centres
+            edges = np.diff(np.concatenate([[0], (~mask & inside).ravel().astype(np.int8), [0]]))
+            (starts, stops) = (np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+            run_starts.append(starts.astype(dtype))
+            run_lengths.append(stops - starts)
+            background_counts.append(int(np.sum(stops - starts)))
+
+        foreground_offsets = np.concatenate([[0], np.cumsum([len(c) for c in foreground])]).astype(np.int64)
+        background_offsets = np.concatenate([[0], np.cumsum(background_counts)]).astype(np.int64)
+
+        return cls(spatial_shape, patch_shape, np.concatenate(foreground), foreground_offsets,
+                   np.concatenate(run_starts), np.cumsum(np.concatenate(run_lengths)).astype(np.int64),
+                   background_offsets)
+
+    @classmethod
+    def load(cls, group):
+        """Load an index stored in a HDF5 group"""
+        patch_shape = group.attrs["patch_shape"] if len(group.attrs["patch_shape"]) > 0 else None
+
+        return cls(group.attrs["spatial_shape"], patch_shape,
+                   *[group[name][()] for name in ["foreground", "foreground_offsets", "background_starts",
+                                                  "background_ends", "background_offsets"]])
+
+    def save(self, group):
+        """Store the index in a HDF5 group"""
+        group.attrs["spatial_shape"] = self.spatial_shape
+        group.attrs["patch_shape"] = self.patch_shape if self.patch_shape is not None else ()
+
+        for name in ["foreground", "foreground_offsets", "background_starts", "background_ends", "background_offsets"]:
+            group.create_dataset(name, data=getattr(self, name))
+
+    def sample(self, rng, num_samples, foreground_ratio):
+        """
+        Draw random centres, each from a random image
+        :param rng: np.random.RandomState to use
+        :param num_samples: number of centres to draw
+        :param foreground_ratio: probability of drawing a foreground centre. Images without foreground (or background)
+        centres always provide a centre of the other class
+        :return: tuple holding a NumPy array with the image index of each centre and a NumPy array with shape
+        (num_samples, spatial_ndim) holding the coordinates of each centre
+        """
+        image_ixs = self._valid_images[rng.randint(0, len(self._valid_images), size=num_samples)]
+        (fg_counts, bg_counts) = (self._fg_counts[image_ixs], self._bg_counts[image_ixs])
+
+        # Pick the class of each centre
+        use_fg = rng.rand(num_samples) < foreground_ratio
+        use_fg = np.where(fg_counts == 0, False, np.where(bg_counts == 0, True, use_fg))
+
+        # Pick the number of the centre in its image, then look up its coordinate
+        picks = (rng.rand(num_samples) * np.where(use_fg, fg_counts, bg_counts)).astype(np.int64)
+        coords = np.empty(num_samples, dtype=np.int64)
+        coords[use_fg] = self.foreground[self.foreground_offsets[image_ixs[use_fg]] + picks[use_fg]]
+
+        bg_picks = self.background_offsets[image_ixs[~use_fg]] + picks[~use_fg]
+        runs = np.searchsorted(self.background_ends, bg_picks, side="right")
+        coords[~use_fg] = self.background_starts[runs] + (bg_picks - self._run_firsts[runs])
+
+        return image_ixs, np.stack(np.unravel_index(coords, self.spatial_shape), axis=1)
+
+
+def index_path(path, mask_key):
+    """Return the full path to the file holding the pixel index of the masks stored in a HDF5 file"""
+    (root, ext) = os.path.splitext(path)
+
+    return "{}{}{}{}".format(root, INDEX_FILE_SUFFIX, mask_key, ext)
+
+
+def cached_pixel_index(path, mask_key, fov_path=None, fov_key=None, spatial_ndim=2, threshold=0.0, patch_shape=None):
+    """
+    Return the pixel index of the masks stored in a HDF5 file. The index is loaded from the file next to it (see
+    index_path) when it was stored earlier for the same masks file (compared by fingerprint), FOV, threshold and patch
+    shape. Otherwise it is built and stored in that file
+    :param path: full path to the HDF5 file holding the masks
+    :param mask_key: name of the masks data set
+    :param fov_path: full path to the HDF5 file holding the field of view masks, None to index all pixels
+    :param fov_key: name of the field of view data set, None to use mask_key
+    :param spatial_ndim: number of spatial dimensions, 2 for images or 3 for volumes
+    :param threshold: mask values above the threshold are foreground
+    :param patch_shape: spatial shape of the patches, see PixelIndex.build
+    :return: PixelIndex
+    """
+    cache_path = index_path(path, mask_key)
+    fov_key = fov_key if fov_key is not None else mask_key
+    fov_id = "" if fov_path is None else "{}:{}:{}".format(os.path.realpath(fov_path), fov_key,
+                                                           file_fingerprint(fov_path))
+    attrs = {"mask_fingerprint": file_fingerprint(path), "fov": fov_id, "threshold": threshold,
+             "spatial_ndim": spatial_ndim, "patch_shape": tuple(patch_shape) if patch_shape is not None else ()}
+
+    # Use the stored index if it was built for the same masks, and holds the background runs
+    if os.path.exists(cache_path):
+        with h5py.File(cache_path, "r") as f:
+            if "background_starts" in f and \
+                    all(k in f.attrs and np.array_equal(f.attrs[k], v) for (k, v) in attrs.items()):
+                return PixelIndex.load(f)
+
+    with get_handle_cache().open(path) as f:
+        if fov_path is None:
+            index = PixelIndex.build(f[mask_key], None, spatial_ndim, threshold, patch_shape)
+        else:
+            with get_handle_cache().open(fov_path) as f_fov:
+                index = PixelIndex.build(f[mask_key], f_fov[fov_key], spatial_ndim, threshold, patch_shape)
+
+    # The folder may be read-only, the index is then built again next time
+    try:
+        with h5py.File(cache_path, "w") as f:
+            index.save(f)
+
+            for (k, v) in attrs.items():
+                f.attrs[k] = v
+    except OSError:
+        pass
+
+    return index
@@ -0,0 +1,141 @@
+"""Prepare batches ahead of the training loop using background threads or processes. Batches are returned in their
+original order and the number of batches being prepared or waiting to be consumed is bounded.
+
+Worker processes are forked from the training process. Each worker re-opens the generator's HDF5 files after the fork
+(see the generators' _reopen method), so no HDF5 handles are shared between processes.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import multiprocessing as mp
+import numpy as np
+
+# Generator used by the current worker process
+_worker_owner = None
+
+
+def _init_worker(owner):
+    """Initialise a worker process: re-open the owner's files and give the worker its own random state"""
+    global _worker_owner
+    _worker_owner = owner
+    _worker_owner._reopen()
+    np.random.seed()
+
+
+def _call_in_worker(method_name, args):
+    """Call a method of the owner in a worker process"""
+    return getattr(_worker_owner, method_name)(*args)
+
+
+class Prefetcher:
+    """Call a batch loading method of a generator (the owner) in the background for a sequence of arguments
+
+    Attributes:
+        num_batches: maximum number of batches being prepared or waiting to be consumed
+        num_workers: number of worker threads or processes
+        use_processes: True to use worker processes (requires the fork start method), False to use threads
+    """
+    def __init__(self, owner, method_name, num_batches, num_workers=1, use_processes=False):
+        """
+        Initialise the class
+        :param owner: generator object the method belongs to, it must have a _reopen() method when processes are used
+        :param method_name: name of the method preparing a single batch
+        :param num_batches: maximum number of batches prepared ahead
+        :param num_workers: number of worker threads or processes
+        :param use_processes: True to use worker processes, False to use threads
+        """
+        self.num_batches = max(1, num_batches)
+        self.num_workers = num_workers
+        self.use_processes = use_processes
+        self._owner = owner
+        self._method_name = method_name
+        self._pending = deque()
+
+        # A fork Pool rather than a ProcessPoolExecutor, which only accepts an initializer as of Python 3.7
+        if use_processes:
+            self._pool = mp.get_context("fork").Pool(num_workers, initializer=_init_worker, initargs=(owner,))
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def _submit(self, args):
+        if self.use_processes:
+            return self._pool.apply_async(_call_in_worker, (self._method_name, args))
+
+        return self._executor.submit(getattr(self._owner, self._method_name), *args)
+
+    def _result(self, pending):
+        """Wait for a batch submitted earlier"""
+        return pending.get() if self.use_processes else pending.result()
+
+    def imap(self, args_iter):
+        """
+        Prepare batches in the background
+        :param args_iter: iterable of argument tuples, one per batch, it is consumed lazily
+        :return: generator yielding the batches in order, the workers are shut down when it is closed
+        """
+        try:
+            for args in args_iter:
+                self._pending.append(self._submit(args))
+
+                # Wait for the oldest batch once the maximum number of batches is in flight
+                if len(self._pending) > self.num_batches:
+                    yield self._result(self._pending.popleft())
+
+            while len(self._pending) > 0:
+                yield self._result(self._pending.popleft())
+        finally:
+            self.close()
+
+    def close(self):
+        """Cancel batches that were not started yet and shut down the workers"""
+        if self.use_processes:
+            # Batches still being prepared are discarded
+            self._pending.clear()
+            self._pool.terminate()
+            self._pool.join()
+            return
+
+        while len(self._pending) > 0:
+            self._pending.popleft().cancel()
+
+        self._executor.shutdown(wait=True)
+
+
+class PrefetchingGenerator:
+    """Mixin of the generators that can prepare batches in the background. A single batch is prepared by the
+    generator's _load_batch method, _advance (see ResumableGenerator) is called when a batch is handed out"""
+    def _init_prefetch(self, prefetch, prefetch_workers, prefetch_processes):
+        """
+        Initialise background batch preparation
+        :param prefetch: number of batches prepared ahead in the background, 0 to prepare batches when they are
+        requested
+        :param prefetch_workers: number of threads or processes preparing batches
+        :param prefetch_processes: True to prepare batches in forked worker processes, False to use threads
+        """
+        self._prefetch = prefetch
+        self._prefetch_workers = prefetch_workers
+        self._prefetch_processes = prefetch_processes
+        self._prefetchers = set()
+
+    def _generate(self, batches):
+        """Generate the batches loaded for a sequence of _load_batch argument tuples"""
+        if self._prefetch == 0:
+            for args in batches:
+                batch = self._load_batch(*args)
+                self._advance()
+                yield batch
+        else:
+            prefetcher = Prefetcher(self, "_load_batch", self._prefetch, self._prefetch_workers,
+                                    self._prefetch_processes)
+            self._prefetchers.add(prefetcher)
+
+            try:
+                for batch in prefetcher.imap(batches):
+                    self._advance()
+                    yield batch
+            finally:
+                self._prefetchers.discard(prefetcher)
+
+    def _stop_prefetch(self):
+        """Stop background batch preparation, called before the generator's files are closed"""
+        for prefetcher in list(self._prefetchers):
+            prefetcher.close()
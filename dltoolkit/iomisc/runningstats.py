@@ -0,0 +1,107 @@
+"""Per-channel data set statistics (mean, variance, minimum, maximum and a histogram of values) that are updated one
+batch of records at a time, so they can be calculated while a data set is being written without a separate pass
+over the data. The mean and variance use Welford's algorithm in the batch-wise form by Chan et al., which is
+numerically stable for very large data sets.
+"""
+import numpy as np
+
+# Attribute names used to store the statistics on a HDF5 data set
+STAT_PREFIX = "stat_"
+STAT_COUNT = "stat_count"
+STAT_MEAN = "stat_mean"
+STAT_VAR = "stat_var"
+STAT_STD = "stat_std"
+STAT_MIN = "stat_min"
+STAT_MAX = "stat_max"
+STAT_HIST = "stat_hist"
+STAT_HIST_EDGES = "stat_hist_edges"
+
+HIST_BINS = 256
+HIST_RANGE = (0, 256)
+STATS_BLOCK_SIZE = 2 ** 22      # maximum number of values converted to float64 at a time
+
+
+class RunningStatistics:
+    """Running per-channel statistics, the channel is the last dimension of each record
+
+    Attributes:
+        count: number of values seen per channel
+        mean: per-channel mean
+        min: per-channel minimum
+        max: per-channel maximum
+        hist: per-channel histogram, shape (# of channels, hist_bins)
+        hist_edges: histogram bin edges
+    """
+    def __init__(self, num_channels, hist_bins=HIST_BINS, hist_range=HIST_RANGE):
+        """
+        Initialise the class
+        :param num_channels: number of channels, i.e. the size of the last dimension of each record
+        :param hist_bins: number of histogram bins
+        :param hist_range: (lower, upper) range of the histogram, values outside the range are not counted
+        """
+        self.num_channels = num_channels
+        self.hist_range = hist_range
+
+        self.count = 0
+        self.mean = np.zeros(num_channels, dtype=np.float64)
+        self._m2 = np.zeros(num_channels, dtype=np.float64)          # sum of squared differences from the mean
+        self.min = np.full(num_channels, np.inf)
+        self.max = np.full(num_channels, -np.inf)
+        self.hist = np.zeros((num_channels, hist_bins), dtype=np.int64)
+        self.hist_edges = np.linspace(hist_range[0], hist_range[1], hist_bins + 1)
+
+    def update(self, records):
+        """
+        Update the statistics with a batch of records
+        :param records: NumPy array of records, e.g. with shape (# of images, height, width, # of channels)
+        """
+        values = records.reshape(-1, self.num_channels)
+
+        # Convert to float64 in blocks to limit the size of the temporary arrays
+        block_rows = max(1, STATS_BLOCK_SIZE // self.num_channels)
+
+        for i in range(0, values.shape[0], block_rows):
+            self._update_block(values[i:i + block_rows].astype(np.float64))
+
+    def _update_block(self, values):
+        """Merge the statistics of a 2D block of values (# of values, # of channels) into the running statistics"""
+        block_count = values.shape[0]
+        block_mean = values.mean(axis=0)
+        block_m2 = ((values - block_mean) ** 2).sum(axis=0)
+
+        # Combine the running and block mean/variance
+        total = self.count + block_count
+        delta = block_mean - self.mean
+        self.mean += delta * block_count / total
+        self._m2 += block_m2 + delta ** 2 * self.count * block_count / total
+        self.count = total
+
+        self.min = np.minimum(self.min, values.min(axis=0))
+        self.max = np.maximum(self.max, values.max(axis=0))
+
+        for c in range(self.num_channels):
+            self.hist[c] += np.histogram(values[:, c], bins=self.hist.shape[1], range=self.hist_range)[0]
+
+    @property
+    def variance(self):
+        """Per-channel (population) variance"""
+        return self._m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        """Per-channel standard deviation"""
+        return np.sqrt(self.variance)
+
+    def to_attrs(self, attrs):
+        """
+        Store the statistics as HDF5 attributes
+        :param attrs: attribute manager of a HDF5 data set, i.e. dataset.attrs
+        """
+        attrs[STAT_COUNT] = self.count
+        attrs[STAT_MEAN] = self.mean
+        attrs[STAT_VAR] = self.variance
+        attrs[STAT_STD] = self.std
+        attrs[STAT_MIN] = self.min
+        attrs[STAT_MAX] = self.max
+        attrs[STAT_HIST] = self.hist
+        attrs[STAT_HIST_EDGES] = self.hist_edges
@@ -0,0 +1,274 @@
+"""Chunk-aware shuffling of HDF5 data sets. Reading records in a fully random order from a chunked HDF5 data set is
+very slow, as every record requires a separate read of (at least) one whole chunk. Instead:
+
+- the data set is split into blocks of consecutive records, typically one chunk per block, and the order of the blocks
+  is shuffled
+- the shuffled blocks are grouped into pools of pool_size records, the records in each pool are shuffled. The
+  generators size the pools in bytes (pool_bytes) and derive the number of records from the record size, so a pool of
+  large records (e.g. 3D volumes) holds fewer of them (see pool_records)
+
+Each block is read from disc in one go, so records are read at close to sequential speed while the order of the
+records is close to random. BlockReader reads the records of a batch block by block, keeping the blocks of the current
+pool in memory.
+
+The final batch of an epoch holds fewer records when the number of records is not a multiple of the batch size. It is
+either kept, dropped, or padded to a full batch with records from the start of the epoch's order.
+
+In data-parallel training each of world_size processes (ranks) reads its own share of every epoch: all ranks determine
+the same epoch order (which requires a common seed) and each takes one contiguous segment of it (see shard_order). As
+the order is made up of shuffled blocks and pools, a rank only reads the blocks in its own segment.
+"""
+from collections import OrderedDict
+import numpy as np
+
+# Constants
+POOL_BYTES = 256 * 2**20    # default memory budget of the records shuffled together
+VLEN_RECORD_BYTES = 2**16   # assumed size of a variable-length record (e.g. an encoded image)
+PARTIAL_BATCH_MODES = ("keep", "drop", "pad")
+MAX_SEED = 2**31 - 1
+
+
+def epoch_rng(seed, *keys):
+    """
+    Create the random number generator used for one epoch (and optionally one worker)
+    :param seed: base seed, None for a non-reproducible generator
+    :param keys: additional non-negative integers the stream depends on, e.g. the epoch number
+    :return: np.random.RandomState
+    """
+    if seed is None:
+        return np.random.RandomState()
+
+    return np.random.RandomState([seed] + [int(k) for k in keys])
+
+
+def batch_seed(seed, *keys):
+    """
+    Derive an integer seed from a base seed and keys like epoch_rng() does, for code that only accepts an integer seed
+    (e.g. ImageDataGenerator.flow) or runs in another process
+    :param seed: base seed, None for a non-reproducible seed
+    :param keys: additional non-negative integers the seed depends on, e.g. the epoch number and batch index
+    :return: integer seed
+    """
+    return int(epoch_rng(seed, *keys).randint(MAX_SEED))
+
+
+def chunk_records(dataset, default):
+    """Return the number of records per chunk of a data set, or the default for unchunked data sets"""
+    chunks = getattr(dataset, "chunks", None)
+    return chunks[0] if chunks else default
+
+
+def record_nbytes(dataset):
+    """Return the number of bytes of a single record of a data set, variable-length records are assumed to hold
+    VLEN_RECORD_BYTES"""
+    dtype = np.dtype(dataset.dtype)
+
+    if dtype.hasobject:
+        return VLEN_RECORD_BYTES
+
+    return int(np.prod(dataset.shape[1:])) * dtype.itemsize
+
+
+def pool_records(pool_bytes, datasets):
+    """
+    Return the number of records shuffled together
+    :param pool_bytes: memory budget of a pool
+    :param datasets: data sets read together (e.g. features and labels), a pool holds their records
+    :return: number of records per pool, at least one
+    """
+    return max(1, int(pool_bytes) // max(1, sum(record_nbytes(d) for d in datasets)))
+
+
+def block_shuffled_order(num_records, block_size, pool_size=None, rng=None):
+    """
+    Determine the order in which the records of a data set are read during one epoch
+    :param num_records: number of records in the data set
+    :param block_size: number of consecutive records per block, i.e. the number of records per chunk
+    :param pool_size: number of records shuffled together (see pool_records), rounded down to a whole number of blocks
+    (at least one). None to shuffle all records together
+    :param rng: np.random.RandomState to use, e.g. created by epoch_rng()
+    :return: NumPy array of record indices
+    """
+    rng = rng if rng is not None else np.random.RandomState()
+    block_size = max(1, int(block_size))
+    pool_size = pool_size if pool_size is not None else num_records
+    blocks_per_pool = max(1, pool_size // block_size)
+
+    # Shuffle the order of the blocks
+    block_starts = np.arange(0, num_records, block_size)
+    rng.shuffle(block_starts)
+
+    # Shuffle the records inside each pool of blocks
+    order = []
+
+    for p in range(0, len(block_starts), blocks_per_pool):
+        pool = np.concatenate([np.arange(s, min(s + block_size, num_records))
+                               for s in block_starts[p:p + blocks_per_pool]])
+        rng.shuffle(pool)
+        order.append(pool)
+
+    return np.concatenate(order) if len(order) > 0 else np.arange(0)
+
+
+def epoch_order(num_records, epoch, shuffle=False, block_size=1, pool_size=None, seed=None):
+    """
+    Determine the order in which the records of a data set are read during an epoch
+    :param num_records: number of records in the data set
+    :param epoch: epoch number, the order is reproducible for a given seed and epoch
+    :param shuffle: False to read the records sequentially, True to shuffle them (see block_shuffled_order)
+    :param block_size: number of consecutive records per block
+    :param pool_size: number of records shuffled together, None to shuffle all records together
+    :param seed: base seed, None for a different order every time
+    :return: NumPy array of record indices
+    """
+    if not shuffle:
+        return np.arange(num_records)
+
+    return block_shuffled_order(num_records, block_size, pool_size, epoch_rng(seed, epoch))
+
+
+def check_shard(rank, world_size, shuffle, seed):
+    """Raise a ValueError if the sharding arguments of a generator are invalid"""
+    if not 0 <= rank < world_size:
+        raise ValueError("The rank must be between 0 and world_size - 1", rank, world_size)
+
+    if world_size > 1 and shuffle and seed is None:
+        raise ValueError("All ranks must shuffle with the same seed", rank, world_size)
+
+
+def shard_size(num_records, world_size=1):
+    """Return the number of records each of world_size ranks reads per epoch"""
+    return -(-num_records // world_size)
+
+
+def shard_order(order, rank=0, world_size=1):
+    """
+    Return the segment of an epoch's order read by one rank. When the number of records is not a multiple of
+    world_size the final segment is padded with records from the start of the order, so all ranks read the same number
+    of records (and run the same number of steps)
+    :param order: NumPy array of record indices, the same for all ranks
+    :param rank: index of this rank (0 <= rank < world_size)
+    :param world_size: number of ranks
+    :return: NumPy array of record indices
+    """
+    if world_size == 1:
+        return order
+
+    size = shard_size(len(order), world_size)
+
+    return np.take(order, np.arange(rank * size, (rank + 1) * size), mode="wrap")
+
+
+def num_batches(num_records, batch_size, partial_batch="keep"):
+    """
+    Return the number of batches per epoch
+    :param num_records: number of records in the data set
+    :param batch_size: batch size
+    :param partial_batch: "keep" to keep a final batch holding fewer records, "drop" to drop it, "pad" to pad it
+    :return: number of batches
+    """
+    if partial_batch not in PARTIAL_BATCH_MODES:
+        raise ValueError("Invalid partial batch mode", partial_batch, PARTIAL_BATCH_MODES)
+
+    if partial_batch == "drop":
+        return num_records // batch_size
+
+    return (num_records + batch_size - 1) // batch_size
+
+
+def batch_indices(order, index, batch_size, partial_batch="keep"):
+    """
+    Return the record indices of one batch of an epoch
+    :param order: NumPy array of record indices in the order they are read during the epoch
+    :param index: index of the batch
+    :param batch_size: batch size
+    :param partial_batch: "keep", "drop" or "pad", see num_batches(). A padded batch continues at the start of the
+    order
+    :return: NumPy array of record indices
+    """
+    start = index * batch_size
+
+    if partial_batch == "pad" and start + batch_size > len(order):
+        return np.take(order, np.arange(start, start + batch_size), mode="wrap")
+
+    return order[start:start + batch_size]
+
+
+class BlockReader:
+    """Read records from a data set (h5py data set or any object supporting slicing) in the order given, one block of
+    consecutive records at a time. The most recently read blocks are kept in memory, so every block of a pool is only
+    read once. A contiguous, increasing range of records is read with a single slice instead.
+
+    Attributes:
+        dataset: data set to read from
+        block_size: number of consecutive records per block
+        max_blocks: maximum number of blocks kept in memory
+    """
+    def __init__(self, dataset, block_size, pool_size=None, batch_size=1):
+        """
+        Initialise the class
+        :param dataset: data set to read from
+        :param block_size: number of consecutive records per block, i.e. the number of records per chunk
+        :param pool_size: number of records shuffled together, None for as many records of the data set as fit in
+        POOL_BYTES
+        :param batch_size: maximum number of records read at a time
+        """
+        self.dataset = dataset
+        self.block_size = max(1, int(block_size))
+        pool_size = pool_size if pool_size is not None else pool_records(POOL_BYTES, [dataset])
+
+        # Keep all blocks of the pools a single batch can span in memory
+        blocks_per_pool = max(1, pool_size // self.block_size)
+        self.max_blocks = (batch_size // max(1, blocks_per_pool * self.block_size) + 2) * blocks_per_pool
+        self._blocks = OrderedDict()
+
+    def _block(self, block_ix):
+        """Return a block, reading it if it is not in memory"""
+        if block_ix in self._blocks:
+            self._blocks.move_to_end(block_ix)
+        else:
+            start = block_ix * self.block_size
+            self._blocks[block_ix] = self.dataset[start:start + self.block_size]
+
+            if len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+
+        return self._blocks[block_ix]
+
+    def read(self, indices, out=None):
+        """
+        Read records
+        :param indices: NumPy array of record indices
+        :param out: optional NumPy array to read the records into, it must hold exactly len(indices) records
+        :return: NumPy array holding the records in the order of the indices
+        """
+        indices = np.asarray(indices)
+        start = int(indices[0]) if len(indices) > 0 else 0
+
+        # Records held in memory are gathered directly, always returning a copy
+        if isinstance(self.dataset, np.ndarray):
+            return np.take(self.dataset, indices, axis=0, out=out)
+
+        # Sequential reads do not need the block cache, h5py data sets read straight into the output array
+        if np.array_equal(indices, np.arange(start, start + len(indices))):
+            if out is None:
+                return self.dataset[start:start + len(indices)]
+            elif hasattr(self.dataset, "read_direct") and out.flags.c_contiguous and len(indices) > 0:
+                self.dataset.read_direct(out, np.s_[start:start + len(indices)])
+            else:
+                out[...] = self.dataset[start:start + len(indices)]
+
+            return out
+
+        block_ixs = indices // self.block_size
+
+        for block_ix in np.unique(block_ixs):
+            block = self._block(int(block_ix))
+            mask = block_ixs == block_ix
+
+            if out is None:
+                out = np.empty((len(indices),) + block.shape[1:], dtype=block.dtype)
+
+            out[mask] = block[indices[mask] - block_ix * self.block_size]
+
+        return out
@@ -0,0 +1,199 @@
+"""Generate batches of sub-volumes of 3D volumes (e.g. MRA patient volumes with shape (slices, height, width,
+# of channels)) and the corresponding sub-volumes of their masks. Each sub-volume is read from the HDF5 file with a
+single hyperslab selection straight into the batch array, so whole volumes are never loaded into memory and the data
+sets may be larger than RAM. Comes in two modes:
+
+- strided: every epoch covers all sub-volumes on a regular grid with a given stride (a final position is added on each
+  axis so the volumes are fully covered), optionally in a shuffled order. With world_size > 1 each rank reads its own
+  segment of the grid
+- random: patches_per_epoch sub-volumes are sampled at random positions, optionally centred on a foreground voxel with
+  probability foreground_ratio (see PixelIndex)
+
+Like RandomPatchGenerator, the positions of batch b during epoch e are drawn from a random stream derived from (seed,
+worker, e, b), so batches are reproducible no matter which thread or process prepares them.
+"""
+from .patchgenerator import PatchGeneratorBase
+from .sampling import epoch_rng, epoch_order, num_batches, batch_indices
+from .sampling import check_shard, shard_order, shard_size
+import numpy as np
+import itertools
+
+
+def grid_starts(size, patch_size, stride):
+    """
+    Return the start positions of patches on a regular grid along one axis, the final patch ends at the last position
+    :param size: size of the axis
+    :param patch_size: patch size along the axis
+    :param stride: distance between the starts of consecutive patches
+    :return: list of start positions
+    """
+    starts = list(range(0, size - patch_size + 1, stride))
+
+    if starts[-1] != size - patch_size:
+        starts.append(size - patch_size)
+
+    return starts
+
+
+class SubVolumeGenerator(PatchGeneratorBase):
+    """Generator reading sub-volumes of volumes and the corresponding sub-volumes of their masks"""
+    def __init__(self, volumes, masks, patch_dim, batch_size, num_classes=2, converter=None, feat_key="X",
+                 mask_key=None, stride=None, shuffle=True, patches_per_epoch=None, seed=None, worker=0,
+                 fixed_patches=False, partial_batch="keep", dim_reorder=None, foreground_ratio=None, fov=None,
+                 fov_key=None, mask_threshold=0.0, rdcc_nbytes=None, prefetch=0, prefetch_workers=1,
+                 prefetch_processes=False, rank=0, world_size=1):
+        """
+        Initialise the generator
+        :param volumes: full path to the HDF5 file holding the volumes with shape (N, depth, height, width, # of
+        channels), or a NumPy array with that shape
+        :param masks: full path to the HDF5 file holding the masks, a NumPy array of masks or None if the masks are
+        stored in the same HDF5 file as the volumes
+        :param patch_dim: sub-volume size, either an integer for cubes or a (depth, height, width) tuple
+        :param batch_size: number of sub-volumes per batch
+        :param num_classes: number of classes, passed to the converter
+        :param converter: function converting a batch of mask sub-volumes to the format produced by the model
+        :param feat_key: name of the volumes data set
+        :param mask_key: name of the masks data set, None to use feat_key for a separate masks file or "Y" when the
+        masks are stored in the volumes file
+        :param stride: distance between sub-volumes on the grid, either an integer or a (depth, height, width) tuple.
+        None to sample random sub-volumes instead
+        :param shuffle: True to read the grid's sub-volumes in a different random order every epoch (strided mode)
+        :param patches_per_epoch: number of random sub-volumes per epoch (random mode)
+        :param seed: seed of the random positions and orders, None for different ones every run
+        :param worker: index of this worker, each worker samples different sub-volumes (random mode)
+        :param fixed_patches: True to sample the same sub-volumes every epoch, e.g. for validation (random mode)
+        :param partial_batch: "keep", "drop" or "pad" the final batch of an epoch when it holds fewer sub-volumes
+        :param dim_reorder: order the dimensions of the batches are transposed to, e.g. (0, 2, 3, 1, 4) for models
+        expecting (N, height, width, depth, # of channels), None to keep the order
+        :param foreground_ratio: fraction of the random sub-volumes centred on a foreground voxel, None to sample
+        positions uniformly (random mode)
+        :param fov: full path to the HDF5 file holding field of view masks or a NumPy array of them, None to use all
+        voxels. Only used with a foreground_ratio
+        :param fov_key: name of the field of view data set, None to use mask_key
+        :param mask_threshold: mask values above the threshold are foreground
+        :param rdcc_nbytes: chunk cache size in bytes, None to use the HDF5 default
+        :param prefetch: number of batches prepared ahead in the background, 0 to prepare batches when they are
+        requested
+        :param prefetch_workers: number of threads or processes preparing batches
+        :param prefetch_processes: True to prepare batches in forked worker processes, False to use threads
+        :param rank: index of this process when the grid is shared by world_size processes (strided mode)
+        :param world_size: number of processes each reading a disjoint segment of the grid every epoch, the final
+        segment is padded with sub-volumes from the start of the epoch. All processes must use the same seed when
+        shuffling. In random mode give each process its own worker index instead
+        """
+        if stride is None and patches_per_epoch is None:
+            raise ValueError("Either a stride or the number of patches per epoch must be provided")
+
+        check_shard(rank, world_size, shuffle and stride is not None, seed)
+
+        self._patch_shape = tuple(patch_dim for _ in range(3)) if np.isscalar(patch_dim) else tuple(patch_dim)
+        self._batch_size = batch_size
+        self._num_classes = num_classes
+        self._converter = converter
+        self._shuffle = shuffle
+        self._init_state(seed)
+        self._worker = worker
+        self._fixed_patches = fixed_patches
+        self._partial_batch = partial_batch
+        self._dim_reorder = dim_reorder
+        self._rank = rank
+        self._world_size = world_size
+
+        # Background batch preparation
+        self._init_prefetch(prefetch, prefetch_workers, prefetch_processes)
+
+        # The volumes are opened as the base class' images
+        self._init_sources(volumes, masks, feat_key, mask_key, rdcc_nbytes, foreground_ratio, fov, fov_key,
+                           mask_threshold, self._patch_shape)
+
+        self._num_volumes = self._images.shape[0]
+        self._volume_shape = tuple(self._images.shape[1:4])
+
+        if tuple(self._masks.shape[:4]) != tuple(self._images.shape[:4]):
+            raise ValueError("The volumes and masks differ in number or size", self._images.shape, self._masks.shape)
+
+        if any(p > s for (p, s) in zip(self._patch_shape, self._volume_shape)):
+            raise ValueError("Sub-volumes are larger than the volumes", self._patch_shape, self._volume_shape)
+
+        # Positions (volume, depth, row, column) of the sub-volumes on the grid
+        self._grid = None
+        self._order = (None, None)
+
+        if stride is not None:
+            strides = tuple(stride for _ in range(3)) if np.isscalar(stride) else tuple(stride)
+            starts = [grid_starts(s, p, st) for (s, p, st) in zip(self._volume_shape, self._patch_shape, strides)]
+            self._grid = np.array(list(itertools.product(range(self._num_volumes), *starts)), dtype=np.int64)
+            self._patches_per_epoch = shard_size(len(self._grid), world_size)
+        else:
+            self._patches_per_epoch = patches_per_epoch
+
+    def steps_per_epoch(self):
+        """Return the number of batches per epoch"""
+        return num_batches(self._patches_per_epoch, self._batch_size, self._partial_batch)
+
+    def _patch_positions(self, epoch, index):
+        """Return the (volume, depth, row, column) positions of the sub-volumes of a batch"""
+        if self._grid is not None:
+            # The order of the grid's sub-volumes is determined once per epoch
+            (order_epoch, order) = self._order
+
+            if order_epoch != epoch:
+                order = shard_order(epoch_order(len(self._grid), epoch, self._shuffle, seed=self._seed), self._rank,
+                                    self._world_size)
+                self._order = (epoch, order)
+
+            return self._grid[batch_indices(order, index, self._batch_size, self._partial_batch)]
+
+        rng = epoch_rng(self._seed, self._worker, 0 if self._fixed_patches else epoch, index)
+        batch_size = self._batch_size if self._partial_batch == "pad" else \
+            min(self._batch_size, self._patches_per_epoch - index * self._batch_size)
+
+        if self._pixel_index is None:
+            # Pick a random volume and a random corner for each sub-volume
+            corners = [rng.randint(0, s - p + 1, size=batch_size)
+                       for (s, p) in zip(self._volume_shape, self._patch_shape)]
+            return np.stack([rng.randint(0, self._num_volumes, size=batch_size)] + corners, axis=1)
+
+        # Pick a foreground or background centre voxel for each sub-volume, the index only holds centres of
+        # sub-volumes lying inside the volume
+        (volume_ixs, centres) = self._pixel_index.sample(rng, batch_size, self._foreground_ratio)
+        corners = [centres[:, i] - p // 2 for (i, p) in enumerate(self._patch_shape)]
+
+        return np.stack([volume_ixs] + corners, axis=1)
+
+    def _state_loaded(self):
+        """Determine the order of the grid's sub-volumes again, the seed may have changed"""
+        self._order = (None, None)
+
+    def _read(self, dataset, positions):
+        """Read the sub-volumes at the given positions into a new batch array"""
+        out = np.empty((len(positions),) + self._patch_shape + tuple(dataset.shape[4:]), dtype=dataset.dtype)
+
+        with self._read_lock:
+            for (i, (v, z, y, x)) in enumerate(positions):
+                selection = np.s_[v, z:z + self._patch_shape[0], y:y + self._patch_shape[1], x:x + self._patch_shape[2]]
+
+                if isinstance(dataset, np.ndarray):
+                    out[i] = dataset[selection]
+                else:
+                    # Hyperslab read straight into the batch array
+                    dataset.read_direct(out, source_sel=selection, dest_sel=np.s_[i])
+
+        return out
+
+    def _load_batch(self, epoch, index):
+        """Read the sub-volumes of a single batch"""
+        positions = self._patch_positions(epoch, index)
+
+        X = self._read(self._images, positions)
+        Y = self._read(self._masks, positions)
+
+        if self._dim_reorder is not None:
+            X = np.transpose(X, axes=self._dim_reorder)
+            Y = np.transpose(Y, axes=self._dim_reorder)
+
+        # Convert masks to the format produced by the segmentation model
+        if self._converter is not None:
+            Y = self._converter(Y, self._num_classes)
+
+        return X, Y
@@ -3,6 +3,7 @@
 Code is based on the excellent book "Deep Learning for Computer Vision" by PyImageSearch available on:
 https://www.pyimagesearch.com/deep-learning-computer-vision-python-book/
 """
+from .resize import resize_batch
 import cv2
 import numpy as np
 
@@ -62,3 +63,44 @@ class CropPreprocessor:
             crops.extend(mirrors)
 
         return np.array(crops)
+
+    def preprocess_batch(self, images, out=None):
+        """
+        Perform patch extraction on a batch of images of the same size
+        :param images: NumPy array of images with shape (N, height, width, # of channels)
+        :param out: optional NumPy array to write the crops to
+        :return: NumPy array with shape (N, # of crops, img_height, img_width, # of channels) containing the crops
+        """
+        (height, width) = images.shape[1:3]
+
+        # Determine the image's corners and center crop
+        crop_width = int(0.5 * (width - self.img_width))
+        crop_height = int(0.5 * (height - self.img_height))
+        corners = [
+            [0, 0, self.img_width, self.img_height],                            # top left
+            [width - self.img_width, 0, width, self.img_height],                # top right
+            [width - self.img_width, height - self.img_height, width, height],  # bottom right
+            [0, height - self.img_height, self.img_width, height],              # bottom left
+            [crop_width, crop_height, width - crop_width, height - crop_height]  # center
+        ]
+
+        num_crops = len(corners) * (2 if self.flip_horiz else 1)
+
+        if out is None:
+            out = np.empty((len(images), num_crops, self.img_height, self.img_width) + images.shape[3:],
+                           dtype=images.dtype)
+
+        # Get the crops of all images at once, only crops of a different size need resizing
+        for (i, (x_start, y_start, x_end, y_end)) in enumerate(corners):
+            crops = images[:, y_start:y_end, x_start:x_end]
+
+            if crops.shape[1:3] != (self.img_height, self.img_width):
+                crops = resize_batch(crops, self.img_width, self.img_height, self.inter)
+
+            out[:, i] = crops
+
+        # Create the horizontal flips if required
+        if self.flip_horiz:
+            out[:, len(corners):] = out[:, :len(corners), :, ::-1]
+
+        return out
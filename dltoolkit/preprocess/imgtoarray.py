@@ -2,6 +2,8 @@
 image_data_format setting located in ~/.keras/keras.json
 """
 from keras.preprocessing.image import img_to_array
+from keras import backend as K
+import numpy as np
 
 
 class ImgToArrayPreprocessor:
@@ -20,3 +22,26 @@ class ImgToArrayPreprocessor:
         :return: image data converted to the required dimension ordering
         """
         return img_to_array(image, data_format=self.format)
+
+    def preprocess_batch(self, images, out=None):
+        """
+        Perform the conversion on a batch of images
+        :param images: NumPy array of images with shape (N, height, width) or (N, height, width, # of channels)
+        :param out: optional NumPy array to write the converted images to
+        :return: image data converted to the required dimension ordering
+        """
+        data_format = self.format if self.format is not None else K.image_data_format()
+        images = np.asarray(images)
+
+        # Add the channel axis of grayscale images, then move it if required
+        if images.ndim == 3:
+            images = images[..., np.newaxis]
+
+        if data_format == "channels_first":
+            images = images.transpose(0, 3, 1, 2)
+
+        if out is None:
+            return images.astype(K.floatx())
+
+        out[...] = images
+        return out
@@ -1,4 +1,5 @@
 """Scale pixel intensities to be bin the range [0, 1]"""
+import numpy as np
 
 
 class NormalisePreprocessor:
@@ -9,3 +10,12 @@ class NormalisePreprocessor:
         :return: normalised image data
         """
         return image.astype("float") / 255.0
+
+    def preprocess_batch(self, images, out=None):
+        """
+        Preprocess a batch of images by normalising the data
+        :param images: NumPy array of images
+        :param out: optional NumPy array to write the normalised images to
+        :return: normalised image data
+        """
+        return np.divide(images, 255.0, out=out, dtype="float")
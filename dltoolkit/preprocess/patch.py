@@ -4,9 +4,13 @@ Code is based on the excellent book "Deep Learning for Computer Vision" by PyIma
 https://www.pyimagesearch.com/deep-learning-computer-vision-python-book/
 """
 from sklearn.feature_extraction.image import extract_patches_2d
+import numpy as np
 
 
 class PatchPreprocessor:
+    # The patch positions can be drawn from RandomStates passed by the caller, see ParallelPreprocessor
+    uses_rng = True
+
     def __init__(self, img_width, img_height):
         """
         Initialise the class
@@ -16,10 +20,41 @@ class PatchPreprocessor:
         self.img_width = img_width
         self.img_height = img_height
 
-    def preprocess(self, image):
+    def preprocess(self, image, rng=None):
         """
         Perform patch extraction
         :param image: image data
+        :param rng: optional np.random.RandomState to draw the patch position from, None to use NumPy's global one
         :return: one random patch
         """
-        return extract_patches_2d(image, (self.img_height, self.img_width), max_patches=1)[0]
+        return extract_patches_2d(image, (self.img_height, self.img_width), max_patches=1, random_state=rng)[0]
+
+    def preprocess_batch(self, images, out=None, rngs=None):
+        """
+        Perform patch extraction on a batch of images of the same size
+        :param images: NumPy array of images with shape (N, height, width) or (N, height, width, # of channels)
+        :param out: optional NumPy array to write the patches to
+        :param rngs: optional list holding the np.random.RandomState to draw the patch position of each image from,
+        None to use NumPy's global one
+        :return: one random patch per image
+        """
+        (num_images, height, width) = images.shape[:3]
+
+        # Pick a random top left corner for each image, then gather all patches at once
+        if rngs is None:
+            y = np.random.randint(0, height - self.img_height + 1, size=num_images)
+            x = np.random.randint(0, width - self.img_width + 1, size=num_images)
+        else:
+            corners = [(rng.randint(0, height - self.img_height + 1), rng.randint(0, width - self.img_width + 1))
+                       for rng in rngs]
+            (y, x) = np.array(corners, dtype=np.int64).reshape(-1, 2).T
+
+        rows = (y[:, np.newaxis] + np.arange(self.img_height))[:, :, np.newaxis]
+        cols = (x[:, np.newaxis] + np.arange(self.img_width))[:, np.newaxis, :]
+        patches = images[np.arange(num_images)[:, np.newaxis, np.newaxis], rows, cols]
+
+        if out is None:
+            return patches
+
+        out[...] = patches
+        return out
@@ -1,7 +1,28 @@
 """Resize an image to a new height, width and interpolation method"""
+import numpy as np
 import cv2
 
 
+def resize_batch(images, width, height, interp=cv2.INTER_AREA, out=None):
+    """
+    Resize a batch of images of the same size, used by the preprocess_batch methods of the preprocessors
+    :param images: NumPy array of images with shape (N, height, width) or (N, height, width, # of channels)
+    :param width: desired image width
+    :param height: desired image height
+    :param interp: desired interpolation method
+    :param out: optional NumPy array to write the resized images to
+    :return: NumPy array holding the resized images
+    """
+    if out is None:
+        out = np.empty((len(images), height, width) + images.shape[3:], dtype=images.dtype)
+
+    # OpenCV resizes one image at a time, it drops the channel axis of single channel images
+    for (i, image) in enumerate(images):
+        out[i] = cv2.resize(image, (width, height), interpolation=interp).reshape(out.shape[1:])
+
+    return out
+
+
 class ResizePreprocessor:
     """Resize an image to a new height, width and interpolation method
 
@@ -29,3 +50,13 @@ class ResizePreprocessor:
         :return: preprocessed image data
         """
         return cv2.resize(image, (self.width, self.height), interpolation=self.interp)
+
+    def preprocess_batch(self, images, out=None):
+        """
+        Resize a batch of images of the same size
+
+        :param images: NumPy array of images with shape (N, height, width, # of channels)
+        :param out: optional NumPy array to write the preprocessed images to
+        :return: preprocessed image data
+        """
+        return resize_batch(images, self.width, self.height, self.interp, out)
@@ -3,6 +3,7 @@
 Code is based on the excellent book "Deep Learning for Computer Vision" by PyImageSearch available on:
 https://www.pyimagesearch.com/deep-learning-computer-vision-python-book/
 """
+from .resize import resize_batch
 import cv2
 import imutils
 
@@ -43,3 +44,29 @@ class ResizeWithAspectRatioPreprocessor:
 
         # Finally resize
         return cv2.resize(image, (self.width, self.height), interpolation=self.inter)
+
+    def preprocess_batch(self, images, out=None):
+        """
+        Perform the resize operation on a batch of images of the same size, all images are cropped in the same way
+        :param images: NumPy array of images with shape (N, height, width, # of channels)
+        :param out: optional NumPy array to write the resized images to
+        :return: resized image data
+        """
+        (height, width) = images.shape[1:3]
+        crop_width = 0
+        crop_height = 0
+
+        # Determine whether to crop the height or width, the intermediate size matches imutils.resize
+        if width < height:
+            images = resize_batch(images, self.width, int(height * self.width / float(width)), self.inter)
+            crop_height = int((images.shape[1] - self.height)/2.0)
+        else:
+            images = resize_batch(images, int(width * self.height / float(height)), self.height, self.inter)
+            crop_width = int((images.shape[2] - self.width)/2.0)
+
+        # Crop the images
+        (height, width) = images.shape[1:3]
+        images = images[:, crop_height:height - crop_height, crop_width:width - crop_width]
+
+        # Finally resize
+        return resize_batch(images, self.width, self.height, self.inter, out)
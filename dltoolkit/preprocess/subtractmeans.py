@@ -1,4 +1,6 @@
 """Subtract mean RGB values (calculated across the entire data set) from an individual image"""
+from ..iomisc import HDF5Reader
+import numpy as np
 import cv2
 
 
@@ -14,6 +16,19 @@ class SubtractMeansPreprocessor:
         self.G_mean = G_mean
         self.B_mean = B_mean
 
+    @classmethod
+    def from_hdf5(cls, db_path, feat_key="X"):
+        """
+        Create the preprocessor using the channel means HDF5Writer stored for a data set (see compute_stats). Images
+        are assumed to be in OpenCV's BGR channel order
+        :param db_path: full path to the HDF5 file
+        :param feat_key: name of the features data set
+        :return: SubtractMeansPreprocessor instance
+        """
+        (B_mean, G_mean, R_mean) = HDF5Reader().load_stats(db_path, feat_key)["mean"][:3]
+
+        return cls(R_mean, G_mean, B_mean)
+
     def preprocess(self, image):
         """
         Perform the subtraction
@@ -27,3 +42,14 @@ class SubtractMeansPreprocessor:
         B -= self.B_mean
 
         return cv2.merge([B, G, R])
+
+    def preprocess_batch(self, images, out=None):
+        """
+        Perform the subtraction on a batch of images
+        :param images: NumPy array of images with shape (N, height, width, 3) in BGR channel order
+        :param out: optional NumPy array to write the converted images to
+        :return: converted
+        """
+        means = np.array([self.B_mean, self.G_mean, self.R_mean], dtype="float32")
+
+        return np.subtract(images, means, out=out, dtype="float32")
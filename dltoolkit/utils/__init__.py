@@ -1,7 +1,7 @@
 """Various utility functions and constants"""
 from .constants import CIFAR10_CLASS_NAMES, ANIMALS_CLASS_NAMES, FLOWERS17_CLASS_NAMES
 from .generic import str2bool, ranked_accuracy, model_architecture_to_file, list_images, model_summary_to_file
-from .callback import TrainingMonitor
+from .callback import TrainingMonitor, GeneratorCheckpoint, load_generator_state
 from .visual import plot_training_history, model_performance, visualise_results
 from .utils_rnn import *
 from .foundation import *
@@ -1,6 +1,11 @@
-"""Keras BaseLogger callback producing figures after each epoch"""
+"""Keras callbacks:
+
+- TrainingMonitor, a BaseLogger callback producing figures after each epoch
+- GeneratorCheckpoint, storing the state of a training data generator after each epoch so an interrupted run can be
+  resumed with exactly the batches it would have produced (see dltoolkit.iomisc.generatorstate)
+"""
 from .visual import plot_training_history
-from keras.callbacks import BaseLogger
+from keras.callbacks import BaseLogger, Callback
 import json, os
 
 
@@ -38,3 +43,48 @@ class TrainingMonitor(BaseLogger):
         # Create and save the accuracy/loss plot
         if len(self.hist["loss"]) > 1:
             plot_training_history(self.hist, len(self.hist["loss"]), False, self.fig_path)
+
+
+class GeneratorCheckpoint(Callback):
+    def __init__(self, generator, state_path, steps_per_epoch=None):
+        """
+        Initialise the callback
+        :param generator: generator (or Sequence) providing the training batches, it must have a state_dict() method
+        :param state_path: full path to the JSON file the state is written to, e.g. next to the model checkpoint. May
+        contain named formatting options like ModelCheckpoint's file path, e.g. "state-{epoch:02d}.json"
+        :param steps_per_epoch: number of batches per Keras epoch, None to use the number of steps Keras was given
+        """
+        super(GeneratorCheckpoint, self).__init__()
+        self.generator = generator
+        self.state_path = state_path
+        self.steps_per_epoch = steps_per_epoch
+
+    def on_epoch_end(self, epoch, logs={}):
+        # Keras takes batches from the generator ahead of training on them, so the position of the next batch is
+        # determined by the number of batches trained on
+        steps = self.steps_per_epoch if self.steps_per_epoch is not None else self.params.get("steps")
+        state = self.generator.state_dict((epoch + 1) * steps if steps is not None else None)
+
+        # Write the state to a temporary file first, so an interrupted write never leaves a truncated file
+        path = self.state_path.format(epoch=epoch + 1, **logs)
+        tmp_path = path + ".tmp"
+
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"initial_epoch": epoch + 1, "generator": state}))
+
+        os.replace(tmp_path, path)
+
+
+def load_generator_state(generator, state_path):
+    """
+    Restore the state of a generator stored by GeneratorCheckpoint
+    :param generator: generator (or Sequence) the state was stored for, created with the same arguments
+    :param state_path: full path to the JSON file holding the state
+    :return: the number of epochs completed, to be passed to fit_generator as initial_epoch
+    """
+    with open(state_path) as f:
+        checkpoint = json.loads(f.read())
+
+    generator.load_state_dict(checkpoint["generator"])
+
+    return checkpoint["initial_epoch"]
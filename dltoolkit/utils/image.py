@@ -1,3 +1,4 @@
+from ..iomisc import HDF5Reader
 import numpy as np
 import cv2
 
@@ -31,10 +32,12 @@ def standardise_single(image):
     return imgs_standardised.astype(np.float32)
 
 
-def standardise(imgs):
-    """Standardise an array of images, values are float32 between 0.0 and 1.0"""
-    imgs_std = np.std(imgs)
-    imgs_mean = np.mean(imgs)
+def standardise(imgs, mean=None, std=None):
+    """Standardise an array of images, values are float32 between 0.0 and 1.0. The mean and standard deviation are
+    calculated from the images unless they are provided, e.g. the per-channel statistics stored by HDF5Writer (see
+    standardise_from_hdf5)"""
+    imgs_std = np.std(imgs) if std is None else std
+    imgs_mean = np.mean(imgs) if mean is None else mean
     imgs_standardised = (imgs-imgs_mean)/imgs_std
 
     for i in range(imgs.shape[0]):
@@ -44,6 +47,14 @@ def standardise(imgs):
     return imgs_standardised.astype(np.float32)
 
 
+def standardise_from_hdf5(imgs, db_path, key="X"):
+    """Standardise an array of images read from a HDF5 data set using the per-channel mean and standard deviation
+    HDF5Writer stored for the data set (see compute_stats), instead of calculating them from the images"""
+    stats = HDF5Reader().load_stats(db_path, key)
+
+    return standardise(imgs, stats["mean"], stats["std"])
+
+
 def normalise_single(img):
     """Normalise an array of RGB images, values are float16 between 0.0 and 255.0"""
     img_normalized = ((img - np.min(img)) / (np.max(img)-np.min(img)))
@@ -1,16 +1,13 @@
 """Train AlexNet on the Kaggle Cats & Dogs data set"""
-import json
 import os
-import numpy as np
 import progressbar
-import cv2
 import matplotlib
 matplotlib.use("Agg")
 
 from settings import settings_cats_and_dogs as settings
 
 from dltoolkit.preprocess import ResizeWithAspectRatioPreprocessor, ImgToArrayPreprocessor, ResizePreprocessor, PatchPreprocessor, SubtractMeansPreprocessor
-from dltoolkit.iomisc import HDF5Generator, HDF5Writer
+from dltoolkit.iomisc import HDF5Generator, HDF5Writer, ParallelLoader, ImageFileLoader
 from dltoolkit.nn.cnn import AlexNetNN
 from dltoolkit.utils import TrainingMonitor, ranked_accuracy, model_architecture_to_file
 from dltoolkit.utils.generic import list_images
@@ -55,14 +52,17 @@ def create_hdf5():
             (VAL_SET, val_paths, val_labels, settings.VAL_SET_HDF5_PATH),
             (TEST_SET, test_paths, test_labels, settings.TEST_SET_HDF5_PATH)]
 
-    # Init image resizer and channel averages
+    # Init image resizer, images are decoded and resized by a pool of worker processes
     aspect_process = ResizeWithAspectRatioPreprocessor(settings.IMG_DIM_WIDTH, settings.IMG_DIM_HEIGHT)
-    (R_vals, G_vals, B_vals) = ([], [], [])
+    loader = ParallelLoader(ImageFileLoader([aspect_process]), num_workers=settings.NUM_WORKERS)
 
-    # Write each dataset to HDF5
+    # Write each dataset to HDF5, unreadable images are skipped. Images are encoded (see HDF5_ENCODE_EXT) while the
+    # next ones are decoded. The channel means of the training set are stored in its HDF5 file
     for (dt, paths, labels, output_path) in data:
-        writer = HDF5Writer((len(paths), settings.IMG_DIM_WIDTH,
-                             settings.IMG_DIM_HEIGHT, settings.IMG_CHANNELS), output_path)
+        writer = HDF5Writer((None, settings.IMG_DIM_WIDTH,
+                             settings.IMG_DIM_HEIGHT, settings.IMG_CHANNELS), output_path,
+                            buf_size=settings.HDF5_BUF_SIZE, compute_stats=(dt == TRAIN_SET),
+                            async_flush=True, encode_ext=settings.HDF5_ENCODE_EXT)
 
         print("{}".format((len(paths), settings.IMG_DIM_WIDTH,
                              settings.IMG_DIM_HEIGHT, settings.IMG_CHANNELS)))
@@ -71,29 +71,12 @@ def create_hdf5():
         widgets = ["Creating HDF5 database ", progressbar.Percentage(), " ", progressbar.Bar(), " ", progressbar.ETA()]
         pbar = progressbar.ProgressBar(maxval=len(paths), widgets=widgets).start()
 
-        # Preprocess each image and write to hfd5. Keep track of mean RGB values for the training set
-        for (i, (path, label)) in enumerate(zip(paths, labels)):
-            image = cv2.imread(path)
-            image = aspect_process.preprocess(image)
-
-            if dt == TRAIN_SET:
-                (b, g, r) = cv2.mean(image)[:3]
-                R_vals.append(r)
-                G_vals.append(g)
-                B_vals.append(b)
-
-            writer.add([image], [label])
-            pbar.update(i)
+        # Preprocess each image and write to hfd5
+        loader.to_hdf5(writer, paths, labels, pbar=pbar)
 
         pbar.finish()
         writer.close()
 
-    # Save RGB means to disk
-    D = {"R": np.mean(R_vals), "G" : np.mean(G_vals), "B": np.mean(B_vals)}
-    f = open(settings.RGB_MEANS_PATH, "w")
-    f.write(json.dumps(D))
-    f.close()
-
 
 def create_model():
     """Create and compile the AlexNet model"""
@@ -111,21 +94,21 @@ def train_alexnet(model):
                              height_shift_range=0.2, shear_range=0.15,
                              horizontal_flip=True, fill_mode="nearest")
 
-    # Load RGB means
-    means = json.loads(open(settings.RGB_MEANS_PATH).read())
-
-    # Init preprocessors
+    # Init preprocessors, using the RGB means of the training set
     res_pre = ResizePreprocessor(AlexNetNN._img_width, AlexNetNN._img_height)
     patch_pre = PatchPreprocessor(AlexNetNN._img_width, AlexNetNN._img_height)
-    mean_pre = SubtractMeansPreprocessor(means["R"], means["G"], means["B"])
+    mean_pre = SubtractMeansPreprocessor.from_hdf5(settings.TRAIN_SET_HDF5_PATH)
     itoa_pre = ImgToArrayPreprocessor()
 
     # Init data generators
     train_gen = HDF5Generator(settings.TRAIN_SET_HDF5_PATH, batch_size=settings.BATCH_SIZE, augment=aug,
-                              preprocessors=[patch_pre, mean_pre, itoa_pre], num_classes=settings.NUM_CLASSES)
+                              preprocessors=[patch_pre, mean_pre, itoa_pre], num_classes=settings.NUM_CLASSES,
+                              shuffle=True, seed=settings.RANDOM_STATE, prefetch=settings.PREFETCH_BATCHES,
+                              preprocess_workers=settings.PREPROCESS_WORKERS)
 
     val_gen = HDF5Generator(settings.VAL_SET_HDF5_PATH, batch_size=settings.BATCH_SIZE, augment=aug,
-                            preprocessors=[res_pre, mean_pre, itoa_pre], num_classes=settings.NUM_CLASSES)
+                            preprocessors=[res_pre, mean_pre, itoa_pre], num_classes=settings.NUM_CLASSES,
+                            prefetch=settings.PREFETCH_BATCHES)
 
     # Train the model
     path = os.path.sep.join([settings.OUTPUT_PATH, "{}.png".format(os.getpid())])
@@ -160,12 +143,9 @@ def visualise_model(model):
 
 def evaluate_model():
     """test the model on the unseen test set"""
-    # Load RGB means
-    means = json.loads(open(settings.RGB_MEANS_PATH).read())
-
-    # Init preprocessors
+    # Init preprocessors, using the RGB means of the training set
     res_pre = ResizePreprocessor(AlexNetNN._img_width, AlexNetNN._img_height)
-    mean_pre = SubtractMeansPreprocessor(means["R"], means["G"], means["B"])
+    mean_pre = SubtractMeansPreprocessor.from_hdf5(settings.TRAIN_SET_HDF5_PATH)
     itoa_pre = ImgToArrayPreprocessor()
 
     # Load the saved model
@@ -142,7 +142,7 @@ def apply_masks(preds, masks):
 
 def load_masks(mask_path, key, patch_dim):
     """Load masks and crop and extend them like the images and ground truths were"""
-    masks = HDF5Reader().load_hdf5(mask_path, key).astype("uint8")
+    masks = HDF5Reader().read_into(mask_path, key, dtype=np.uint8)
 
     masks = crop_image(masks, masks.shape[1], masks.shape[2])
     masks, _, _ = extend_images(masks, patch_dim)
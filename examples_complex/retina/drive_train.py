@@ -27,7 +27,7 @@
 from settings import settings_drive as settings
 from drive_utils import perform_image_preprocessing, perform_groundtruth_preprocessing
 
-from dltoolkit.iomisc import HDF5Writer
+from dltoolkit.iomisc import ParallelLoader, RandomPatchGenerator, update_hdf5
 from dltoolkit.utils.generic import list_images, model_architecture_to_file, model_summary_to_file
 from dltoolkit.nn.segment import UNet_NN
 from dltoolkit.utils.visual import plot_training_history
@@ -37,141 +37,113 @@ from keras.callbacks import ModelCheckpoint, EarlyStopping, CSVLogger
 from keras.optimizers import SGD, Adam
 
 import numpy as np
-import os, progressbar, cv2, random, time
+import os, progressbar, cv2, time
+from functools import partial
 
 from PIL import Image                                   # for reading .gif images
 
 
-def convert_to_hdf5(img_path, img_shape, img_exts, key, ext):
+def load_image(img_path, img_shape, is_gif):
+    """
+    Load a single DRIVE image, ground truth or mask. Defined at module level so worker processes can use it
+    :param img_path: full path to the image
+    :param img_shape: shape of each image (width, height, # of channels)
+    :param is_gif: True for ground truths and masks, False for the actual images
+    :return: the image or None if it could not be read
+    """
+    if is_gif:
+        # Ground truth and masks are single colour channel .gif files
+        image = np.asarray(Image.open(img_path).convert("L"))
+        return image.reshape((img_shape[0],
+                              img_shape[1],
+                              img_shape[2]))
+    else:
+        # Actual images are .tiff files with three channels
+        return cv2.imread(img_path)
+
+
+def convert_to_hdf5(img_path, img_shape, img_exts, key, ext, num_workers=None, incremental=True):
     """
     Convert images present in `img_path` to HDF5 format. The HDF5 file is one sub folder up from where the
     images are located
     :param img_path: path to the folder containing images
     :param img_shape: shape of each image (width, height, # of channels)
+    :param num_workers: number of processes used to decode images, None for one per CPU
+    :param incremental: True to only decode images that were added or changed since the HDF5 file was created, False
+    to always convert all images
     :return: full path to the generated HDF5 file
     """
     output_path = os.path.join(os.path.dirname(img_path), os.path.basename(img_path)) + ext
     imgs_list = sorted(list(list_images(basePath=img_path, validExts=img_exts)))
 
-    # Prepare the HDF5 writer, which expects a label vector. Because this is a segmentation problem just pass None
-    hdf5_writer = HDF5Writer((len(imgs_list), img_shape[0], img_shape[1], img_shape[2]), output_path,
-                             feat_key=key,
-                             label_key=None,
-                             del_existing=True,
-                             buf_size=len(imgs_list)
-                             )
+    if not incremental and os.path.exists(output_path):
+        os.remove(output_path)
 
-    # Loop through all images
+    # Decode all new or changed images in parallel, they are written to the HDF5 file in their original order. The
+    # HDF5 writer expects a label vector, because this is a segmentation problem just pass None. Images that cannot
+    # be read are skipped
     widgets = ["Creating HDF5 database ", progressbar.Percentage(), " ", progressbar.Bar(), " ", progressbar.ETA()]
     pbar = progressbar.ProgressBar(maxval=len(imgs_list), widgets=widgets).start()
-    for i, img in enumerate(imgs_list):
-        if img_exts == ".gif":
-            # Ground truth and masks are single colour channel .gif files
-            image = np.asarray(Image.open(img).convert("L"))
-            image = image.reshape((img_shape[0],
-                                   img_shape[1],
-                                   img_shape[2]))
-        else:
-            # Actual images are .tiff files with three channels
-            image = cv2.imread(img)
-
-        hdf5_writer.add([image], None)
-        pbar.update(i)
-
+    loader = ParallelLoader(partial(load_image, img_shape=img_shape, is_gif=(img_exts == ".gif")),
+                            num_workers=num_workers)
+    (num_copied, num_loaded, num_removed) = update_hdf5(output_path, imgs_list, loader, img_shape,
+                                                        feat_key=key,
+                                                        label_key=None,
+                                                        buf_size=settings.HDF5_BUF_SIZE,
+                                                        pbar=pbar)
     pbar.finish()
-    hdf5_writer.close()
+
+    print("{}: {} unchanged, {} converted, {} removed".format(output_path, num_copied, num_loaded, num_removed))
 
     return output_path
 
 
-def perform_hdf5_conversion():
+def perform_hdf5_conversion(incremental=True):
     """Convert the training and test images, ground truths and masks to HDF5 format. For the DRIVE data set the
-    assumption is that filenames start with a number and that images/ground truths/masks share the same number
+    assumption is that filenames start with a number and that images/ground truths/masks share the same number. When
+    converting incrementally only images that were added or changed since the previous conversion are decoded
     """
     output_paths = []
 
     # Convert training images in each sub folder to a single HDF5 file
     output_paths.append(convert_to_hdf5(os.path.join(settings.TRAINING_PATH, settings.FOLDER_IMAGES),
                                         (settings.IMG_HEIGHT, settings.IMG_WIDTH, settings.IMG_CHANNELS_TIF),
-                                        img_exts=".tif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT))
+                                        img_exts=".tif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT,
+                                        num_workers=settings.NUM_WORKERS, incremental=incremental))
 
     # Training ground truths
     output_paths.append(convert_to_hdf5(os.path.join(settings.TRAINING_PATH, settings.FOLDER_MANUAL_1),
                                         (settings.IMG_HEIGHT, settings.IMG_WIDTH, settings.IMG_CHANNELS_GIF),
-                                        img_exts=".gif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT))
+                                        img_exts=".gif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT,
+                                        num_workers=settings.NUM_WORKERS, incremental=incremental))
 
     # Training masks
     output_paths.append(convert_to_hdf5(os.path.join(settings.TRAINING_PATH, settings.FOLDER_MASK),
                                         (settings.IMG_HEIGHT, settings.IMG_WIDTH, settings.IMG_CHANNELS_GIF),
-                                        img_exts=".gif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT))
+                                        img_exts=".gif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT,
+                                        num_workers=settings.NUM_WORKERS, incremental=incremental))
 
     # Do the same for the test images
     output_paths.append(convert_to_hdf5(os.path.join(settings.TEST_PATH, settings.FOLDER_IMAGES),
                                         (settings.IMG_HEIGHT, settings.IMG_WIDTH, settings.IMG_CHANNELS_TIF),
-                                        img_exts=".tif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT))
+                                        img_exts=".tif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT,
+                                        num_workers=settings.NUM_WORKERS, incremental=incremental))
 
     # Test ground truths
     output_paths.append(convert_to_hdf5(os.path.join(settings.TEST_PATH, settings.FOLDER_MANUAL_1),
                                         (settings.IMG_HEIGHT, settings.IMG_WIDTH, settings.IMG_CHANNELS_GIF),
-                                        img_exts=".gif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT))
+                                        img_exts=".gif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT,
+                                        num_workers=settings.NUM_WORKERS, incremental=incremental))
 
     # Test masks
     output_paths.append(convert_to_hdf5(os.path.join(settings.TEST_PATH, settings.FOLDER_MASK),
                                         (settings.IMG_HEIGHT, settings.IMG_WIDTH, settings.IMG_CHANNELS_GIF),
-                                        img_exts=".gif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT))
+                                        img_exts=".gif", key=settings.HDF5_KEY, ext=settings.HDF5_EXT,
+                                        num_workers=settings.NUM_WORKERS, incremental=incremental))
 
     return output_paths
 
 
-def generate_random_patches(imgs, ground_truths, num_rnd_patches, patch_dim, patch_channels, verbose=False):
-    """Random sample small patches from the preprocessed images and corresponding ground truths"""
-    start_time = time.time()
-
-    img_dim = imgs.shape[1]
-    patch_per_img = int(num_rnd_patches / imgs.shape[0])        # number of random patches to generate per image
-
-    # Placeholder arrays for the image patches and corresponding ground truth patches
-    patches = np.empty((num_rnd_patches, patch_dim, patch_dim, patch_channels))
-    patches_ground_truths = np.empty((num_rnd_patches, patch_dim, patch_dim, patch_channels))
-
-    # Loop over all images
-    total_patch_count = 0
-    for i in range(imgs.shape[0]):
-        # Sample random patches from each individual image
-        p = 0
-        while p < patch_per_img:
-            # Pick a random center point inside the original image
-            x = random.randint(0 + int(patch_dim/2), img_dim - int(patch_dim / 2))
-            y = random.randint(0 + int(patch_dim/2), img_dim - int(patch_dim / 2))
-
-            # Grab the patch from the original image and ground truth
-            img_patch = imgs[i,                                     # current image
-                   y - int(patch_dim/2):y + int(patch_dim/2),       # height
-                   x - int(patch_dim/2):x + int(patch_dim/2),       # width
-                   :]                                               # color channel
-            ground_truth_patch = ground_truths[i,
-                   y - int(patch_dim/2):y + int(patch_dim/2),
-                   x - int(patch_dim/2):x + int(patch_dim/2),
-                   :]
-
-            # Copy to the placeholders that will be returned from the function
-            patches[total_patch_count] = img_patch
-            patches_ground_truths[total_patch_count] = ground_truth_patch
-
-            total_patch_count+=1
-            p+=1
-
-    if verbose:
-        print("Elapsed time: {}".format(time.time() - start_time))
-
-    # Shuffle the data for good measure TODO: may not be required due to random patch generation
-    indices = np.arange(total_patch_count)
-    patches = patches[indices]
-    patches_ground_truths = patches_ground_truths[indices]
-
-    return patches, patches_ground_truths
-
-
 def convert_img_to_pred(ground_truths, num_model_channels, verbose=False):
     """Convert ground truth *images* into the shape of the *predictions* produced by the U-Net (the opposite of
     convert_pred_to_img_flatten in drive_test.py)
@@ -184,17 +156,9 @@ def convert_img_to_pred(ground_truths, num_model_channels, verbose=False):
     ground_truths = np.reshape(ground_truths, (ground_truths.shape[0], img_height * img_width))
     new_masks = np.empty((ground_truths.shape[0], img_height * img_width, num_model_channels))
 
-    for image in range(ground_truths.shape[0]):
-        if verbose and image % 1000 == 0:
-            print("{}/{}".format(image, ground_truths.shape[0]))
-
-        for pix in range(img_height*img_width):
-            if ground_truths[image, pix] == 0.:      # TODO: update for num_model_channels > 2
-                new_masks[image, pix, 0] = 1.0
-                new_masks[image, pix, 1] = 0.0
-            else:
-                new_masks[image, pix, 0] = 0.0
-                new_masks[image, pix, 1] = 1.0
+    # Background pixels belong to the first class, all other pixels to the second
+    new_masks[:, :, 0] = ground_truths == 0.                # TODO: update for num_model_channels > 2
+    new_masks[:, :, 1] = ground_truths != 0.
 
     if verbose:
         print("Elapsed time: {}".format(time.time() - start_time))
@@ -203,17 +167,8 @@ def convert_img_to_pred(ground_truths, num_model_channels, verbose=False):
 
 
 if __name__ == "__main__":
-    # Convert images to HDF5 format (without applying any preprocessing), this is only required once
-    if not settings.DEVELOPMENT:
-        # Hard code paths to the HDF5 files during development instead
-        hdf5_paths = ["../../data/DRIVE/training/images.hdf5",
-                        "../../data/DRIVE/training/1st_manual.hdf5",
-                        "../../data/DRIVE/training/mask.hdf5",
-                        "../../data/DRIVE/test/images.hdf5",
-                        "../../data/DRIVE/test/1st_manual.hdf5",
-                        "../../data/DRIVE/test/mask.hdf5"]
-    else:
-        hdf5_paths = perform_hdf5_conversion()
+    # Convert images to HDF5 format (without applying any preprocessing), only new or changed images are converted
+    hdf5_paths = perform_hdf5_conversion(incremental=settings.INCREMENTAL_HDF5)
 
     # Perform training image and ground truth pre-processing. All images are square and gray scale after this
     print("--- Pre-processing training images")
@@ -223,19 +178,39 @@ if __name__ == "__main__":
     training_ground_truths = perform_groundtruth_preprocessing(hdf5_paths[1],
                                                                settings.HDF5_KEY)
 
+    # Field of view masks, training patches are centred on pixels inside the field of view
+    training_fovs = perform_groundtruth_preprocessing(hdf5_paths[2],
+                                                      settings.HDF5_KEY)
+
     print("--- Showing example image and ground truth")
     cv2.imshow("Preprocessed image", training_imgs[0])
     cv2.waitKey(0)
     cv2.imshow("Preprocessed ground dtruth", training_ground_truths[0])
     cv2.waitKey(0)
 
-    # Generate random patches that will serve as the training set
-    print("\n--- Generating random training patches")
-    patch_imgs, patch_ground_truths = generate_random_patches(training_imgs, training_ground_truths,
-                                                              settings.PATCHES_NUM_RND,
-                                                              settings.PATCH_DIM,
-                                                              settings.PATCH_CHANNELS,
-                                                              settings.VERBOSE)
+    # Sample fresh random patches for every training batch, the validation patches are the same every epoch. Training
+    # patches are centred on a blood vessel pixel more often than uniform sampling would
+    print("\n--- Preparing random training patches")
+    num_val_patches = int(settings.PATCHES_NUM_RND * settings.TRAIN_VAL_SPLIT)
+    train_gen = RandomPatchGenerator(training_imgs, training_ground_truths,
+                                     settings.PATCH_DIM,
+                                     settings.BATCH_SIZE,
+                                     settings.PATCHES_NUM_RND - num_val_patches,
+                                     num_classes=settings.NUM_OUTPUT_CLASSES,
+                                     converter=convert_img_to_pred,
+                                     seed=settings.RANDOM_STATE,
+                                     prefetch=settings.PREFETCH_BATCHES,
+                                     foreground_ratio=settings.PATCH_FOREGROUND_RATIO,
+                                     fov=training_fovs)
+    val_gen = RandomPatchGenerator(training_imgs, training_ground_truths,
+                                   settings.PATCH_DIM,
+                                   settings.BATCH_SIZE,
+                                   num_val_patches,
+                                   num_classes=settings.NUM_OUTPUT_CLASSES,
+                                   converter=convert_img_to_pred,
+                                   seed=settings.RANDOM_STATE,
+                                   worker=1,
+                                   fixed_patches=True)
 
     # Instantiate the U-Net model
     unet = UNet_NN(img_height=settings.PATCH_DIM,
@@ -258,10 +233,7 @@ if __name__ == "__main__":
     model_summary_to_file(model, summ_path)
     model_architecture_to_file(unet.model, settings.OUTPUT_PATH + unet.title + "_DRIVE_training")
 
-    # Convert the random patches into the same shape as the predictions the U-net produces
-    print("--- \nEncoding training ground truths")
-    patch_ground_truths_conv = convert_img_to_pred(patch_ground_truths, settings.NUM_OUTPUT_CLASSES, settings.VERBOSE)
-
+    # The generators convert the ground truth patches into the same shape as the predictions the U-net produces
     # Train the model
     print("\n--- Start training")
     opt = Adam()
@@ -274,14 +246,17 @@ if __name__ == "__main__":
                  # TensorBoard(settings.OUTPUT_PATH + "/tensorboard", histogram_freq=1, batch_size=1)
                  ]
 
-    hist = model.fit(patch_imgs, patch_ground_truths_conv,
+    hist = model.fit_generator(train_gen.generator(),
+              steps_per_epoch=train_gen.steps_per_epoch(),
               epochs=settings.NUM_EPOCH,
-              batch_size=settings.BATCH_SIZE,
               verbose=1,
-              shuffle=True,
-              validation_split=settings.TRAIN_VAL_SPLIT,
+              validation_data=val_gen.generator(),
+              validation_steps=val_gen.steps_per_epoch(),
               callbacks=callbacks)
 
+    train_gen.close()
+    val_gen.close()
+
     print("\n--- Training complete")
 
     # Plot the training results - currently breaks if training stopped early
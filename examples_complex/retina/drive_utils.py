@@ -16,7 +16,7 @@ def crop_image(imgs, img_height, img_width):
 
 def perform_image_preprocessing(image_path, key, is_training=True):
     """Perform image pre-processing, resulting pixel values are between 0 and 1"""
-    imgs = HDF5Reader().load_hdf5(image_path, key).astype("uint8")
+    imgs = HDF5Reader().read_into(image_path, key, dtype=np.uint8)
 
     # Convert RGB to gray scale
     imgs = rgb_to_gray(imgs)
@@ -39,7 +39,7 @@ def perform_image_preprocessing(image_path, key, is_training=True):
 
 def perform_groundtruth_preprocessing(ground_truth_path, key, is_training=True):
     """Perform ground truth image pre-processing, resulting pixel values are between 0 and 1"""
-    imgs = HDF5Reader().load_hdf5(ground_truth_path, key).astype("uint8")
+    imgs = HDF5Reader().read_into(ground_truth_path, key, dtype=np.uint8)
 
     # Cut off top and bottom pixel rows to convert images to squares
     if is_training:
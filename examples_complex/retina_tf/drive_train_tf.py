@@ -1,7 +1,9 @@
 """Train the U-Net model on DRIVE training data using TensorFlow"""
 from settings import settings_drive as settings
 from drive_utils import perform_image_preprocessing, perform_groundtruth_preprocessing
-from drive_train import generate_random_patches, convert_img_to_pred
+from drive_train import convert_img_to_pred
+
+from dltoolkit.iomisc import RandomPatchGenerator
 
 import tensorflow as tf
 from sklearn.model_selection import train_test_split
@@ -152,13 +154,15 @@ if __name__ == "__main__":
     cv2.imshow("Preprocessed ground dtruth", training_ground_truths[0])
     cv2.waitKey(0)
 
-    # Generate random patches that will serve as the training set
+    # Generate random patches that will serve as the training set, all patches are sampled as a single batch
     print("\n--- Generating random training patches")
-    patch_imgs, patch_ground_truths = generate_random_patches(training_imgs, training_ground_truths,
-                                                              settings.PATCHES_NUM_RND,
-                                                              settings.PATCH_DIM,
-                                                              settings.PATCH_CHANNELS,
-                                                              settings.VERBOSE)
+    patch_gen = RandomPatchGenerator(training_imgs, training_ground_truths,
+                                     settings.PATCH_DIM,
+                                     settings.PATCHES_NUM_RND,
+                                     settings.PATCHES_NUM_RND,
+                                     seed=settings.RANDOM_STATE)
+    patch_imgs, patch_ground_truths = next(patch_gen.generator())
+    patch_gen.close()
 
     # Prepare some path strings
     uunet_title = "U-net_tf"
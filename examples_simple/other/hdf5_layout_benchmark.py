@@ -0,0 +1,84 @@
+"""Compare the file size and read throughput of HDF5Generator for different HDF5 data set layouts (contiguous,
+chunked, compressed) using a synthetic image data set
+
+Parameters:
+    -n=2048             number of images to write
+    -d=256              image width and height
+    -c=3                number of channels
+    -b=32               batch size used to read the data set
+    -o=../output        folder for the temporary HDF5 files
+
+Use the fastest layout for which the file size is acceptable as the settings for HDF5Writer.
+"""
+from dltoolkit.iomisc import HDF5Writer, HDF5Generator
+
+import numpy as np
+import argparse, os, time
+
+RANDOM_STATE = 122177
+
+# Layouts to compare, each entry holds the keyword arguments passed to HDF5Writer
+LAYOUTS = [("contiguous", {"chunks": False}),
+           ("chunked", {}),
+           ("chunked_lzf", {"compression": "lzf"}),
+           ("chunked_lzf_shuffle", {"compression": "lzf", "shuffle": True}),
+           ("chunked_gzip_1", {"compression": "gzip", "compression_opts": 1}),
+           ("chunked_gzip_4_shuffle", {"compression": "gzip", "compression_opts": 4, "shuffle": True})]
+
+
+def create_data_set(output_path, num_images, img_dim, img_channels, batch_size, layout):
+    """Write a synthetic data set using the layout provided and return the time it took"""
+    rng = np.random.RandomState(RANDOM_STATE)
+    start_time = time.time()
+
+    writer = HDF5Writer((num_images, img_dim, img_dim, img_channels), output_path, del_existing=True,
+                        buf_size=batch_size * 8, chunk_records=batch_size, dtype_feat=np.uint8, **layout)
+
+    for i in range(0, num_images, batch_size):
+        count = min(batch_size, num_images - i)
+
+        # Smooth gradients plus some noise, which compresses roughly like real images
+        imgs = np.linspace(0, 255, img_dim * img_dim * img_channels).reshape((img_dim, img_dim, img_channels))
+        imgs = (imgs[np.newaxis] + rng.randint(0, 32, (count, img_dim, img_dim, img_channels))) % 256
+        writer.add(imgs.astype(np.uint8), rng.randint(0, 2, count))
+
+    writer.close()
+
+    return time.time() - start_time
+
+
+def read_data_set(db_path, num_images, batch_size):
+    """Read the data set once using HDF5Generator and return the time it took"""
+    gen = HDF5Generator(db_path, batch_size=batch_size, rdcc_nbytes=64 * 1024 ** 2)
+    start_time = time.time()
+
+    for (X, Y) in gen.generator(num_epochs=1):
+        pass
+
+    elapsed = time.time() - start_time
+    gen.close()
+
+    return elapsed
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark HDF5 data set layouts.")
+    ap.add_argument("-n", "--num_images", type=int, default=2048, help="# of images to write")
+    ap.add_argument("-d", "--dim", type=int, default=256, help="image width and height")
+    ap.add_argument("-c", "--channels", type=int, default=3, help="# of channels")
+    ap.add_argument("-b", "--batch_size", type=int, default=32, help="batch size used to read the data set")
+    ap.add_argument("-o", "--output", type=str, default="../output", help="folder for the temporary HDF5 files")
+    args = vars(ap.parse_args())
+
+    print("{:>24s} {:>10s} {:>10s} {:>12s}".format("layout", "size (MB)", "write (s)", "read (img/s)"))
+
+    for (name, layout) in LAYOUTS:
+        db_path = os.path.join(args["output"], "benchmark_{}.hdf5".format(name))
+
+        write_time = create_data_set(db_path, args["num_images"], args["dim"], args["channels"],
+                                     args["batch_size"], layout)
+        read_time = read_data_set(db_path, args["num_images"], args["batch_size"])
+        size = os.path.getsize(db_path) / 1024 ** 2
+
+        print("{:>24s} {:>10.1f} {:>10.2f} {:>12.1f}".format(name, size, write_time, args["num_images"] / read_time))
+        os.remove(db_path)
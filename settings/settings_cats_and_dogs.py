@@ -3,7 +3,6 @@ DATA_PATH = "../data/kaggle_cats_and_dogs/train"       # Path to the original da
 MODEL_PATH = "../savedmodels/alexnet.model"            # Path to the saved model
 OUTPUT_PATH = "output"                              # Path to where other output is saved
 HISTORY_PATH = OUTPUT_PATH + "/history.json"        # Path to the training history JSON file
-RGB_MEANS_PATH = OUTPUT_PATH + "/cats_dogs_alexnet_rgb_means.json"            # Path to the mean RGB values
 
 TRAIN_SET_HDF5_PATH = "../data/kaggle_cats_and_dogs/hdf5/train.hdf5"   # Path to the training HDF5 dataset
 VAL_SET_HDF5_PATH = "../data/kaggle_cats_and_dogs/hdf5/val.hdf5"       # Path to the validation HDF5 dataset
@@ -18,6 +17,11 @@ RANDOM_STATE = 122177
 IMG_DIM_WIDTH = 256                                 # Image width to resize all images to
 IMG_DIM_HEIGHT = 256                                # Image height to resize all images to
 IMG_CHANNELS = 3                                    # Expected number of channels
+NUM_WORKERS = None                                  # Processes used to decode images, None for one per CPU
+HDF5_BUF_SIZE = 1024                                # Number of images kept in memory before writing them to HDF5
+HDF5_ENCODE_EXT = ".jpg"                            # Store images as JPEG bytes in HDF5, None to store pixels
+PREFETCH_BATCHES = 4                                # Batches prepared in the background during training
+PREPROCESS_WORKERS = 4                              # Processes preprocessing the images of each training batch
 
 # Training parameters
 NUM_EPOCHS = 15          # 70
@@ -9,6 +9,7 @@ FOLDER_IMAGES = "images"                            # retina images
 FOLDER_MASK = "mask"                                # masks
 HDF5_EXT = ".hdf5"
 HDF5_KEY = "image"
+HDF5_BUF_SIZE = 64                                  # number of images kept in memory before writing them to HDF5
 
 # Image dimensions
 IMG_HEIGHT = 584            # original image height (prior to any pre-processing)
@@ -20,6 +21,7 @@ IMG_CHANNELS_GIF = 1        # number of channels for the ground truths (gray sca
 PATCH_DIM = 48              # patch dimension (squares, i.e. width == height == PATCH_DIM)
 PATCH_CHANNELS = 1          # number of colour channels used for patches (gray scale)
 NUM_OUTPUT_CLASSES = 2      # number of classes the U-Net should identify
+PATCH_FOREGROUND_RATIO = 0.5    # fraction of the training patches centred on a blood vessel pixel
 
 # Training parameters
 PATCHES_NUM_RND = 2000      # total # of random patches to generate (i.e. for all images in the training set combined)
@@ -28,8 +30,11 @@ BATCH_SIZE = 1
 TRAIN_VAL_SPLIT = 0.1       # Percentage of training data to use for the validation set
 DROPOUT_RATE = 0.0          # Dropout rate used for all DropOut layers
 MOMENTUM = 0.99
+RANDOM_STATE = 42           # seed of the random training patches
+PREFETCH_BATCHES = 4        # batches of patches prepared in the background during training
 PRED_THRESHOLD = 0.5        # Pixel intensities that exceed the threshold are considered a positive detection
 
 # Other variables
 VERBOSE = True              # set to True for debugging print statements to the console
-DEVELOPMENT = True          # set to True to avoid converting data to HDF5 every run
+NUM_WORKERS = None          # number of processes used to decode images, None for one per CPU
+INCREMENTAL_HDF5 = True     # set to True to only convert new or changed images to HDF5, False to convert all images
@@ -10,6 +10,7 @@ FLDR_IMAGES = "images"                                  # folder with the images
 HDF5_EXT = ".h5"
 HDF5_KEY = "image"
 IMG_EXTENSION = ".jpg"
+HDF5_BUF_SIZE = 8                                       # number of volumes kept in memory before writing them to HDF5
 
 # Image dimensions
 IMG_HEIGHT = 256            # image height (after cropping)
@@ -1,5 +1,5 @@
 """Image handling and conversion methods for U-Net and 3D U-net models"""
-from dltoolkit.iomisc import HDF5Reader, HDF5Writer
+from dltoolkit.iomisc import HDF5Reader, ParallelLoader, update_hdf5
 from dltoolkit.utils.image import standardise_single
 from dltoolkit.utils.generic import list_images
 from sklearn.model_selection import train_test_split
@@ -7,9 +7,105 @@ from sklearn.model_selection import train_test_split
 import numpy as np
 import cv2
 import time, os, progressbar, argparse
+from functools import partial
+from itertools import chain
 import matplotlib.pyplot as plt
 
 
+# Image loading functions used by the worker processes that create HDF5 files
+def load_slice(img_path, img_shape, crop_height, crop_width, is_mask, mask_threshold, mask_value):
+    """
+    Read a single image or ground truth and apply the same preprocessing as during training
+    :param img_path: full path to the image
+    :param img_shape: shape of the image after cropping (height, width, channels)
+    :param crop_height: number of pixels to crop from both the top and the bottom
+    :param crop_width: number of pixels to crop from both the left and the right
+    :param is_mask: True for ground truths, False for images
+    :param mask_threshold: pixel intensities above this value are considered blood vessels (ground truths only)
+    :param mask_value: pixel intensity used for blood vessels (ground truths only)
+    :return: preprocessed image with shape img_shape or None if the image could not be read
+    """
+    image = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+
+    if image is None:
+        return None
+
+    # Crop to the region of interest
+    image = image[crop_height:image.shape[0] - crop_height, crop_width:image.shape[1] - crop_width]
+
+    # Apply pre-processing
+    if is_mask:
+        # Apply binary thresholding to ground truth masks
+        _, image = cv2.threshold(image, mask_threshold, mask_value, cv2.THRESH_BINARY)
+    else:
+        # Apply CLAHE histogram equalization
+        clahe = cv2.createCLAHE(clipLimit=2, tileGridSize=(16, 16))
+        image = clahe.apply(image)
+
+        # Standardise
+        image = standardise_single(image)
+
+    # Reshape from (height, width) to (height, width, 1)
+    return image.reshape((img_shape[0], img_shape[1], img_shape[2]))
+
+
+def slice_loader(settings, img_shape, is_mask):
+    """Return a picklable version of load_slice using the settings provided, for use with ParallelLoader"""
+    return partial(load_slice, img_shape=img_shape, crop_height=settings.IMG_CROP_HEIGHT,
+                   crop_width=settings.IMG_CROP_WIDTH, is_mask=is_mask,
+                   mask_threshold=settings.MASK_BINARY_THRESHOLD, mask_value=settings.MASK_BLOODVESSEL)
+
+
+class VolumeLoader:
+    """Load patient volumes, decoding the slices of all patients in parallel. Has the same imap method as
+    ParallelLoader so it can be used with update_hdf5
+    """
+    def __init__(self, settings, img_shape, img_exts, is_mask, num_workers=None):
+        """
+        Initialise the class
+        :param settings: holds settings
+        :param img_shape: shape of each slice (height, width, channels)
+        :param img_exts: image extensions to search for
+        :param is_mask: True for ground truths, False for images
+        :param num_workers: number of processes used to decode slices, None for one per CPU
+        """
+        self.slice_start = settings.SLICE_START
+        self.slice_end = settings.SLICE_END
+        self.img_shape = img_shape
+        self.img_exts = img_exts
+        self.loader = ParallelLoader(slice_loader(settings, img_shape, is_mask), num_workers=num_workers)
+
+    def imap(self, patients_list):
+        """
+        Load the volume in each patient folder
+        :param patients_list: list of paths to patient folders
+        :return: generator yielding one volume of shape (slices, height, width, channels) per patient
+        """
+        num_slices = self.slice_end - self.slice_start
+
+        # List the slices in each patient's folder. All slices are decoded in parallel and returned in their original
+        # order
+        slices_list = [sorted(list(list_images(basePath=p_folder, validExts=self.img_exts)))[self.slice_start:self.slice_end]
+                       for p_folder in patients_list]
+        slices = self.loader.imap(chain.from_iterable(slices_list))
+
+        # Loop through each patient subfolder
+        for imgs_list in slices_list:
+            imgs = np.zeros((num_slices,) + tuple(self.img_shape), dtype=np.float32)
+
+            # Collect each slice in the current patient's folder
+            for slice_ix, slice_img in enumerate(imgs_list):
+                image = next(slices)
+
+                if image is None:
+                    print("Skipping unreadable slice: {}".format(slice_img))
+                    continue
+
+                imgs[slice_ix] = image
+
+            yield imgs
+
+
 # 3D U-Net functions
 def load_training_3d(settings):
     """Load patient volumes and split them into a training and validation set
@@ -120,9 +216,10 @@ def load_images_3d(patients_list, img_shape, img_exts, settings, is_mask=False):
     return data
 
 
-def create_hdf5_db_3d(patients_list, dn_name, img_path, img_shape, img_exts, key, ext, settings, is_mask=False):
+def create_hdf5_db_3d(patients_list, dn_name, img_path, img_shape, img_exts, key, ext, settings, is_mask=False,
+                      num_workers=None, incremental=False):
     """Create a HDF5 file using a list of paths to patient subfolders to be written to the data set. An existing file is
-    overwritten.
+    overwritten, or updated when incremental is True.
     :param imgs_list: list of patient subfolders
     :param dn_name: becomes part of the HDF5 file name
     :param img_path: path to the location of the `images` and `groundtruths` subfolders
@@ -131,6 +228,9 @@ def create_hdf5_db_3d(patients_list, dn_name, img_path, img_shape, img_exts, key
     :param ext: extension of the HDF5 file name
     :param settings: holds settings
     :param is_mask: True if the ground truths data set is being created, False if not
+    :param num_workers: number of processes used to decode images, None for one per CPU
+    :param incremental: True to only load sources that were added or changed since the existing HDF5 file was created
+    (changes to the preprocessing settings are not detected), False to recreate the file
     :return: the full path to the HDF5 file.
     """
     # Do not do anything if the list of patient subfolders is empty
@@ -152,59 +252,24 @@ def create_hdf5_db_3d(patients_list, dn_name, img_path, img_shape, img_exts, key
     print("reading patient folders: ", patients_list)
     print("---")
 
-    # Prepare the HDF5 writer
-    hdf5_writer = HDF5Writer((len(patients_list), num_slices) + img_shape,
-                             output_path,
-                             feat_key=key,
-                             label_key=None,
-                             del_existing=True,
-                             buf_size=len(patients_list),
-                             # dtype_feat=np.float16 if not is_mask else np.uint8)
-                             dtype_feat = np.float32 if not is_mask else np.uint8)
-
-    # Prepare for CLAHE histogram equalization
-    clahe = cv2.createCLAHE(clipLimit=2, tileGridSize=(16, 16))
+    if not incremental and os.path.exists(output_path):
+        os.remove(output_path)
 
-    # Loop through all images
+    # Loop through all patient volumes, only new or changed volumes are loaded when updating an existing file
     widgets = ["Creating HDF5 database ", progressbar.Percentage(), " ", progressbar.Bar(), " ", progressbar.ETA()]
     pbar = progressbar.ProgressBar(maxval=len(patients_list), widgets=widgets).start()
-
-    # Loop through each patient subfolder
-    for patient_ix, p_folder in enumerate(patients_list):
-        imgs_list = sorted(list(list_images(basePath=p_folder, validExts=img_exts)))[settings.SLICE_START:settings.SLICE_END]
-        # imgs = np.zeros((num_slices, img_shape[0], img_shape[1], img_shape[2]), dtype=np.float16)
-        imgs = np.zeros((num_slices, img_shape[0], img_shape[1], img_shape[2]), dtype=np.float32)
-
-        # Read each slice in the current patient's folder
-        for slice_ix, slice_img in enumerate(imgs_list):
-            image = cv2.imread(slice_img, cv2.IMREAD_GRAYSCALE)
-
-            # Crop to the region of interest
-            image = image[settings.IMG_CROP_HEIGHT:image.shape[0] - settings.IMG_CROP_HEIGHT,
-                    settings.IMG_CROP_WIDTH:image.shape[1] - settings.IMG_CROP_WIDTH]
-
-            # Apply any preprocessing
-            if is_mask:
-                # Apply binary thresholding to ground truth masks
-                _, image = cv2.threshold(image, settings.MASK_BINARY_THRESHOLD, settings.MASK_BLOODVESSEL,
-                                         cv2.THRESH_BINARY)
-            else:
-                # Apply CLAHE histogram equalization
-                image = clahe.apply(image)
-
-                # Standardise
-                image = standardise_single(image)
-
-            # Reshape from (height, width) to (height, width, 1)
-            image = image.reshape((img_shape[0], img_shape[1], img_shape[2]))
-            imgs[slice_ix] = image
-
-        # Write all slices for the current patient
-        hdf5_writer.add([imgs], None)
-        pbar.update(patient_ix)
-
+    loader = VolumeLoader(settings, img_shape, img_exts, is_mask, num_workers=num_workers)
+    (num_copied, num_loaded, num_removed) = update_hdf5(output_path, patients_list, loader,
+                                                        (num_slices,) + img_shape,
+                                                        feat_key=key,
+                                                        label_key=None,
+                                                        buf_size=settings.HDF5_BUF_SIZE,
+                                                        # dtype_feat=np.float16 if not is_mask else np.uint8)
+                                                        dtype_feat=np.float32 if not is_mask else np.uint8,
+                                                        pbar=pbar)
     pbar.finish()
-    hdf5_writer.close()
+
+    print("{} unchanged, {} loaded, {} removed".format(num_copied, num_loaded, num_removed))
 
     return output_path
 
@@ -259,9 +324,10 @@ def convert_pred_to_img_3d(pred, threshold=0.5, verbose=False):
 
 
 # U-Net functions
-def create_hdf5_db(imgs_list, dn_name, img_path, img_shape, key, ext, settings, is_mask=False):
+def create_hdf5_db(imgs_list, dn_name, img_path, img_shape, key, ext, settings, is_mask=False, num_workers=None,
+                   incremental=False):
     """Create a HDF5 file using a list of paths to individual images to be written to the data set. An existing file is
-    overwritten.
+    overwritten, or updated when incremental is True.
     :param imgs_list: list of image paths (NOT the actual images)
     :param dn_name: becomes part of the HDF5 file name
     :param img_path: path to the location of the `images` and `groundtruths` subfolders
@@ -270,6 +336,9 @@ def create_hdf5_db(imgs_list, dn_name, img_path, img_shape, key, ext, settings,
     :param ext: extension of the HDF5 file name
     :param settings: holds settings
     :param is_mask: True if the ground truths data set is being created, False if not
+    :param num_workers: number of processes used to decode images, None for one per CPU
+    :param incremental: True to only load sources that were added or changed since the existing HDF5 file was created
+    (changes to the preprocessing settings are not detected), False to recreate the file
     :return: the full path to the HDF5 file.
     """
     # Construct the name of the database
@@ -282,50 +351,24 @@ def create_hdf5_db(imgs_list, dn_name, img_path, img_shape, key, ext, settings,
     output_path = os.path.join(os.path.dirname(img_path), tmp_name) + ext
     print(output_path)
 
-    # Prepare the HDF5 writer
-    hdf5_writer = HDF5Writer(((len(imgs_list),) + img_shape),
-                             output_path=output_path,
-                             feat_key=key,
-                             label_key=None,
-                             del_existing=True,
-                             buf_size=len(imgs_list),
-                             # dtype_feat=np.float16 if not is_mask else np.uint8
-                             dtype_feat=np.float32 if not is_mask else np.uint8
-                             )
-
-    # Prepare for CLAHE histogram equalization
-    clahe = cv2.createCLAHE(clipLimit=2, tileGridSize=(16, 16))
+    if not incremental and os.path.exists(output_path):
+        os.remove(output_path)
 
-    # Loop through all images
+    # Loop through all images, which are decoded in parallel and returned in their original order. Only new or changed
+    # images are decoded when updating an existing file and images that cannot be read are skipped
     widgets = ["Creating HDF5 database ", progressbar.Percentage(), " ", progressbar.Bar(), " ", progressbar.ETA()]
     pbar = progressbar.ProgressBar(maxval=len(imgs_list), widgets=widgets).start()
-    for i, img in enumerate(imgs_list):
-        image = cv2.imread(img, cv2.IMREAD_GRAYSCALE)
-
-        # Crop to the region of interest
-        image = image[settings.IMG_CROP_HEIGHT:image.shape[0] - settings.IMG_CROP_HEIGHT,
-                settings.IMG_CROP_WIDTH:image.shape[1] - settings.IMG_CROP_WIDTH]
-
-        # Apply pre-processing
-        if is_mask:
-            # Apply binary thresholding to ground truth masks
-            _, image = cv2.threshold(image, settings.MASK_BINARY_THRESHOLD, settings.MASK_BLOODVESSEL,
-                                     cv2.THRESH_BINARY)
-        else:
-            # Apply CLAHE histogram equalization
-            image = clahe.apply(image)
-
-            # Standardise
-            image = standardise_single(image)
-
-        # Reshape from (height, width) to (height, width, 1)
-        image = image.reshape((img_shape[0], img_shape[1], img_shape[2]))
-
-        hdf5_writer.add([image], None)
-        pbar.update(i)
-
+    loader = ParallelLoader(slice_loader(settings, img_shape, is_mask), num_workers=num_workers)
+    (num_copied, num_loaded, num_removed) = update_hdf5(output_path, imgs_list, loader, img_shape,
+                                                        feat_key=key,
+                                                        label_key=None,
+                                                        buf_size=settings.HDF5_BUF_SIZE,
+                                                        # dtype_feat=np.float16 if not is_mask else np.uint8
+                                                        dtype_feat=np.float32 if not is_mask else np.uint8,
+                                                        pbar=pbar)
     pbar.finish()
-    hdf5_writer.close()
+
+    print("{} unchanged, {} loaded, {} removed".format(num_copied, num_loaded, num_removed))
 
     return output_path
 
@@ -389,9 +432,15 @@ def convert_pred_to_img(pred, threshold=0.5, num_channels=1, verbose=False):
 
 
 # Generic functions - load HDF5 data into memory (i.e. no generators)
-def read_images(image_path, key, is_3D=False):
-    """Load an HDF5 data set containing images into memory"""
-    imgs = HDF5Reader().load_hdf5(image_path, key)
+def read_images(image_path, key, is_3D=False, lazy=False, dtype=None, selection=None):
+    """Load an HDF5 data set containing images into memory. With lazy=True the data set is memory-mapped or read
+    when it is sliced instead (see HDF5Reader.load_hdf5), the 3D permutation still reads all images. Otherwise the
+    images are read straight into an array of the dtype provided, optionally limited to a selection such as the
+    slices of a single patient, e.g. np.s_[10:20] (see HDF5Reader.read_into)"""
+    if lazy:
+        imgs = HDF5Reader().load_hdf5(image_path, key, lazy=True)
+    else:
+        imgs = HDF5Reader().read_into(image_path, key, dtype=dtype, selection=selection)
     print("Loading image HDF5: {} with dtype = {}".format(image_path, imgs.dtype))
 
     # Permute array dimensions for the 3D U-Net model so that the shape becomes: (-1, height, width, slices, channels),
@@ -402,9 +451,17 @@ def read_images(image_path, key, is_3D=False):
     return imgs
 
 
-def read_groundtruths(ground_truth_path, key, is_3D=False):
-    """Load an HDF5 data set containing ground truths into memory"""
-    imgs = HDF5Reader().load_hdf5(ground_truth_path, key).astype("uint8")
+def read_groundtruths(ground_truth_path, key, is_3D=False, lazy=False, selection=None):
+    """Load an HDF5 data set containing ground truths into memory as uint8, see read_images for lazy loading and
+    selections"""
+    if lazy:
+        imgs = HDF5Reader().load_hdf5(ground_truth_path, key, lazy=True)
+
+        # Only convert (i.e. read and copy) the ground truths if they were not stored as uint8
+        if imgs.dtype != np.uint8:
+            imgs = np.asarray(imgs).astype("uint8")
+    else:
+        imgs = HDF5Reader().read_into(ground_truth_path, key, dtype=np.uint8, selection=selection)
     print("Loading ground truth HDF5: {} with dtype = {}".format(ground_truth_path, imgs.dtype))
 
     # Permute array dimensions for the 3D U-Net model so that the shape becomes: (-1, height, width, slices, channels),